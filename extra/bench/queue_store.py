@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+'''
+Queue Store Microbenchmark
+------------------------------------------------------------
+
+Compares the per operation cost of a put/get pair on the old
+``Queue.Queue`` backed store, a bare ``collections.deque``, and
+the persistent queues themselves (with logging disabled so only
+the in-memory store is measured).
+
+Run::
+
+    python extra/bench/queue_store.py
+'''
+import shutil, tempfile, timeit
+from Queue import Queue
+from collections import deque
+from mamba.persistent import PersistentQueue, SynchronizedQueue
+
+def measure(name, put, get, count=200000):
+    ''' Helper to time ``count`` put/get pairs and report the cost '''
+    timer = timeit.default_timer
+    start = timer()
+    for value in xrange(count): put(value)
+    for value in xrange(count): get()
+    elapsed = timer() - start
+    print "%-28s %8.1f ns/op" % (name, elapsed / (2 * count) * 1e9)
+
+def main():
+    ''' Run each of the benchmarks '''
+    queue = Queue()
+    measure("Queue.Queue", queue.put, lambda: queue.get(False))
+    queue = deque()
+    measure("collections.deque", queue.append, queue.popleft)
+
+    path = tempfile.mkdtemp()
+    try:
+        for store in (PersistentQueue, SynchronizedQueue):
+            queue = store(path, store.__name__)
+            measure(store.__name__, lambda value: queue.put("value", False),
+                lambda: queue.get(False))
+            queue.purge()
+    finally: shutil.rmtree(path)
+
+if __name__ == "__main__":
+    main()
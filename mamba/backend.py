@@ -0,0 +1,401 @@
+'''
+Mamba Storage Backends
+------------------------------------------------------------
+
+The collection does not create or store its queues itself, it hands
+that to a storage backend. A backend opens (and so recovers) queues
+by name, finds the queues it already holds, writes out the records
+its queues hold for a group commit, and is closed with the collection.
+The queues it opens all have the parts of the :class:`PersistentQueue`
+interface that the collection uses (``put``, ``put_many``, ``get``,
+``qsize``, ``when_durable``, ``close``, ``purge`` and so on).
+
+The backends are looked up by name in ``Backends``, and the ``storage``
+option of the collection picks one for the whole server or one per
+queue name pattern, so trying out another storage engine is a matter
+of adding a class here and pointing some queues at it.
+'''
+import os, threading
+from Queue import Empty
+from collections import deque
+from mamba.persistent import PersistentQueue
+from mamba.journal import Journal
+from mamba.errors import QueueCollectionException
+
+#---------------------------------------------------------------------------#
+# Logging
+#---------------------------------------------------------------------------#
+import logging
+_logger = logging.getLogger("mamba.queue")
+
+#---------------------------------------------------------------------------#
+# Local helpers
+#---------------------------------------------------------------------------#
+def _setup_path(path):
+    '''
+    Helper to check and create a persistence log directory
+
+    :param path: The path to create the directory at
+    :return: void
+    '''
+    if not os.path.isdir(path) and not os.access(path, os.W_OK):
+        try:
+            _logger.info("Creating queue directory : '%s'" % path)
+            os.makedirs(path)
+        except OSError:
+            raise QueueCollectionException("Queue path '%s' is inacessible" % path)
+
+#---------------------------------------------------------------------------#
+# Class definitions
+#---------------------------------------------------------------------------#
+class StorageBackend(object):
+    '''
+    The interface every storage backend implements. A backend reads
+    its settings from the collection that created it.
+    '''
+    replays = False    # opening a queue replays it, so do that off the main thread
+    queue_logs = False # every queue has log files of its own to manage
+
+    def __init__(self, collection):
+        '''
+        Initialize a new storage backend
+
+        :param collection: The collection the backend stores queues for
+        '''
+        self.collection = collection
+
+    def open(self, key):
+        '''
+        Create the queue at key, recovering anything stored for it
+
+        :param key: The name of the queue
+        :return: The new queue
+        '''
+        raise NotImplementedError("open")
+
+    def find_queues(self):
+        '''
+        Find every queue that has something stored in this backend
+
+        :return: A list of the queue names in each place searched
+        '''
+        return [[]]
+
+    def commit(self, queues):
+        '''
+        Write out the records held for a group commit by some queues
+
+        :param queues: The queues of this backend to commit
+        :return: void
+        '''
+        for queue in queues: queue.commit()
+
+    def close(self):
+        '''
+        Close the backend once all of its queues have been closed
+
+        :return: void
+        '''
+        pass
+
+class LogBackend(StorageBackend):
+    '''
+    Keeps every queue in a transaction log of its own, placed in one
+    of the collection paths by its :class:`SpoolLayout`.
+    '''
+    replays = True
+    queue_logs = True
+
+    def __init__(self, collection):
+        '''
+        Initialize a new log backend, creating its directories
+
+        :param collection: The collection the backend stores queues for
+        '''
+        super(LogBackend, self).__init__(collection)
+        self.layout = collection.layout
+        self.locations = {} # name -> directory of logs found by find_queues
+        self.listings = None # (directory, name) -> segments found by find_queues
+        self.scan_lock = threading.Lock()
+        for directory in self.layout.directories():
+            _setup_path(directory)
+
+    def open(self, key):
+        '''
+        Create the queue at key, replaying its log if it has one. The
+        collection paths are scanned the first time (unless a recovery
+        already did), so that no queue has to list its directory.
+
+        :param key: The name of the queue
+        :return: The new queue
+        '''
+        options = self.collection
+        with self.scan_lock:
+            if self.listings is None: self.find_queues()
+        directory = self.locations.get(key, None) or self.layout.directory(key)
+        segments = self.listings.pop((directory, key), [])
+        return options.queue_type(directory, key,
+            durability=options.durability, segment_size=options.segment_size,
+            payloads=options.payloads, memory_budget=options.memory_budget,
+            spill_window=options.spill_window,
+            background_writes=options.writer is not None,
+            preallocate=options.preallocate,
+            coalesce_pops=options.durability != "fsync-per-op",
+            compress_threshold=options.compress_threshold,
+            compress_level=options.compress_level,
+            retain_segments=options.retention.enabled(), segments=segments)
+
+    def find_queues(self):
+        '''
+        Find every queue with a log in the collection paths, scanning
+        each of them in its own thread. A queue found in more than one
+        place is opened from the place it hashes to. The log segments
+        found are kept, so that opening a queue need not list its
+        directory again.
+
+        :return: A list of the queue names found on each path
+        '''
+        shards = [{} for path in self.layout.paths]
+        listings = [{} for path in self.layout.paths]
+        def scan(path, found, listing):
+            for directory in self.layout.directories(path):
+                if not os.path.isdir(directory): continue
+                segments = PersistentQueue.find_segments(directory)
+                for name in segments:
+                    found.setdefault(name, []).append(directory)
+                    listing[(directory, name)] = segments[name]
+        threads = [threading.Thread(target=scan, args=args)
+            for args in zip(self.layout.paths, shards, listings)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        self.listings = {}
+        for listing in listings: self.listings.update(listing)
+
+        located = {}
+        for found in shards:
+            for name, directories in found.iteritems():
+                located.setdefault(name, []).extend(directories)
+        for name, directories in located.iteritems():
+            placed = self.layout.directory(name)
+            if len(directories) > 1:
+                _logger.warning("Queue %s has logs in %s" % (name,
+                    ", ".join("'%s'" % path for path in directories)))
+            self.locations[name] = (placed if placed in directories
+                else directories[0])
+        return [[name for name, directories in found.iteritems()
+            if self.locations[name] in directories] for found in shards]
+
+    def commit(self, queues):
+        '''
+        Write out the records held by some queues, handing them to the
+        log writers if the collection has them.
+
+        :param queues: The queues of this backend to commit
+        :return: void
+        '''
+        writer = self.collection.writer
+        for queue in queues:
+            if not queue.transactions: continue
+            if writer: writer.submit(queue)
+            else: queue.commit()
+
+class JournalBackend(StorageBackend):
+    '''
+    Keeps every queue in one :class:`Journal` in the first collection
+    path, which is replayed as soon as the backend is created.
+    '''
+
+    def __init__(self, collection):
+        '''
+        Initialize a new journal backend, replaying the journal
+
+        :param collection: The collection the backend stores queues for
+        '''
+        super(JournalBackend, self).__init__(collection)
+        path = collection.layout.paths[0]
+        _setup_path(path)
+        self.journal = Journal(path, collection.durability,
+            collection.segment_size)
+
+    def open(self, key):
+        '''
+        Create a view of the queue at key in the journal
+
+        :param key: The name of the queue
+        :return: The new queue
+        '''
+        return self.journal.queue(key)
+
+    def find_queues(self):
+        '''
+        Find every queue with items in the journal
+
+        :return: A list with the list of queue names
+        '''
+        return [self.journal.names()]
+
+    def commit(self, queues):
+        '''
+        Write out the records held for a group commit of the journal
+
+        :param queues: Ignored, the journal is committed as a whole
+        :return: void
+        '''
+        self.journal.commit()
+
+    def close(self):
+        '''
+        Close the journal
+
+        :return: void
+        '''
+        self.journal.close()
+
+class MemoryBackend(StorageBackend):
+    '''
+    Keeps every queue in memory only, so nothing survives a restart.
+    This is mostly useful as a baseline to compare the others with.
+    '''
+
+    def open(self, key):
+        '''
+        Create a new empty queue at key
+
+        :param key: The name of the queue
+        :return: The new queue
+        '''
+        return MemoryQueue(key)
+
+class MemoryQueue(object):
+    '''
+    A queue that is only kept in memory, with the parts of the
+    :class:`PersistentQueue` interface the collection uses.
+    '''
+    pending = () # nothing is ever held for a commit
+    unlogged_pops = 0
+    compressed_in = compressed_out = 0
+    compress_time = 0.0
+    initial_bytes = 0
+    log_size = 0
+
+    def __init__(self, name):
+        '''
+        Create a new empty queue
+
+        :param name: The name of the queue
+        '''
+        self.name = name
+        self.queue = deque()
+        self.total_items = 0
+
+    def put(self, value, log=True, spill=False):
+        '''
+        Pushes ``value`` to the queue
+
+        :param value: The value to queue up
+        :param log: Ignored, there is no log
+        :param spill: Ignored, the payloads are always in memory
+        :return: void
+        '''
+        self.queue.append(value)
+        self.total_items += 1
+
+    def put_many(self, values, spill=False):
+        '''
+        Pushes every one of ``values`` to the queue
+
+        :param values: The values to queue up, in order
+        :param spill: Ignored, the payloads are always in memory
+        :return: void
+        '''
+        self.queue.extend(values)
+        self.total_items += len(values)
+
+    def get(self, log=True):
+        '''
+        Retrieve the next element off the queue
+
+        :param log: Ignored, there is no log
+        :return: The next item off of the queue
+        :raises Empty: If the queue is empty
+        '''
+        if not self.queue: raise Empty
+        return self.queue.popleft()
+
+    def qsize(self):
+        '''
+        Returns the number of items in the queue
+
+        :return: The number of items in the queue
+        '''
+        return len(self.queue)
+
+    @property
+    def queued_bytes(self):
+        ''' The payload bytes of the items in the queue '''
+        return sum(map(len, self.queue))
+
+    def empty(self):
+        '''
+        Check if the queue is empty
+
+        :return: True if the queue is empty, False otherwise
+        '''
+        return not self.queue
+
+    def commit(self):
+        '''
+        There is nothing to commit
+
+        :return: void
+        '''
+        pass
+
+    def when_durable(self, callback, errback=None):
+        '''
+        Call ``callback`` straight away, as nothing is ever made durable
+
+        :param callback: The method to call
+        :param errback: Ignored, there is nothing to fail
+        :return: void
+        '''
+        callback()
+
+    def needs_compaction(self, ratio, min_size):
+        '''
+        There is no log to compact
+
+        :return: False
+        '''
+        return False
+
+    def close(self):
+        '''
+        There is nothing to close
+
+        :return: void
+        '''
+        pass
+
+    def purge(self):
+        '''
+        Drop every item in the queue
+
+        :return: void
+        '''
+        self.queue.clear()
+
+#---------------------------------------------------------------------------#
+# Backend Registry
+#---------------------------------------------------------------------------#
+Backends = {
+    "log":     LogBackend,
+    "journal": JournalBackend,
+    "memory":  MemoryBackend,
+}
+
+#---------------------------------------------------------------------------#
+# Exported Identifiers
+#---------------------------------------------------------------------------#
+__all__ = [ "StorageBackend", "LogBackend", "JournalBackend",
+    "MemoryBackend", "MemoryQueue", "Backends" ]
@@ -5,8 +5,17 @@ Queue Collection
 We wrap all the queues in a collection so that we can control
 the safe creation, statistics, and logging.
 '''
-import os, thread, logging
-from mamba.persistent import PersistentQueue
+import os, time, thread, threading, logging
+from fnmatch import fnmatchcase
+from collections import OrderedDict
+from itertools import izip_longest
+from mamba.persistent import PersistentQueue, SynchronizedQueue
+from mamba.scheduler import Scheduler
+from mamba.writer import LogWriter
+from mamba.backend import Backends
+from mamba.retention import RetentionPolicy
+from mamba.layout import SpoolLayout
+from mamba.defaults import Defaults
 from mamba.errors import QueueCollectionException
 from mamba.attr import AttributeDict
 
@@ -15,19 +24,112 @@ class QueueCollection(object):
     Represents a collection of message queues for the
     mamba system
     '''
-    def __init__(self, path):
+    def __init__(self, path, durability=Defaults.Durability,
+        commit_window=Defaults.CommitWindow, segment_size=Defaults.SegmentSize,
+        payloads=Defaults.Payloads, memory_limit=Defaults.MemoryLimit,
+        memory_budget=Defaults.MemoryBudget, spill_window=Defaults.SpillWindow,
+        compact_ratio=Defaults.CompactRatio,
+        compact_min_size=Defaults.CompactMinSize,
+        log_writers=Defaults.LogWriters, writer_backlog=Defaults.WriterBacklog,
+        storage=Defaults.Storage, max_open_logs=Defaults.MaxOpenLogs,
+        preallocate=Defaults.Preallocate,
+        compress_threshold=Defaults.CompressThreshold,
+        compress_level=Defaults.CompressLevel, retain_age=Defaults.RetainAge,
+        retain_count=Defaults.RetainCount, retain_bytes=Defaults.RetainBytes,
+        retention_interval=Defaults.RetentionInterval, fanout=Defaults.Fanout,
+        synchronized=False, scheduler=None):
         '''
         Initialize a new collection of queues persisted 
         at the given path.
 
-        :param path: The path to store the queue persistence logs
+        The path can also be a list of data directories (or a string
+        of them separated by ``os.pathsep``), in which case every queue
+        log is placed on one of them by a :class:`SpoolLayout`, and
+        recovery scans them all in parallel. Queues that are found by
+        recovery are served from wherever their logs are, even if the
+        list of directories has changed since they were created.
+
+        The queues are stored by the backends in ``Backends``. With
+        ``log`` storage every queue keeps its own transaction log. With
+        ``journal`` storage every queue is appended to one shared
+        :class:`Journal`, which is replayed as soon as the collection is
+        created (the payloads are always kept in memory, and the journal
+        does its own segment reclaiming instead of compacting or using
+        the log writers). With ``memory`` storage nothing is persisted.
+        The storage can also be a list of ``{pattern: backend}`` pairs,
+        where each queue is stored by the backend of the first
+        (``fnmatch`` style) pattern its name matches::
+
+            [{"cache.*": "memory"}, {"*": "log"}]
+
+        If any of the retention limits are set, consumed log segments
+        are kept as retired files, and at most every ``retention_interval``
+        seconds a sweep is run off the main thread to remove the retired
+        files past the :class:`RetentionPolicy`.
+
+        :param path: The path (or paths) to store the queue persistence logs
+        :param durability: The durability mode of the queue logs
+        :param commit_window: The seconds to batch group commits over
+        :param segment_size: The size of each queue log segment
+        :param payloads: Where queue payloads are kept, memory, disk, or spill
+        :param memory_limit: The queued bytes after which every queue spills
+        :param memory_budget: The payload bytes each spilling queue keeps in memory
+        :param spill_window: The bytes a spilling queue keeps at each end
+        :param compact_ratio: The dead to live log ratio to compact at
+        :param compact_min_size: The smallest queue log worth compacting
+        :param log_writers: The threads to append to the logs with, 0 for none
+        :param writer_backlog: The batches each log writer can have waiting
+        :param storage: The backend of every queue, or a list of pattern to backend pairs
+        :param max_open_logs: The queue logs to keep open at once, 0 for all
+        :param preallocate: The chunk to reserve queue log space in, 0 for none
+        :param compress_threshold: The smallest payload to compress, 0 for none
+        :param compress_level: The zlib level to compress payloads with
+        :param retain_age: The seconds a retired log is kept for, 0 for no limit
+        :param retain_count: The retired logs kept per queue, 0 for no limit
+        :param retain_bytes: The retired log bytes kept per queue, 0 for no limit
+        :param retention_interval: The seconds between retention sweeps
+        :param fanout: The hashed subdirectories in each path, 0 for none
+        :param synchronized: Set to True if the queues are shared between threads
+        :param scheduler: The scheduler used to defer work
         '''
-        self.path = path
+        self.routes = self._parse_storage(storage)
+        self.layout = SpoolLayout(path, fanout)
+        self.durability = durability
+        self.commit_window = commit_window
+        self.segment_size = segment_size
+        self.payloads = payloads
+        self.memory_limit = memory_limit
+        self.memory_budget = memory_budget
+        self.spill_window = spill_window
+        self.compact_ratio = compact_ratio
+        self.compact_min_size = compact_min_size
+        self.queue_type = SynchronizedQueue if synchronized else PersistentQueue
+        self.scheduler = scheduler or Scheduler()
+        self.writer = (log_writers and any(Backends[name].queue_logs
+            for pattern, name in self.routes) and
+            LogWriter(log_writers, writer_backlog, self.scheduler) or None)
+        self.max_open_logs = max_open_logs
+        self.preallocate = preallocate
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.retention = RetentionPolicy(retain_age, retain_count, retain_bytes)
+        self.retention_interval = retention_interval
+        self.retention_due = 0 # when the next sweep may run
+        self.retention_running = False
+        self.open_logs = OrderedDict() # least recently used first
+        self.uncommitted = {}
+        self.commit_scheduled = False
+        self.recovering = set()
+        self.purging = {} # name -> detached queue waiting to be purged
+        self.ready_waiters = {}
         self.queues = {}
         self.queue_locks = {}
         self.shutdown_lock = thread.allocate_lock()
         self.statistics = AttributeDict()
-        self._setup_path(path)
+        self.routed = {} # name -> backend of the queue
+        self.backends = dict((name, Backends[name](self))
+            for name in set(name for pattern, name in self.routes))
+        self._schedule_retention()
 
     def put(self, key, data):
         '''
@@ -41,7 +143,29 @@ class QueueCollection(object):
         if queue:
             self.statistics.current_bytes += len(data)
             self.statistics.total_items += 1
-            queue.put(data)
+            self._touch_log(queue)
+            queue.put(data, spill=self.memory_limit > 0 and
+                self.statistics.current_bytes > self.memory_limit)
+            self._schedule_commit(queue)
+        return queue is not None
+
+    def put_many(self, key, values):
+        '''
+        Puts several new values in the queue at key, which are written
+        to its log together as a single append.
+
+        :param key: The key to put the values at
+        :param values: The list of data to put at the specified key
+        :return: True if the put succeeded, False otherwise
+        '''
+        queue = self.get_queues(key)
+        if queue:
+            self.statistics.current_bytes += sum(map(len, values))
+            self.statistics.total_items += len(values)
+            self._touch_log(queue)
+            queue.put_many(values, spill=self.memory_limit > 0 and
+                self.statistics.current_bytes > self.memory_limit)
+            self._schedule_commit(queue)
         return queue is not None
     
     def get(self, key):
@@ -51,15 +175,88 @@ class QueueCollection(object):
         :param key: The key to put the next value at
         :return: The data at key or None if the queue does not exist
         '''
+        results = self.get_many(key, 1)
+        return results[0] if results else None
+
+    def get_many(self, key, count):
+        '''
+        Retrieves up to ``count`` values at key in one go. The pops are
+        logged together (as a single record for queues that coalesce
+        their pops) and the queue is only checked for a commit or a
+        compaction once.
+
+        :param key: The key to take the next values from
+        :param count: The most values to take
+        :return: The list of values taken, empty if there were none
+        '''
         queue = self.get_queues(key)
-        result = None
+        results = []
         if not queue or not queue.qsize():
             self.statistics.get_misses += 1
         else:
-            self.statistics.get_hits += 1
-            result = queue.get()
-            self.statistics.current_bytes -= len(result)
-        return result
+            self._touch_log(queue)
+            while len(results) < count and queue.qsize():
+                results.append(queue.get())
+            self.statistics.get_hits += len(results)
+            self.statistics.current_bytes -= sum(map(len, results))
+            self._schedule_commit(queue)
+            self._schedule_compaction(queue)
+            self._schedule_retention()
+        return results
+
+    def when_durable(self, key, callback, errback=None):
+        '''
+        Call ``callback`` once everything logged for the queue at key
+        is durable (immediately unless the queue is group committing),
+        or ``errback`` if it could not be written.
+
+        :param key: The key of the queue to wait on
+        :param callback: The method to call once the queue is durable
+        :param errback: The method to call if the queue log failed
+        :return: void
+        '''
+        queue = self.queues.get(key, None)
+        if queue: queue.when_durable(callback, errback)
+        else: callback()
+
+    def when_ready(self, key, callback):
+        '''
+        Call ``callback`` once the queue at key has been replayed and
+        can be served (immediately if it already is). A queue that has
+        not been touched yet is replayed off the main thread by the
+        scheduler, so a long log does not stall every other client.
+        Queues of backends that do not replay (such as the journal,
+        which is replayed up front) are always ready.
+        A queue that is still being purged is only recreated once the
+        purge has finished.
+
+        :param key: The key of the queue to wait on
+        :param callback: The method to call once the queue is ready
+        :return: void
+        '''
+        if (key in self.queues or not self._backend(key).replays
+            or self.shutdown_lock.locked()):
+            return callback()
+        self.ready_waiters.setdefault(key, []).append(callback)
+        if key not in self.recovering and key not in self.purging:
+            logging.debug("Loading queue %s" % key)
+            self.recovering.add(key)
+            self.scheduler.call_in_thread(self._create_queue,
+                lambda queue: self._loaded(key, queue), key, False)
+
+    def commit(self):
+        '''
+        Write out the pending group commit batch of every queue
+
+        :return: void
+        '''
+        self.commit_scheduled = False
+        queues, self.uncommitted = self.uncommitted, {}
+        backends = {}
+        for queue in queues.itervalues():
+            backends.setdefault(self._backend(queue.name), []).append(queue)
+        for backend, queues in backends.iteritems():
+            backend.commit(queues)
     
     def get_queues(self, key = None):
         '''
@@ -74,6 +271,7 @@ class QueueCollection(object):
         # if no queue specified, return all, otherwise return queue
         if not key: return self.queues
         if self.queues.has_key(key): return self.queues[key]
+        if key in self.recovering or key in self.purging: return None
         
         # otherwise, we need to start the safe creation process
         if not self.queue_locks.has_key(key):
@@ -86,24 +284,87 @@ class QueueCollection(object):
                 self.queue_locks[key].acquire()
                 if not self.queues.has_key(key):
                     logging.debug("Creating new queue %s" % key)
-                    self.queues[key] = PersistentQueue(self.path, key)
-                    self.statistics.current_bytes += self.queues[key].initial_bytes
+                    self._install_queue(key, self._create_queue(key))
             finally:
                 self.queue_locks[key].release()
                 del self.queue_locks[key] # do we need this?
         return self.queues[key]
 
+    def recover(self, workers=Defaults.RecoveryWorkers, wait=True, callback=None):
+        '''
+        Replay the log of every queue found in the persistence paths,
+        with at most ``workers`` queues replaying at the same time. The
+        paths are scanned in parallel, and the replays are spread
+        evenly over them.
+
+        When waiting, the replays run in a pool of threads and this
+        returns once every queue is ready. Otherwise the replays are
+        handed to the scheduler and the queues are served as soon as
+        each one finishes; the ones still replaying look busy until then.
+
+        :param workers: The number of queues to replay in parallel
+        :param wait: Set to False to return before the replays finish
+        :param callback: The method to call once every queue is ready
+        :return: void
+        '''
+        skipped = set(self.queues) | self.recovering
+        shards = [sorted(name for name in set(found) - skipped
+            if self._backend(name) is backend)
+            for backend in self.backends.itervalues()
+            for found in backend.find_queues()]
+        names = [name for names in izip_longest(*shards)
+            for name in names if name is not None]
+        logging.info("Recovering %d queues from %s" % (len(names),
+            ", ".join("'%s'" % path for path in self.layout.paths)))
+        self.recovering.update(names)
+        state = { 'names': names, 'remaining': len(names),
+            'start': time.time(), 'callback': callback }
+
+        if not names:
+            self._finish_recovery(state)
+        elif wait:
+            results = []
+            def replay():
+                while names:
+                    try: name = names.pop()
+                    except IndexError: break
+                    results.append((name, self._create_queue(name, False)))
+            threads = [threading.Thread(target=replay)
+                for _ in range(min(workers, len(names)))]
+            for worker in threads: worker.start()
+            for worker in threads: worker.join()
+            for name, queue in results: self._recovered(state, name, queue)
+        else:
+            for _ in range(min(workers, len(names))):
+                self._recover_next(state)
+
     def delete(self, key):
         '''
-        Delete the queue at key if it exists
+        Delete the queue at key if it exists. The queue is detached
+        straight away, but its log is closed and removed off the main
+        thread by the scheduler (after any compaction of it finishes),
+        as purging a large log can take a while.
+
+        Queues of backends that do not replay are only opened when used,
+        so one stored before a restart is opened here to be deleted.
 
         :param key: The key to delete
         :return: True if successful, False otherwise
         '''
-        queue = self.queues.get(key, None)
+        backend = self._backend(key)
+        if key not in self.queues and not backend.replays:
+            if any(key in names for names in backend.find_queues()):
+                self.get_queues(key)
+        queue = self.queues.pop(key, None)
         if queue:
-            queue.purge
-            del self.queues[key]
+            self.statistics.current_bytes -= queue.queued_bytes
+            self.open_logs.pop(key, None)
+            self.uncommitted.pop(key, None)
+            if not self._backend(key).queue_logs: queue.purge()
+            else:
+                queue.detach()
+                self.purging[key] = queue
+                if not queue.compacting: self._start_purge(key, queue)
         return queue is not None
         
     def get_statistic(self, name = None):
@@ -116,6 +377,13 @@ class QueueCollection(object):
             ``current_bytes`` Current size in bytes of items in the queues
             ``current_size``  Current number of items across all queues
             ``total_items``   Total number of items stored in queues.
+            ``log_compactions`` Total number of queue log compactions
+            ``recovered_queues`` Total number of queues recovered at startup
+            ``log_cache_hits`` Total number of uses of a queue with its log open
+            ``log_cache_misses`` Total number of queue logs that had to be opened
+            ``open_logs``     Current number of open queue logs
+            ``retired_logs_removed`` Total number of retired logs removed
+            ``purges_in_progress`` Current number of deleted queues being purged
 
         :param name: The statistic to retrieve, or none for all
         :return: the requested statistic
@@ -123,7 +391,11 @@ class QueueCollection(object):
         if not name:
             return self.statistics
         elif name == 'current_size':
-            return sum(q.qsize() for q in self.queues)
+            return sum(q.qsize() for q in self.queues.itervalues())
+        elif name == 'open_logs':
+            return len(self.open_logs)
+        elif name == 'purges_in_progress':
+            return len(self.purging)
         else: return self.statistics[name]
     
     def close(self):
@@ -138,21 +410,267 @@ class QueueCollection(object):
         for queue in self.queues.values():
             queue.close()
         self.queues.clear()
+        self.open_logs.clear()
+        if self.writer: self.writer.close()
+        for backend in self.backends.itervalues():
+            backend.close()
 
     # ---------------------------------------------------- #
     # Private Methods
     # ---------------------------------------------------- #
-    def _setup_path(self, path):
+    def _create_queue(self, key, required=True):
+        '''
+        Helper to create (and so replay) the queue at key
+
+        :param key: The name of the queue to create
+        :param required: Set to False to log failures instead of raising
+        :return: The new queue, or None if it could not be created
         '''
-        Helper to check and create the persistence log directory
+        try:
+            return self._backend(key).open(key)
+        except Exception, ex:
+            if required: raise
+            logging.error("Failed to recover queue %s: %s" % (key, ex))
+            return None
+
+    def _backend(self, key):
+        '''
+        Helper to find the storage backend of the queue at key
 
-        :param path: The path to create the directory at
+        :param key: The name of the queue
+        :return: The backend that stores the queue
+        '''
+        backend = self.routed.get(key, None)
+        if backend is None:
+            name = next(name for pattern, name in self.routes
+                if fnmatchcase(key, pattern))
+            backend = self.routed[key] = self.backends[name]
+        return backend
+
+    def _parse_storage(self, storage):
+        '''
+        Helper to turn the storage option into a list of (pattern,
+        backend) routes, ending with a route that matches every queue.
+
+        :param storage: The backend name, or a list of pattern to backend pairs
+        :return: The list of routes in the order to try them
+        '''
+        if isinstance(storage, basestring): storage = [{ "*": storage }]
+        routes = [route for pairs in storage for route in
+            (pairs.iteritems() if isinstance(pairs, dict) else [pairs])]
+        if not any(pattern == "*" for pattern, name in routes):
+            routes.append(("*", Defaults.Storage))
+        for pattern, name in routes:
+            if name not in Backends:
+                raise QueueCollectionException("Invalid storage mode %s" % name)
+        return routes
+
+    def _install_queue(self, key, queue):
+        '''
+        Helper to start serving a newly created queue
+
+        :param key: The name of the queue
+        :param queue: The queue to serve
         :return: void
         '''
-        if not os.path.isdir(path) and not os.access(path, os.W_OK):
-            try:
-                logging.info("Creating queue directory : '%s'" % path)
-                os.makedirs(path)
-            except OSError:
-                raise QueueCollectionException("Queue path '%s' is inacessible" % path) 
-        
+        self.queues[key] = queue
+        self.statistics.current_bytes += queue.initial_bytes
+        self._touch_log(queue)
+
+    def _touch_log(self, queue):
+        '''
+        Helper to mark the log of a queue as the most recently used,
+        suspending the least recently used queues to stay within the
+        limit of open logs. A suspended queue reopens its own log the
+        next time it is used.
+
+        Busy queues (compacting or waiting on a log writer) cannot be
+        suspended, so they are skipped and keep their place, and the
+        next idle queue is suspended instead. The limit is only exceeded
+        while every other open log is busy.
+
+        :param queue: The queue that is about to be used
+        :return: void
+        '''
+        if not self.max_open_logs or not self._backend(queue.name).queue_logs:
+            return
+        if self.open_logs.pop(queue.name, None) is not None:
+            self.statistics.log_cache_hits += 1
+        else: self.statistics.log_cache_misses += 1
+        self.open_logs[queue.name] = queue
+        excess, suspended = len(self.open_logs) - self.max_open_logs, []
+        for name, idle in self.open_logs.iteritems(): # least recent first
+            if len(suspended) >= excess or idle is queue: break
+            if idle.suspend(): suspended.append(name)
+        for name in suspended: del self.open_logs[name]
+
+    def _recover_next(self, state):
+        '''
+        Helper to hand the next queue waiting on recovery to the
+        scheduler.
+
+        :param state: The shared recovery state
+        :return: void
+        '''
+        if not state['names']: return
+        name = state['names'].pop(0)
+        self.scheduler.call_in_thread(self._create_queue,
+            lambda queue: self._recovered(state, name, queue), name, False)
+
+    def _recovered(self, state, name, queue):
+        '''
+        Helper to serve a queue that has finished recovering, and to
+        report when every queue has.
+
+        :param state: The shared recovery state
+        :param name: The name of the recovered queue
+        :param queue: The recovered queue, or None if it failed
+        :return: void
+        '''
+        if self._loaded(name, queue):
+            self.statistics.recovered_queues += 1
+        state['remaining'] -= 1
+        self._recover_next(state)
+        if not state['remaining']:
+            self._finish_recovery(state)
+
+    def _loaded(self, key, queue):
+        '''
+        Helper to serve a queue that has been replayed off the main
+        thread, and to wake up everything that was waiting on it.
+
+        :param key: The name of the replayed queue
+        :param queue: The replayed queue, or None if it failed
+        :return: True if the queue is now being served, False otherwise
+        '''
+        self.recovering.discard(key)
+        installed = queue is not None and not self.shutdown_lock.locked()
+        if installed: self._install_queue(key, queue)
+        elif queue is not None: queue.close()
+        for callback in self.ready_waiters.pop(key, []):
+            callback()
+        return installed
+
+    def _finish_recovery(self, state):
+        '''
+        Helper to report that every queue has been recovered
+
+        :param state: The shared recovery state
+        :return: void
+        '''
+        logging.info("Recovered the queues in %0.3fs"
+            % (time.time() - state['start']))
+        if state['callback']: state['callback']()
+
+    def _schedule_commit(self, queue):
+        '''
+        Helper to batch the pending records of a queue into the
+        next group commit, scheduling one if needed.
+
+        :param queue: The queue that has just been written to
+        :return: void
+        '''
+        if not queue.pending and not queue.unlogged_pops: return
+        self.uncommitted[queue.name] = queue
+        if not self.commit_scheduled:
+            self.commit_scheduled = True
+            self.scheduler.call_later(self.commit_window, self.commit)
+
+    def _schedule_compaction(self, queue):
+        '''
+        Helper to start a background compaction of a queue log once
+        enough of it is taken up by items that have been popped.
+
+        :param queue: The queue that has just been read from
+        :return: void
+        '''
+        if not self.compact_ratio: return
+        if queue.needs_compaction(self.compact_ratio, self.compact_min_size):
+            self.statistics.log_compactions += 1
+            state = queue.begin_compaction()
+            self.scheduler.call_in_thread(queue.write_compaction,
+                lambda state: self._compacted(queue, state), state)
+
+    def _compacted(self, queue, state):
+        '''
+        Helper to finish a background compaction, and to start the
+        purge of the queue if it was deleted while compacting.
+
+        :param queue: The queue that was compacted
+        :param state: The state returned from ``write_compaction``
+        :return: void
+        '''
+        queue.finish_compaction(state)
+        if self.purging.get(queue.name, None) is queue:
+            self._start_purge(queue.name, queue)
+
+    def _start_purge(self, key, queue):
+        '''
+        Helper to hand the purge of a detached queue to the scheduler
+
+        :param key: The name of the deleted queue
+        :param queue: The detached queue to purge
+        :return: void
+        '''
+        logging.debug("Purging queue %s" % key)
+        self.scheduler.call_in_thread(self._purge_queue,
+            lambda _: self._purged(key), queue)
+
+    def _purge_queue(self, queue):
+        '''
+        Helper to purge a detached queue, which is safe to run in a
+        background thread.
+
+        :param queue: The detached queue to purge
+        :return: void
+        '''
+        try: queue.purge()
+        except Exception, ex:
+            logging.error("Failed to purge queue %s: %s" % (queue.name, ex))
+
+    def _purged(self, key):
+        '''
+        Helper to record the end of a purge, and to recreate the
+        queue for anything that used it while it was being purged.
+
+        :param key: The name of the purged queue
+        :return: void
+        '''
+        del self.purging[key]
+        for callback in self.ready_waiters.pop(key, []):
+            self.when_ready(key, callback)
+
+    def _schedule_retention(self):
+        '''
+        Helper to start a background sweep of the retired logs, at
+        most once every retention interval.
+
+        :return: void
+        '''
+        if not self.retention.enabled() or self.retention_running: return
+        if time.time() < self.retention_due: return
+        self.retention_running = True
+        self.retention_due = time.time() + self.retention_interval
+        self.scheduler.call_in_thread(self._enforce_retention,
+            self._retention_finished)
+
+    def _enforce_retention(self):
+        '''
+        Helper to sweep the retired logs out of every directory that
+        can hold queue logs, which is safe to run in a background thread.
+
+        :return: The retired logs that were removed
+        '''
+        directories = self.layout.directories()
+        return [path for directory in directories if os.path.isdir(directory)
+            for path in self.retention.enforce(directory)]
+
+    def _retention_finished(self, removed):
+        '''
+        Helper to record the end of a retention sweep
+
+        :param removed: The retired logs that the sweep removed
+        :return: void
+        '''
+        self.retention_running = False
+        self.statistics.retired_logs_removed += len(removed)
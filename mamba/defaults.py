@@ -18,6 +18,31 @@ class Defaults(object):
     Logfile   = "/var/log/mamba.log"
     Loglevel  = 0
 
+    # queue persistence
+    Durability   = "flush"
+    CommitWindow = 0.0
+    SegmentSize  = 16 * (1024**2) # 16 MB
+    Payloads     = "memory"
+    MemoryLimit  = 0 # no limit
+    MemoryBudget = 0 # no limit
+    SpillWindow  = 1024**2 # 1 MB
+    Recovery     = "lazy"
+    RecoveryWorkers = 4
+    CompactRatio = 2.0
+    CompactMinSize = 4 * (1024**2) # 4 MB
+    LogWriters   = 0 # write the logs on the reactor
+    WriterBacklog = 1024 # batches waiting on each writer
+    Storage      = "log" # a log per queue
+    MaxOpenLogs  = 0 # no limit
+    Preallocate  = 0 # grow the logs as they are written
+    CompressThreshold = 0 # store payloads as they are
+    CompressLevel = 6
+    RetainAge    = 0 # delete consumed log segments
+    RetainCount  = 0
+    RetainBytes  = 0
+    RetentionInterval = 60 # seconds between retired log sweeps
+    Fanout       = 0 # keep the logs flat in each path
+
 #---------------------------------------------------------------------------# 
 # Exported Identifiers
 #---------------------------------------------------------------------------# 
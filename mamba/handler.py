@@ -3,7 +3,8 @@ Mamba Protocol Handler
 -----------------------------------------------------------
 
 '''
-import re, os, time
+import os, time
+from collections import deque
 from struct import pack, unpack
 import mamba
 try:
@@ -43,151 +44,344 @@ class Handler(object):
         '''
         self.database = database
         self.statistics = statistics
-        self.exiprations = {}
+        self.expirations = {}
         self.state = None
+        self.waiting = False
+        self.resuming = False
+        self.backlog = deque()
+        self.batch = []    # (key, message) of the sets held to store together
 
     def process(self, command, callbacks):
         '''
-        Main handler processing function for new client request
+        Main handler processing function for new client request. A set
+        command is followed by a block of data, which the caller must
+        read as it is (not as lines) and pass to :meth:`process_data`.
 
         :param command: The command to issue against the queue
+        :param callbacks: The continuations to process the command result
+        :return: The length of the data block to read next, or None
+        '''
+        parsed = Messages.parse_command(command)
+        if not parsed:
+            _logger.debug("Received unknown command")
+            return self._dispatch(callbacks, '_unknown', ())
+        processor, arguments = parsed
+        if processor == '_set': # wait for the data block
+            self.state = arguments
+            return int(arguments[3])
+        self._dispatch(callbacks, processor, arguments)
+
+    def process_data(self, chunks, trailer, callbacks):
+        '''
+        Handler processing function for the data block of a set command
+
+        :param chunks: The data block, as a list of strings
+        :param trailer: The bytes read after the data block
+        :param callbacks: The continuations to process the command result
+        :return: void
+        '''
+        arguments, self.state = self.state, None
+        if trailer != Messages.data_trailer:
+            _logger.debug("Received a bad data block")
+            self._dispatch(callbacks, '_data_error', ())
+        else: self._dispatch(callbacks, '_set',
+            arguments[:4] + [chunks] + arguments[4:])
+
+    def flush(self, callbacks):
+        '''
+        Store the sets sent with ``noreply`` that are being held so that
+        they can be written together. This should be called once every
+        command read so far has been processed.
+
         :param callbacks: The continuations to process the command result
         :return: void
         '''
-        # if we have a set command pending
-        if self.state: self._set_data(callbacks, command)
-        else:
-        # otherwise process the request as an new command
-            for proc, regex in Messages.get_commands():
-                match = re.match(regex, command)
-                if match:
-                    getattr(self, proc)(callbacks, match)
-                    break
-            else:
-                _logger.debug("Received unknown command")
-                callbacks['send'](Messages.unknown_response)
+        if self.batch and not self.waiting:
+            self._store_batch(callbacks, False)
 
     # ---------------------------------------------------- #
     # Private Methods
     # ---------------------------------------------------- #
 
-    def _shutdown(self, callbacks, match):
+    def _respond_when_durable(self, callbacks, keys, response, failure):
+        '''
+        Helper to hold a response (and any commands after it) until
+        the queues at keys have all made their latest records durable.
+
+        :param callbacks: The continuations to send the results to
+        :param keys: The queues that must be durable
+        :param response: The response to send once they are
+        :param failure: The response to send if any of them fails
+        :return: void
+        '''
+        remaining, failed = [len(keys)], []
+        def respond():
+            remaining[0] -= 1
+            if remaining[0]: return
+            callbacks['send'](failure if failed else response)
+            self._resume()
+        def fail():
+            failed.append(True)
+            respond()
+        self.waiting = True
+        for key in keys:
+            self.database.when_durable(key, respond, fail)
+
+    def _dispatch(self, callbacks, processor, arguments):
+        '''
+        Helper to run a command. Responses must go out in order, so a
+        command that arrives while we are waiting on an earlier one is
+        held on to until that one is done.
+
+        :param callbacks: The continuations to send the results to
+        :param processor: The name of the method that runs the command
+        :param arguments: The arguments of the command
+        :return: void
+        '''
+        if self.waiting:
+            self.backlog.append((callbacks, processor, arguments))
+        else: self._run(callbacks, processor, arguments)
+
+    def _run(self, callbacks, processor, arguments):
+        '''
+        Helper to run a command, storing any sets held for a batch first
+        (unless it is another set, which joins them). If storing them has
+        to wait, the command is put back at the front of the backlog.
+
+        :param callbacks: The continuations to send the results to
+        :param processor: The name of the method that runs the command
+        :param arguments: The arguments of the command
+        :return: void
+        '''
+        if self.batch and processor != '_set':
+            self._store_batch(callbacks, False)
+            if self.waiting:
+                self.backlog.appendleft((callbacks, processor, arguments))
+                return
+        getattr(self, processor)(callbacks, *arguments)
+
+    def _when_ready(self, keys, method, *args):
+        '''
+        Helper to hold a command (and any commands after it) until
+        the queues at keys have all been replayed.
+
+        :param keys: The queues that must be ready
+        :param method: The method to finish the command with
+        :param args: The arguments to pass to the method
+        :return: void
+        '''
+        remaining = [len(keys)]
+        def ready():
+            remaining[0] -= 1
+            if remaining[0]: return
+            self.waiting = False
+            method(*args)
+            if not self.waiting: self._resume()
+        self.waiting = True
+        for key in keys:
+            self.database.when_ready(key, ready)
+
+    def _resume(self):
+        '''
+        Helper to process the commands that arrived while we were
+        waiting on an earlier one.
+
+        :return: void
+        '''
+        self.waiting = False
+        if self.resuming: return # the outer call keeps draining
+        self.resuming = True
+        try:
+            while self.backlog and not self.waiting:
+                callbacks, processor, arguments = self.backlog.popleft()
+                self._run(callbacks, processor, arguments)
+            if self.batch and not self.waiting:
+                self._store_batch(None, False)
+        finally: self.resuming = False
+
+    def _shutdown(self, callbacks):
         '''
         Wrapper around the client shutdown operation
 
         :param callbacks: The continuations to send the results to
-        :param match: The parameters found for the command
         :return: void
         '''
         _logger.debug("Received a SHUTDOWN command")
         callbacks['send'](Messages.quit_response)
         callbacks['exit']()
 
-    def _quit(self, callbacks, match):
+    def _unknown(self, callbacks):
+        '''
+        Wrapper around the response to an unknown command
+
+        :param callbacks: The continuations to send the results to
+        :return: void
+        '''
+        callbacks['send'](Messages.unknown_response)
+
+    def _data_error(self, callbacks):
+        '''
+        Wrapper around the response to a set with a bad data block
+
+        :param callbacks: The continuations to send the results to
+        :return: void
+        '''
+        callbacks['send'](Messages.set_client_data_error)
+
+    def _quit(self, callbacks):
         '''
         Wrapper around the client quit operation
 
         :param callbacks: The continuations to send the results to
-        :param match: The parameters found for the command
         :return: void
         '''
         _logger.debug("Received a QUIT command")
         self.statistics.clean_exits += 1
         callbacks['send'](Messages.quit_response)
 
-    def _delete(self, callbacks, match):
+    def _delete(self, callbacks, key, timeout):
         '''
         Wrapper around the queue delete operation
 
         :param callbacks: The continuations to send the results to
-        :param match: The parameters found for the command
+        :param key: The key of the queue to delete
+        :param timeout: The time to wait before deleting (ignored)
         :return: void
         '''
         _logger.debug("Received a DELETE command")
         self.statistics.delete_requests += 1
+        self._when_ready([key], self._finish_delete, callbacks, key)
+
+    def _finish_delete(self, callbacks, key):
+        '''
+        Helper to delete a queue once it is ready
 
-        key = match.group(1)
+        :param callbacks: The continuations to send the results to
+        :param key: The key of the queue to delete
+        :return: void
+        '''
         self.database.delete(key)
         callbacks['send'](Messages.delete_response)
 
-    def _set(self, callbacks, match):
+    def _set(self, callbacks, key, flags, expire, length, chunks,
+        noreply=False):
         '''
-        Wrapper around the queue set operation
+        Wrapper around the queue set operation. A set sent with ``noreply``
+        is held (without a response) so that the sets pipelined after it
+        are stored along with it, each queue getting one log append for
+        the lot. The next set without ``noreply`` stores them all and
+        acknowledges them all with its response.
 
         :param callbacks: The continuations to send the results to
-        :param match: The parameters found for the command
+        :param key: The key of the queue to store the message in
+        :param flags: The client flags of the message
+        :param expire: The time the message expires at, 0 for never
+        :param length: The length of the message data
+        :param chunks: The message data, as a list of strings
+        :param noreply: True to hold the message without a response
         :return: void
         '''
         _logger.debug("Received a SET command")
         self.statistics.set_requests += 1
+        chunks.insert(0, pack(Messages.data_header_format, int(flags), int(expire)))
+        self.batch.append((key, "".join(chunks)))
+        if not noreply: self._store_batch(callbacks, True)
 
-        key, flags, expire, length = (
-            match.group(1), match.group(2), match.group(3), match.group(4))
-        self.state = {
-            'key': key, 'flags':int(flags),
-            'expire':int(expire), 'length':int(length) }
-        self.buffer = '' # start state machine
-
-    def _set_data(self, callbacks, data):
+    def _store_batch(self, callbacks, acknowledge):
         '''
-        Wrapper around the actually setting the resulting data
+        Helper to store the held sets once all of their queues are ready
 
         :param callbacks: The continuations to send the results to
-        :param data: The next chunk of data to process
+        :param acknowledge: True to respond once they are stored
         :return: void
         '''
-        self.buffer += data # what if we get overlapped commands ?
-        if len(self.buffer) == self.state['length']:
-            _logger.debug("Finishing SET command")
-            compressed = pack(Messages.data_pack_format % self.state['length'],
-                self.state['flags'], self.state['expire'], self.buffer)
-            if self.database.put(self.state['key'], compressed):
-                callbacks['send'](Messages.set_response_success)
-            else: callbacks['send'](Messages.set_response_failure)
-            self.buffer, self.state = ('', None) # reset
+        batch, self.batch = self.batch, []
+        keys, messages = [], {}
+        for key, data in batch:
+            if key not in messages: keys.append(key)
+            messages.setdefault(key, []).append(data)
+        self._when_ready(keys, self._finish_batch, callbacks, keys, messages,
+            acknowledge)
+
+    def _finish_batch(self, callbacks, keys, messages, acknowledge):
+        '''
+        Helper to store a batch of messages once their queues are ready.
+        The response is only a success if every message was stored.
 
-    def _get_next_message(self, key):
+        :param callbacks: The continuations to send the results to
+        :param keys: The keys of the queues, in the order they were sent
+        :param messages: The key -> list of packed messages to store
+        :param acknowledge: True to respond once they are stored
+        :return: void
+        '''
+        stored = [self.database.put_many(key, messages[key]) for key in keys]
+        if not acknowledge: return
+        if all(stored):
+            self._respond_when_durable(callbacks, keys,
+                Messages.set_response_success, Messages.set_response_failure)
+        else: callbacks['send'](Messages.set_response_failure)
+
+    def _get_next_messages(self, key, count):
         '''
         Helper method to abstract away from getting the next valid
-        non expired message out of a queue
-
-        :param key: The key to retrieve the next message from
-        :return: The next message, or None if none exist
-        '''
-        now = time.time()
-        flag, result = None, None
-        for message in iter(lambda: self.database.get(key), None):
-            flag, expire, result = unpack(
-                Messages.data_pack_format % (len(message) - 8), message)
-            if expire == 0 or expire >= now:
-                break
-            self.exiprations[key] = 1 + self.expirations.get(key, 0)
-            flag, expire, result = (None, None, None) # reset results
-        return (flag, result)
+        non expired messages out of a queue
+
+        :param key: The key to retrieve the next messages from
+        :param count: The most messages to retrieve
+        :return: A list of the (flag, message) of each message retrieved
+        '''
+        now, results = time.time(), []
+        while len(results) < count:
+            wanted = count - len(results)
+            messages = self.database.get_many(key, wanted)
+            for message in messages:
+                flag, expire, result = unpack(
+                    Messages.data_pack_format % (len(message) - 8), message)
+                if expire == 0 or expire >= now:
+                    results.append((flag, result))
+                else: self.expirations[key] = 1 + self.expirations.get(key, 0)
+            if len(messages) < wanted: break # the queue is empty
+        return results
     
-    def _get(self, callbacks, match):
+    def _get(self, callbacks, *keys):
         '''
-        Wrapper around the queue get operation
+        Wrapper around the queue get operation, which takes the next
+        message off of every queue named. A key of ``name/n=count``
+        takes up to count messages off of the queue name instead.
 
         :param callbacks: The continuations to send the results to
-        :param match: The parameters found for the command
+        :param keys: The keys of the queues to read from
         :return: void
         '''
         _logger.debug("Received a GET command")
-        self.statistics.get_requests += 1
+        self.statistics.get_requests += len(keys)
+        requests = [(key,) + Messages.parse_batch(key) for key in keys]
+        self._when_ready([name for key, name, count in requests],
+            self._finish_get, callbacks, requests)
+
+    def _finish_get(self, callbacks, requests):
+        '''
+        Helper to send the next messages of each queue once they are
+        ready, as one response with a value for each message taken.
 
-        key = match.group(1)
-        (flag, data) = self._get_next_message(key)
-        if data:
-            callbacks['send'](Messages.get_response % (key, flag, len(data), data))
-        else: callbacks['send'](Messages.get_response_empty)
+        :param callbacks: The continuations to send the results to
+        :param requests: The (key, queue, count) of each key requested
+        :return: void
+        '''
+        response = []
+        for key, name, count in requests:
+            for flag, data in self._get_next_messages(name, count):
+                if not data: continue
+                response.append(Messages.get_response_value
+                    % (key, flag, len(data), data))
+        response.append(Messages.get_response_empty)
+        callbacks['send']("".join(response))
     
-    def _statistics(self, callbacks, match):
+    def _statistics(self, callbacks):
         '''
         Wrapper around the server statistics retrieval operation
 
         :param callbacks: The continuations to send the results to
-        :param match: The parameters found for the command
         :return: void
         '''
         _logger.debug("Received a STATS command")
@@ -209,7 +403,12 @@ class Handler(object):
             self.database.get_statistic('get_misses'),
             self.statistics.bytes_read,
             self.statistics.bytes_written,
-            0,
+            self.database.memory_limit,
+            self.database.get_statistic('log_cache_hits'),
+            self.database.get_statistic('log_cache_misses'),
+            self.database.get_statistic('open_logs'),
+            self.database.get_statistic('retired_logs_removed'),
+            self.database.get_statistic('purges_in_progress'),
             self._get_queue_statistics()
         ))
         
@@ -229,6 +428,8 @@ class Handler(object):
                 'size':   queue.qsize(),      # number of queues
                 'total':  queue.total_items,  # total number of items in all queues
                 'logs':   queue.log_size,     # current queue log size
+                'ratio':  float(queue.compressed_in or 1) / (queue.compressed_out or 1),
+                'ctime':  queue.compress_time, # processor time spent compressing
                 'expire': expire_count})      # current expiration statistics
         return response
 
@@ -237,7 +438,7 @@ class Handler(object):
 # -------------------------------------------------------- #
 class Messages(object):
     '''
-    The static protocol messages and regular expressions for the
+    The static protocol messages and command table for the
     starling protocol.
     '''
     # mamba general message constants
@@ -246,9 +447,12 @@ class Messages(object):
 
     # mamba common message constants
     data_pack_format      = "!II%ss"
+    data_header_format    = "!II" # the flags and expiry time of a message
+    data_trailer          = __trailer
    
     # mamba get message constants
-    get_response          = "VALUE %s %s %s\r\n%s\r\n" + __empty_message
+    get_response_value    = "VALUE %s %s %s\r\n%s\r\n"
+    get_response          = get_response_value + __empty_message
     get_response_empty    = __empty_message
    
     # mamba set message constants
@@ -280,6 +484,11 @@ STAT get_misses %d\r
 STAT bytes_read %d\r
 STAT bytes_written %d\r
 STAT limit_maxbytes %d\r
+STAT log_cache_hits %d\r
+STAT log_cache_misses %d\r
+STAT open_logs %d\r
+STAT retired_logs_removed %d\r
+STAT purges_in_progress %d\r
 %s\n""" + __empty_message
 
     # mamba queue statistics message constants
@@ -287,27 +496,74 @@ STAT limit_maxbytes %d\r
 STAT queue_%(name)s_items %(size)d\r
 STAT queue_%(name)s_total_items %(total)d\r
 STAT queue_%(name)s_logsize %(logs)d\r
+STAT queue_%(name)s_compression_ratio %(ratio)0.2f\r
+STAT queue_%(name)s_compression_time %(ctime)0.6f\r
 STAT queue_%(name)s_expired_items %(expire)d\r"""
 
-    # mamba command regex collection
+    # mamba command table, the name of each command -> the processor
+    # of the command and the number of numeric arguments after its key
+    # (None for a command that takes no arguments at all, and -1 for
+    # one that takes any number of keys)
     _commands = {
-        '_get':        re.compile(r'^get (.{1,250})$'),
-        '_set':        re.compile(r'^set (.{1,250}) ([0-9]+) ([0-9]+) ([0-9]+)$'),
-        '_delete':     re.compile(r'^delete (.{1,250}) ([0-9]+)$'),
-        '_statistics': re.compile(r'^stats$'),
-        '_quit':       re.compile(r'^quit$'),
-        '_shutdown':   re.compile(r'^shutdown$'),
+        'get':      ('_get', -1),         # get <key>*
+        'set':      ('_set', 3),          # set <key> <flags> <expire> <length>
+        'delete':   ('_delete', 1),       # delete <key> <time>
+        'stats':    ('_statistics', None),
+        'quit':     ('_quit', None),
+        'shutdown': ('_shutdown', None),
     }
+    _max_key_length = 250
+    _batch_option = "/n=" # get <key>/n=<count> takes up to count messages
+    _noreply_option = " noreply" # set ... noreply is stored without a response
+    _noreply_commands = frozenset(['set'])
+
+    @staticmethod
+    def parse_command(line):
+        '''
+        Helper method to look up a command line in the command table
+        and check its arguments. A key is everything between the command
+        name and the numeric arguments (so it may contain spaces) and
+        must be 1 to 250 characters long. Commands that take several
+        keys split them on spaces instead. A set may end with ``noreply``,
+        which adds True to the end of its arguments.
+
+        :param line: The command line to parse
+        :return: The (processor, arguments) of the command, or None if invalid
+        '''
+        if line[-1:] == "\n": line = line[:-1]
+        name, space, rest = line.partition(" ")
+        command = Messages._commands.get(name, None)
+        if command is None or "\n" in rest: return None
+        processor, numbers = command
+        noreply = (name in Messages._noreply_commands
+            and rest.endswith(Messages._noreply_option))
+        if noreply: rest = rest[:-len(Messages._noreply_option)]
+        if numbers is None:
+            return None if space else (processor, ())
+        if numbers < 0:
+            keys = [key for key in rest.split(" ") if key]
+            if not keys or max(map(len, keys)) > Messages._max_key_length:
+                return None
+            return (processor, keys)
+        arguments = rest.rsplit(" ", numbers) if numbers else [rest]
+        if (not space or len(arguments) != numbers + 1
+            or not 0 < len(arguments[0]) <= Messages._max_key_length):
+            return None
+        for argument in arguments[1:]:
+            if not argument or argument.strip("0123456789"): return None
+        return (processor, arguments + [True] if noreply else arguments)
 
     @staticmethod
-    def get_commands():
+    def parse_batch(key):
         '''
-        Helper method to return an iterator over the mamba commands
-        as well as the callbacks processors used to evaluate the
-        command results
+        Helper method to split the batch option off of a get key
 
-        :return: The iterator for the command types
+        :param key: The key to parse, ``name`` or ``name/n=count``
+        :return: The (queue name, most messages to take) of the key
         '''
-        for pair in Messages._commands.iteritems():
-            yield pair
+        name, option, count = key.rpartition(Messages._batch_option)
+        if (not name or not count or count.strip("0123456789")
+            or not int(count)):
+            return (key, 1)
+        return (name, int(count))
 
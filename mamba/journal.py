@@ -0,0 +1,611 @@
+'''
+Mamba Shared Journal
+------------------------------------------------------------
+
+With tens of thousands of queues, giving every queue its own log
+means thousands of open files and a disk that is asked to append a
+few bytes at a time to scattered places. The journal is an optional
+storage engine where every queue in the collection appends to one
+shared log instead, so all the writes become one sequential stream
+through a single file.
+
+The journal is split into numbered segments (``mamba.00000001.journal``)
+and every record is tagged with the id of its queue. The ids are local
+to a segment: the first time a queue is written to in a segment a
+record naming it is written first, so any segment can be replayed
+without the ones before it. Every push carries a per queue sequence
+number and every pop names the sequence number it removed, so once
+every item in a segment has been popped the segment can simply be
+deleted and the pops that referred to it are ignored on replay.
+
+A few items left unread in the oldest segment would otherwise keep every
+segment after it on disk, so once the items still queued in the oldest
+segment are only a small part of it they are pushed again (with the same
+sequence numbers) at the end of the journal and the segment is deleted.
+Replay puts such a relocated push back in its place in its queue.
+'''
+import os, re, time, mmap
+from struct import Struct
+from collections import deque
+from Queue import Empty
+from mamba.defaults import Defaults
+from mamba.errors import TransactionLogException
+
+#---------------------------------------------------------------------------#
+# Logging
+#---------------------------------------------------------------------------#
+import logging
+_logger = logging.getLogger("mamba.queue")
+
+#---------------------------------------------------------------------------#
+# Local helpers
+#---------------------------------------------------------------------------#
+_push_struct = Struct("!cIQI") # command, queue id, sequence, size
+_pop_struct  = Struct("!cIQ")  # command, queue id, sequence
+_name_struct = Struct("!cIH")  # command, queue id, name length
+_drop_struct = Struct("!cI")   # command, queue id
+_journal_pattern = re.compile(r"^mamba\.(\d{8})\.journal$")
+
+#---------------------------------------------------------------------------#
+# Class definitions
+#---------------------------------------------------------------------------#
+class Journal(object):
+    '''
+    A single transaction log shared by every queue in a collection,
+    along with the in-memory index of each queue rebuilt from it.
+
+    Each index entry is a (segment, sequence, size, value) tuple.
+    '''
+    __trx_push = "\x00"
+    __trx_pop  = "\x01"
+    __trx_name = "\x02"
+    __trx_drop = "\x03"
+
+    durability_modes = ("none", "flush", "fsync-per-op", "group-commit")
+    relocate_ratio = 0.25 # the part of the oldest segment still queued
+                          # at which its items are moved to the end
+
+    def __init__(self, path, durability=Defaults.Durability,
+        segment_size=Defaults.SegmentSize):
+        '''
+        Open the journal in the supplied directory, replaying any
+        segments already there.
+
+        :param path: The path to the persistence directory
+        :param durability: The durability mode of the journal
+        :param segment_size: The size at which a new segment is started
+        '''
+        if durability not in self.durability_modes:
+            raise TransactionLogException("Invalid durability mode %s" % durability)
+        self.path = path
+        self.durability = durability
+        self.segment_size = segment_size
+        self.indexes = {}   # queue name -> deque of entries
+        self.sequences = {} # queue name -> next sequence number
+        self.ids = {}       # queue name -> queue id
+        self.declared = set() # queue names named in the active segment
+        self.segments = {}  # segment number -> bytes in the segment
+        self.live = {}      # segment number -> items still queued in it
+        self.live_bytes = {} # segment number -> bytes of those items
+        self.retiring = False
+        self.pending = []   # records waiting on a group commit
+        self.waiters = []   # callbacks waiting on a group commit
+        self.log_size = 0
+        self.transactions = None
+        self._replay()
+
+    def queue(self, name):
+        '''
+        Return a queue backed by this journal
+
+        :param name: The name of the queue
+        :return: The journal queue
+        '''
+        return JournalQueue(self, name)
+
+    def names(self):
+        '''
+        Return the names of every queue with items in the journal
+
+        :return: The set of queue names
+        '''
+        return set(name for name, index in self.indexes.iteritems() if index)
+
+    def push(self, name, value):
+        '''
+        Append an item to the named queue
+
+        :param name: The name of the queue
+        :param value: The value to queue up
+        :return: void
+        '''
+        index = self.indexes.setdefault(name, deque())
+        sequence = self.sequences.get(name, 0)
+        self.sequences[name] = sequence + 1
+        record = _push_struct.pack(self.__trx_push, self._declare(name),
+            sequence, len(value)) + value
+        index.append((self.active, sequence, len(value), value))
+        self.live[self.active] += 1
+        self.live_bytes[self.active] += len(value)
+        self._transaction(record)
+
+    def push_many(self, name, values):
+        '''
+        Append several items to the named queue, with all of their
+        records appended to the journal in a single write.
+
+        :param name: The name of the queue
+        :param values: The values to queue up, in order
+        :return: void
+        '''
+        index = self.indexes.setdefault(name, deque())
+        queue_id, records = self._declare(name), []
+        for value in values:
+            sequence = self.sequences.get(name, 0)
+            self.sequences[name] = sequence + 1
+            records.append(_push_struct.pack(self.__trx_push, queue_id,
+                sequence, len(value)) + value)
+            index.append((self.active, sequence, len(value), value))
+            self.live[self.active] += 1
+            self.live_bytes[self.active] += len(value)
+        if records:
+            self._transaction("".join(records))
+
+    def pop(self, name):
+        '''
+        Remove the next item from the named queue
+
+        :param name: The name of the queue
+        :return: The next item in the queue
+        :raises Empty: If the queue is empty
+        '''
+        index = self.indexes.get(name, None)
+        if not index: raise Empty
+        segment, sequence, size, value = index.popleft()
+        self.live[segment] -= 1 # before the pop record can start a segment
+        self.live_bytes[segment] -= size
+        self._transaction(_pop_struct.pack(self.__trx_pop,
+            self._declare(name), sequence))
+        if segment == min(self.segments): self._retire_segments()
+        return value
+
+    def drop(self, name):
+        '''
+        Remove every item from the named queue
+
+        :param name: The name of the queue
+        :return: void
+        '''
+        for entry in self.indexes.pop(name, ()):
+            self.live[entry[0]] -= 1
+            self.live_bytes[entry[0]] -= entry[2]
+        self.sequences.pop(name, None)
+        self._transaction(_drop_struct.pack(self.__trx_drop, self._declare(name)))
+        self._retire_segments()
+
+    def commit(self):
+        '''
+        Write every record held for a group commit to the journal as
+        one write, make it durable, and notify everyone waiting on it.
+
+        :return: void
+        '''
+        if self.pending:
+            self._log_exists_or_throw()
+            self.transactions.write("".join(self.pending))
+            self.transactions.flush()
+            os.fsync(self.transactions.fileno())
+            self.pending = []
+        waiters, self.waiters = self.waiters, []
+        for waiter in waiters: waiter()
+
+    def when_durable(self, callback):
+        '''
+        Call ``callback`` once every record written so far is durable
+
+        :param callback: The method to call once the journal is durable
+        :return: void
+        '''
+        if self.pending:
+            self.waiters.append(callback)
+        else: callback()
+
+    def close(self):
+        '''
+        Finish all writes to the journal and close it
+
+        :return: void
+        '''
+        _logger.debug("Closing the journal in %s" % self.path)
+        self.commit()
+        temp, self.transactions = self.transactions, None
+        if temp: temp.close()
+
+    # --------------------------------------------------------------- #
+    # Private Methods
+    # --------------------------------------------------------------- #
+    def _segment_path(self, segment):
+        '''
+        Helper to build the path of a journal segment
+
+        :param segment: The number of the segment
+        :return: The path to the segment file
+        '''
+        return os.path.join(self.path, "mamba.%08d.journal" % segment)
+
+    def _declare(self, name):
+        '''
+        Helper to find the id of a queue, naming the queue in the
+        active segment if it has not been yet.
+
+        :param name: The name of the queue
+        :return: The id of the queue
+        '''
+        queue_id = self.ids.get(name, None)
+        if queue_id is None:
+            queue_id = self.ids[name] = len(self.ids)
+        if name not in self.declared:
+            self.declared.add(name)
+            self._transaction(_name_struct.pack(self.__trx_name,
+                queue_id, len(name)) + name, False)
+        return queue_id
+
+    def _open_log(self, segment):
+        '''
+        Helper method to start appending to a new journal segment
+
+        :param segment: The number of the segment to open
+        :return: void
+        '''
+        self.transactions = open(self._segment_path(segment), "ab")
+        self.active, self.next_segment = segment, segment + 1
+        self.segments[segment], self.live[segment] = 0, 0
+        self.live_bytes[segment] = 0
+        self.declared.clear()
+
+    def _roll_segment(self):
+        '''
+        Helper method to close the active journal segment and start
+        appending to a new one.
+
+        :return: void
+        '''
+        _logger.debug("Starting a new journal segment in %s" % self.path)
+        self.commit()
+        self.transactions.close()
+        self._open_log(self.next_segment)
+        self._retire_segments()
+
+    def _retire_segments(self):
+        '''
+        Helper method to delete the oldest journal segments once every
+        item queued in them has been popped, or has been relocated to
+        the end of the journal.
+
+        :return: void
+        '''
+        if self.retiring: return # relocating can start new segments
+        self.retiring = True
+        try:
+            for segment in sorted(self.segments):
+                if segment == self.active: break
+                if self.live[segment]:
+                    if (self.live_bytes[segment] >
+                        self.segments[segment] * self.relocate_ratio): break
+                    self._relocate(segment)
+                _logger.debug("Removing consumed journal segment %d" % segment)
+                os.remove(self._segment_path(segment))
+                self.log_size -= self.segments.pop(segment)
+                del self.live[segment], self.live_bytes[segment]
+        finally: self.retiring = False
+
+    def _relocate(self, segment):
+        '''
+        Helper method to push the items still queued in a segment again
+        at the end of the journal, so that the segment can be deleted.
+        The new records are made durable before this returns.
+
+        :param segment: The number of the segment to empty
+        :return: void
+        '''
+        _logger.debug("Relocating %d items of journal segment %d" %
+            (self.live[segment], segment))
+        for name, index in self.indexes.iteritems():
+            positions = [position for position, entry in enumerate(index)
+                if entry[0] == segment]
+            for position in positions:
+                _, sequence, size, value = index[position]
+                record = _push_struct.pack(self.__trx_push,
+                    self._declare(name), sequence, size) + value
+                index[position] = (self.active, sequence, size, value)
+                self.live[self.active] += 1
+                self.live_bytes[self.active] += size
+                self._transaction(record)
+        self.live[segment] = self.live_bytes[segment] = 0
+        self.commit()
+        self.transactions.flush()
+        os.fsync(self.transactions.fileno())
+
+    def _log_exists_or_throw(self):
+        '''
+        Helper to make the log checking look cleaner
+
+        :return: void
+        '''
+        if not self.transactions:
+            _logger.error("Journal not available in %s" % self.path)
+            raise TransactionLogException("Journal not available")
+
+    def _replay(self):
+        '''
+        Helper to rebuild the index of every queue from the journal.
+        Appending always starts in a new segment afterwards.
+
+        :return: void
+        '''
+        start, segments = time.time(), []
+        for entry in os.listdir(self.path):
+            match = _journal_pattern.match(entry)
+            if match: segments.append(int(match.group(1)))
+
+        _logger.debug("Reading back the journal in %s" % self.path)
+        for segment in sorted(segments):
+            self.segments[segment], self.live[segment] = 0, 0
+            self.live_bytes[segment] = 0
+            path = self._segment_path(segment)
+            if os.path.getsize(path):
+                with open(path, "rb") as log:
+                    buffer = mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ)
+                    try: self._replay_buffer(buffer, segment)
+                    finally: buffer.close()
+            self.segments[segment] = os.path.getsize(path)
+            self.log_size += self.segments[segment]
+
+        self._open_log(max(segments) + 1 if segments else 1)
+        self._retire_segments()
+        _logger.debug("Finished reading back the journal in %s (%d bytes "
+            "in %0.3fs)" % (self.path, self.log_size, time.time() - start))
+
+    def _replay_buffer(self, buffer, segment):
+        '''
+        Helper method to apply every record in a journal segment
+
+        :param buffer: The buffer (or mapping) holding the segment
+        :param segment: The number of the segment being replayed
+        :return: void
+        '''
+        position, length, names = 0, len(buffer), {}
+        while position < length:
+            command = buffer[position]
+            if command == self.__trx_push:
+                end = position + _push_struct.size
+                if end > length: break
+                _, queue_id, sequence, size = _push_struct.unpack_from(buffer, position)
+                if end + size > length: break
+                name = names[queue_id]
+                index = self.indexes.setdefault(name, deque())
+                entry = (segment, sequence, size, buffer[end:end + size])
+                if index and sequence <= index[-1][1]:
+                    self._replay_relocated(index, entry)
+                else:
+                    index.append(entry)
+                    self.sequences[name] = sequence + 1
+                self.live[segment] += 1
+                self.live_bytes[segment] += size
+                position = end + size
+            elif command == self.__trx_pop:
+                if position + _pop_struct.size > length: break
+                _, queue_id, sequence = _pop_struct.unpack_from(buffer, position)
+                index = self.indexes.get(names[queue_id], None)
+                if index and index[0][1] == sequence: # else it was retired
+                    entry = index.popleft()
+                    self.live[entry[0]] -= 1
+                    self.live_bytes[entry[0]] -= entry[2]
+                position += _pop_struct.size
+            elif command == self.__trx_name:
+                end = position + _name_struct.size
+                if end > length: break
+                _, queue_id, size = _name_struct.unpack_from(buffer, position)
+                if end + size > length: break
+                names[queue_id] = name = buffer[end:end + size]
+                self.ids.setdefault(name, len(self.ids))
+                position = end + size
+            elif command == self.__trx_drop:
+                if position + _drop_struct.size > length: break
+                _, queue_id = _drop_struct.unpack_from(buffer, position)
+                name = names[queue_id]
+                for entry in self.indexes.pop(name, ()):
+                    self.live[entry[0]] -= 1
+                    self.live_bytes[entry[0]] -= entry[2]
+                self.sequences.pop(name, None)
+                position += _drop_struct.size
+            else:
+                _logger.warning("Invalid command(%r) in journal" % command)
+                position += 1
+
+        if position < length:
+            _logger.warning("Ignoring %d bytes of incomplete transaction at "
+                "the end of journal segment %d" % (length - position, segment))
+
+    def _replay_relocated(self, index, entry):
+        '''
+        Helper method to put a relocated push back in its place in the
+        index of its queue. If the segment it was relocated from is still
+        there (the journal stopped before deleting it), the relocated copy
+        replaces the original.
+
+        :param index: The index of the queue
+        :param entry: The entry of the relocated push
+        :return: void
+        '''
+        position = 0
+        while index[position][1] < entry[1]: position += 1
+        if index[position][1] == entry[1]:
+            previous, index[position] = index[position], entry
+            self.live[previous[0]] -= 1
+            self.live_bytes[previous[0]] -= previous[2]
+        else:
+            index.rotate(-position)
+            index.appendleft(entry)
+            index.rotate(position)
+
+    def _transaction(self, data, roll=True):
+        '''
+        Helper method to append a record to the journal
+
+        :param data: The record to append
+        :param roll: Set to False to never start a new segment after it
+        :return: void
+        '''
+        self._log_exists_or_throw()
+        if self.durability == "group-commit":
+            self.pending.append(data)
+        else:
+            self.transactions.write(data)
+            if self.durability != "none":
+                self.transactions.flush()
+            if self.durability == "fsync-per-op":
+                os.fsync(self.transactions.fileno())
+        self.log_size += len(data)
+        self.segments[self.active] += len(data)
+        if roll and self.segments[self.active] >= self.segment_size:
+            self._roll_segment()
+
+class JournalQueue(object):
+    '''
+    A view of a single queue in a shared :class:`Journal`, with the
+    parts of the :class:`PersistentQueue` interface the collection uses.
+    '''
+    unlogged_pops = 0 # pops are always logged straight away
+    compressed_in = compressed_out = 0 # payloads are stored as they are
+    compress_time = 0.0
+
+    def __init__(self, journal, name):
+        '''
+        Create a new view of the named queue
+
+        :param journal: The journal the queue is stored in
+        :param name: The name of the queue
+        '''
+        self.journal = journal
+        self.name = name
+        self.total_items = 0
+        self.initial_bytes = sum(entry[2] for entry in self.index)
+
+    @property
+    def index(self):
+        ''' The entries currently in the queue '''
+        return self.journal.indexes.get(self.name, ())
+
+    @property
+    def pending(self):
+        ''' The records of the journal waiting on a group commit '''
+        return self.journal.pending
+
+    @property
+    def log_size(self):
+        ''' The bytes of journal needed to rebuild this queue '''
+        return sum(_push_struct.size + entry[2] for entry in self.index)
+
+    @property
+    def queued_bytes(self):
+        ''' The payload bytes of the items in the queue '''
+        return sum(entry[2] for entry in self.index)
+
+    def put(self, value, log=True, spill=False):
+        '''
+        Pushes ``value`` to the queue
+
+        :param value: The value to queue up
+        :param log: Ignored, journal queues always log
+        :param spill: Ignored, journal queues keep their payloads in memory
+        :return: void
+        '''
+        self.journal.push(self.name, value)
+        self.total_items += 1
+
+    def put_many(self, values, spill=False):
+        '''
+        Pushes every one of ``values`` to the queue in one journal write
+
+        :param values: The values to queue up, in order
+        :param spill: Ignored, journal queues keep their payloads in memory
+        :return: void
+        '''
+        self.journal.push_many(self.name, values)
+        self.total_items += len(values)
+
+    def get(self, log=True):
+        '''
+        Retrieve the next element off the queue
+
+        :param log: Ignored, journal queues always log
+        :return: The next item off of the queue
+        :raises Empty: If the queue is empty
+        '''
+        return self.journal.pop(self.name)
+
+    def qsize(self):
+        '''
+        Returns the number of items in the queue
+
+        :return: The number of items in the queue
+        '''
+        return len(self.index)
+
+    def empty(self):
+        '''
+        Check if the queue is empty
+
+        :return: True if the queue is empty, False otherwise
+        '''
+        return not self.index
+
+    def commit(self):
+        '''
+        Write out the pending group commit batch of the journal
+
+        :return: void
+        '''
+        self.journal.commit()
+
+    def when_durable(self, callback, errback=None):
+        '''
+        Call ``callback`` once every record in the journal is durable
+
+        :param callback: The method to call once the journal is durable
+        :param errback: Ignored, a failed group commit raises instead
+        :return: void
+        '''
+        self.journal.when_durable(callback)
+
+    def needs_compaction(self, ratio, min_size):
+        '''
+        The journal reclaims whole segments as they are consumed, so
+        there is never a queue log to compact.
+
+        :return: False
+        '''
+        return False
+
+    def close(self):
+        '''
+        The journal is shared, so closing a single queue does nothing
+
+        :return: void
+        '''
+        pass
+
+    def purge(self):
+        '''
+        Remove every item in this queue from the journal
+
+        :return: void
+        '''
+        _logger.debug("Purging the journal of queue %s" % self.name)
+        self.journal.drop(self.name)
+
+#---------------------------------------------------------------------------#
+# Exported Identifiers
+#---------------------------------------------------------------------------#
+__all__ = [ "Journal", "JournalQueue" ]
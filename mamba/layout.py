@@ -0,0 +1,110 @@
+'''
+Mamba Spool Layout
+------------------------------------------------------------
+
+The queue logs can be spread over several data directories (each on
+its own disk, say) to add up the write bandwidth of the disks. Every
+queue is placed on one of them by a consistent hash of its name, so
+adding or removing a directory only moves the queues that hashed to
+that directory. Inside each directory the logs can also be fanned out
+over a fixed number of hashed subdirectories, so that no single
+directory ends up holding an unbounded number of files.
+'''
+import os
+from bisect import bisect
+from hashlib import md5
+from struct import Struct
+from mamba.defaults import Defaults
+from mamba.errors import QueueCollectionException
+
+#---------------------------------------------------------------------------#
+# Local helpers
+#---------------------------------------------------------------------------#
+_digest_struct = Struct("!QQ")
+
+def _digest(value):
+    '''
+    Helper to hash a string to a pair of independent integers
+
+    :param value: The string to hash
+    :return: A (ring point, bucket) tuple of 64 bit integers
+    '''
+    return _digest_struct.unpack(md5(value).digest())
+
+#---------------------------------------------------------------------------#
+# Class definitions
+#---------------------------------------------------------------------------#
+class SpoolLayout(object):
+    '''
+    Places queue logs across one or more data directories
+    '''
+
+    def __init__(self, paths, fanout=Defaults.Fanout, replicas=64):
+        '''
+        Initialize a new layout over the given data directories
+
+        :param paths: A list of data directories, or a string of them
+            separated by ``os.pathsep``
+        :param fanout: The hashed subdirectories in each, 0 for none
+        :param replicas: The points each directory gets on the hash ring
+        '''
+        if isinstance(paths, basestring):
+            paths = paths.split(os.pathsep)
+        self.paths = [path for path in paths if path]
+        if not self.paths:
+            raise QueueCollectionException("No queue path was supplied")
+        self.fanout = fanout
+        self.width = len("%x" % max(fanout - 1, 0))
+        self.ring = sorted((_digest("%s#%d" % (path, replica))[0], path)
+            for path in self.paths for replica in range(replicas))
+        self.points = [point for point, path in self.ring]
+
+    def shard(self, name):
+        '''
+        Find the data directory a queue is placed on
+
+        :param name: The name of the queue
+        :return: The data directory of the queue
+        '''
+        index = bisect(self.points, _digest(name)[0]) % len(self.ring)
+        return self.ring[index][1]
+
+    def directory(self, name):
+        '''
+        Find the directory the logs of a queue are kept in
+
+        :param name: The name of the queue
+        :return: The directory to keep the queue logs in
+        '''
+        path = self.shard(name)
+        if not self.fanout: return path
+        return os.path.join(path, self._bucket(_digest(name)[1] % self.fanout))
+
+    def directories(self, path=None):
+        '''
+        List every directory that can hold queue logs
+
+        :param path: The data directory to list, or None for all of them
+        :return: The list of directories
+        '''
+        paths = [path] if path else self.paths
+        if not self.fanout: return paths
+        return [os.path.join(path, self._bucket(bucket))
+            for path in paths for bucket in range(self.fanout)]
+
+    # ---------------------------------------------------- #
+    # Private Methods
+    # ---------------------------------------------------- #
+    def _bucket(self, bucket):
+        '''
+        Helper to name a fan-out subdirectory
+
+        :param bucket: The number of the subdirectory
+        :return: The name of the subdirectory
+        '''
+        return "%0*x" % (self.width, bucket)
+
+#---------------------------------------------------------------------------#
+# Exported Identifiers
+#---------------------------------------------------------------------------#
+__all__ = [ "SpoolLayout" ]
@@ -1,8 +1,12 @@
 '''
 '''
-import os, time
-from struct import pack, unpack
-from Queue import Queue
+import os, re, time, mmap, threading, ctypes, ctypes.util
+from struct import Struct, error as StructError
+from zlib import crc32, compress, decompress, error as ZlibError
+from collections import deque
+from itertools import chain, islice, izip
+from Queue import Empty
+from mamba.defaults import Defaults
 from mamba.errors import TransactionLogException
 
 #---------------------------------------------------------------------------#
@@ -14,60 +18,230 @@ _logger = logging.getLogger("mamba.queue")
 #---------------------------------------------------------------------------#
 # Local helpers
 #---------------------------------------------------------------------------#
-def file_iterator(fd):
-    ''' Simply helper to make code cleaner '''
-    while True:
-        value = fd.read(1)
-        if not value: break
-        yield value
+_size_struct = Struct("I") # the record size header (native, like the old logs)
+_record_struct = Struct("!cI") # the record header of versioned logs
+_record_size_struct = Struct("!I")
+_crc_struct = Struct("!I") # the record checksum of framed logs
+_push_overhead = 1 + _size_struct.size # the same for every log version
+_compressed_flag = 0x80 # set in the command of a compressed record
+_header_struct = Struct("!4sB3x") # log magic and format version
+_log_magic, _log_version = "MQLG", 2
+_log_header = _header_struct.pack(_log_magic, _log_version)
+_checkpoint_struct = Struct("!IQIQ") # head segment/offset, tail segment/offset
+_segment_pattern = re.compile(r"^\.(\d{8})\.(log|compact|tmp)$")
+_file_pattern = re.compile(r"^(.+?)\.(\d{8})\.(log|compact|tmp)$")
+_rotated_pattern = re.compile(r"\.\d{9,10}\.\d{1,2}$") # name.<time.time()>
+_ignore_pattern = re.compile(r"(\.tmp|\.journal|\.retired)$") # temporary, retired, or shared
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _fallocate = getattr(_libc, "posix_fallocate64", _libc.posix_fallocate)
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+except (OSError, AttributeError, TypeError):
+    _fallocate = None
+
+def _allocate(fileno, offset, size):
+    ''' Helper to reserve disk space for a file, growing it if needed '''
+    if _fallocate is None or _fallocate(fileno, offset, size) != 0:
+        os.ftruncate(fileno, max(os.fstat(fileno).st_size, offset + size))
+
+def _frame(command, body=""):
+    ''' Helper to frame a record with its length and checksum '''
+    head = _record_struct.pack(command, len(body))
+    return head + body + _crc_struct.pack(crc32(body, crc32(head)) & 0xffffffff)
+
+def _synchronized(method):
+    ''' Helper to wrap a queue method with the queue mutex '''
+    def wrapper(self, *args, **kwargs):
+        with self.mutex:
+            return method(self, *args, **kwargs)
+    wrapper.__name__, wrapper.__doc__ = method.__name__, method.__doc__
+    return wrapper
 
 #---------------------------------------------------------------------------#
 # Class definitions
 #---------------------------------------------------------------------------#
-class PersistentQueue(Queue):
+class PersistentQueue(object):
     '''
-    PersistentQueue is a subclass of Python synchronized class. It adds a 
-    transactional log to the in-memory Queue, which enables quickly rebuilding
-    the Queue in the event of a sever outage.
-    '''
-    __max_size = 16 * (1024**2) # 16 MB
+    PersistentQueue is an in-memory queue with a transactional log, which
+    enables quickly rebuilding the Queue in the event of a sever outage.
+    The queue does no locking of its own, as the server drives every
+    queue from the reactor thread; use :class:`SynchronizedQueue` for a
+    queue that is shared between threads.
+
+    The log is split into numbered segments (``name.00000001.log``) and
+    a small checkpoint (``name.checkpoint``) that records where the
+    oldest live item starts. Segments that have been fully consumed are
+    deleted and replay starts from the checkpoint, so recovery only has
+    to read the live part of the log. A log from before segments existed
+    (``name``) is read as segment zero.
 
-    __trx_cmd_push = "\x00"
+    New segments start with a header naming their format version, and
+    every record in them is framed with its length and a CRC32, so a
+    torn or corrupt tail is found (and cut off) at the first bad record
+    instead of being read as more commands. A zero byte where a record
+    should start marks the end of the data.
+    That lets the active segment be preallocated in chunks (so appends
+    do not have to grow the file) and still be replayed after a crash;
+    the unused space is trimmed off when the segment is closed. Logs
+    without a header are still read, but never appended to.
+
+    Each queued entry is a (segment, offset, size, value, length) tuple,
+    the length being that of its record in the log. When
+    payloads are kept on ``disk`` the value is left out of the entry and
+    read back from the log when the item is popped, so memory use grows
+    with the number of items rather than with their size. Queues that
+    ``spill`` keep payloads in memory until they go over their memory
+    budget (or are told the server is), after which only a window of the
+    newest items stays in memory and the rest are left in the log. As
+    consumers reach the spilled items the head is refilled from the log
+    a window at a time with large sequential reads.
+    '''
+    __trx_cmd_push = "\x02"
+    __trx_cmd_zpush = chr(ord(__trx_cmd_push) | _compressed_flag)
     __trx_cmd_pop  = "\x01"
-    __trx_push     = "\x00%s%s"
-    __trx_pop      = "\x01"
+    __trx_cmd_pops = "\x03" # followed by the number of items popped
+    __trx_cmd_end  = "\x00" # unwritten (preallocated) space
+    __trx_pop      = _frame(__trx_cmd_pop)
+    __trx_legacy_push = "\x00"
 
-    def __init__(self, persistence_path, queue_name):
+    durability_modes = ("none", "flush", "fsync-per-op", "group-commit")
+    payload_modes = ("memory", "disk", "spill")
+
+    def __init__(self, persistence_path, queue_name,
+        durability=Defaults.Durability, segment_size=Defaults.SegmentSize,
+        payloads=Defaults.Payloads, memory_budget=Defaults.MemoryBudget,
+        spill_window=Defaults.SpillWindow, background_writes=False,
+        preallocate=Defaults.Preallocate, coalesce_pops=False,
+        compress_threshold=Defaults.CompressThreshold,
+        compress_level=Defaults.CompressLevel, retain_segments=False,
+        segments=None):
         '''
         Create a new PersistentQueue at +persistence_path+/+queue_name+.
         If a queue log exists at that path, the Queue will be loaded from
         disk before being available for use.
 
+        The durability mode controls what happens after each record is
+        appended to the log:
+
+            ``none``          Leave the record in the file buffer
+            ``flush``         Flush the record to the operating system
+            ``fsync-per-op``  Flush and fsync every record
+            ``group-commit``  Hold records until :meth:`commit` writes
+                              and fsyncs them as a single batch
+
+        With ``background_writes`` every record is held like a group
+        commit until a writer thread takes it as part of a batch (see
+        :meth:`take_batch`), and is then flushed or fsynced according
+        to the durability mode.
+
+        With ``coalesce_pops`` the pops are counted instead of being
+        logged one at a time, and the count is logged as a single record
+        the next time the queue is committed (or has to checkpoint).
+
+        With ``retain_segments`` consumed segments are renamed to
+        ``name.00000001.retired`` instead of being deleted, and are left
+        for a :class:`mamba.retention.RetentionPolicy` to remove.
+
         :param persistence_path: The path to the persistence directory
         :param queue_name: The name of the queue
+        :param durability: The durability mode of the transaction log
+        :param segment_size: The size at which a new log segment is started
+        :param payloads: Where payloads are kept, ``memory``, ``disk``, or ``spill``
+        :param memory_budget: The payload bytes a spilling queue keeps in memory
+        :param spill_window: The bytes kept in memory at each end once spilling
+        :param background_writes: Set to True to leave log writes to a writer thread
+        :param preallocate: The chunk to reserve log segment space in, 0 for none
+        :param coalesce_pops: Set to True to log pops in batches on ``commit``
+        :param compress_threshold: The smallest payload to compress, 0 for none
+        :param compress_level: The zlib level to compress payloads with
+        :param retain_segments: Set to True to keep consumed segments as retired
+        :param segments: The (segment, kind) pairs of the queue already found
+            by :meth:`find_segments`, or None to look for them
         '''
+        if durability not in self.durability_modes:
+            raise TransactionLogException("Invalid durability mode %s" % durability)
+        if payloads not in self.payload_modes:
+            raise TransactionLogException("Invalid payload mode %s" % payloads)
         self.path = persistence_path
         self.name = queue_name
         self.log_path = os.path.join(self.path, self.name)
+        self.checkpoint_path = self.log_path + ".checkpoint"
+        self.durability = durability
+        self.segment_size = segment_size
+        self.payloads = payloads
+        self.in_memory = (payloads == "memory")
+        self.memory_budget = memory_budget
+        self.spill_window = spill_window
+        self.preallocate = preallocate
+        self.coalesce_pops = coalesce_pops
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.retain_segments = retain_segments
+        self.compressed_in = 0  # payload bytes offered for compression
+        self.compressed_out = 0 # log bytes they were stored in
+        self.compress_time = 0.0 # processor seconds spent in zlib
+        self.unlogged_pops = 0 # pops waiting to be logged as one record
+        self.allocated = 0 # bytes reserved in the active segment
+        self.resident_size = 0 # payload bytes held in memory
+        self.tail_items = 0    # entries in the spilled tail window
+        self.tail_size = 0
+        self.segments = {} # segment number -> bytes in the segment
+        self.compacted = set()
+        self.versions = {} # segment number -> log format version
+        self.readers = {}  # segment number -> file to read payloads from
+        self.pending = []  # records waiting on a group commit
+        self.waiters = []  # (callback, errback) pairs waiting on a group commit
+        self.background_writes = background_writes
+        self.unfinished = [] # batches handed to a writer, oldest first
+        self.in_flight = 0   # batches a writer has not written yet
+        self.write_condition = threading.Condition()
+        self.transactions = None
+        self.failed = False    # a write to the log failed, so it is unavailable
+        self.suspended = False # log closed until the queue is used again
         self.total_items = 0
-        Queue.__init__(self, 0)
-        self.initial_bytes = self._replay_transactions()
+        self.popped = 0
+        self.live_size = 0 # log bytes needed to rebuild the queue
+        self.compacting = False
+        self.queue = deque()
+        self.initial_bytes = self._replay_transactions(segments)
 
-    def put(self, value, log=True):
+    def put(self, value, log=True, spill=False):
         '''
         Pushes ``value`` to the queue. By default, ``put`` will write to the
         transactional log. Set ``log`` to ``False`` to override this behaviour.
 
         :param value: The value to queue up
         :param log: Set to True to log to the transaction log, False otherwise
+        :param spill: Set to True to spill to the log regardless of budget
         :return: void
         '''
+        self._log_exists_or_throw(log)
+        record = self._encode(value) if log else ""
+        self._put_entry((self.active, self.segments[self.active], len(value),
+            value, len(record)), spill)
         if log:
-            self._log_exists_or_throw(log)
-            size = pack("I", len(value))
-            self._transaction(self.__trx_push % (size, value))
-        self.total_items += 1
-        Queue.put(self, value)
+            self._transaction(record)
+
+    def put_many(self, values, spill=False):
+        '''
+        Pushes every one of ``values`` to the queue, appending all of
+        their records to the transaction log in a single write.
+
+        :param values: The values to queue up, in order
+        :param spill: Set to True to spill to the log regardless of budget
+        :return: void
+        '''
+        self._log_exists_or_throw()
+        offset, records = self.segments[self.active], []
+        for value in values:
+            record = self._encode(value)
+            self._put_entry((self.active, offset, len(value), value,
+                len(record)), spill)
+            records.append(record)
+            offset += len(record)
+        if records:
+            self._transaction("".join(records))
 
     def get(self, log = True):
         '''
@@ -75,109 +249,942 @@ class PersistentQueue(Queue):
 
         :param log: Set to True to log to the transaction log, False otherwise
         :return: The next item off of the queue
+        :raises Empty: If the queue is empty
         '''
         self._log_exists_or_throw(log)
-        value = Queue.get(self, log)
-        if log: self._transaction(self.__trx_pop)
+        if not self.queue: raise Empty
+        if self.payloads == "spill" and self.queue[0][3] is None:
+            self._refill_head()
+        segment, offset, size, value, _ = self._pop_entry()
+        if value is None:
+            value = self._decode(self._read_log(segment, offset,
+                _push_overhead + size), 0, size)
+        if log and self.coalesce_pops: self.unlogged_pops += 1
+        elif log: self._transaction(self.__trx_pop)
+        self._retire_segments()
         return value
 
+    @staticmethod
+    def find_queues(persistence_path):
+        '''
+        Find the names of every queue with a transaction log in the
+        supplied persistence directory.
+
+        :param persistence_path: The path to the persistence directory
+        :return: The set of queue names found
+        '''
+        return set(PersistentQueue.find_segments(persistence_path))
+
+    @staticmethod
+    def find_segments(persistence_path):
+        '''
+        Find the log segments of every queue with a transaction log in
+        the supplied persistence directory, with a single listing of it.
+        The result can be handed to each queue as it is opened, so that
+        opening a queue does not have to list the directory again.
+
+        :param persistence_path: The path to the persistence directory
+        :return: A dict of queue name -> sorted list of (segment, kind)
+        '''
+        segments, names, rotated = {}, set(), []
+        for entry in os.listdir(persistence_path):
+            match = _file_pattern.match(entry)
+            if match:
+                name, kind = match.group(1), match.group(3)
+                segments.setdefault(name, []).append((int(match.group(2)), kind))
+                if kind != "tmp": names.add(name)
+            elif entry.endswith(".checkpoint"):
+                names.add(entry[:-len(".checkpoint")])
+            elif _rotated_pattern.search(entry):
+                rotated.append(entry) # unless a live queue has this name
+            elif not _ignore_pattern.search(entry): # pre-segment log
+                segments.setdefault(entry, []).append((0, "log"))
+                names.add(entry)
+        for entry in rotated:
+            if entry in names: segments.setdefault(entry, []).append((0, "log"))
+        return dict((name, sorted(segments.get(name, ()))) for name in names)
+
+    def qsize(self):
+        '''
+        Returns the number of items in the queue
+
+        :return: The number of items in the queue
+        '''
+        return len(self.queue)
+
+    @property
+    def queued_bytes(self):
+        ''' The payload bytes of the items in the queue '''
+        return sum(entry[2] for entry in self.queue)
+
+    def empty(self):
+        '''
+        Check if the queue is empty
+
+        :return: True if the queue is empty, False otherwise
+        '''
+        return not self.queue
+
+    def commit(self):
+        '''
+        Write every record held for a group commit to the transaction
+        log as one write, make it durable, and then notify everyone
+        waiting on the batch. Any coalesced pops are logged first.
+
+        :return: void
+        '''
+        self._log_pops()
+        self._drain_writes()
+        if self.pending:
+            self._log_exists_or_throw()
+            self._write_records(self.transactions, "".join(self.pending))
+            self.pending = []
+        waiters, self.waiters = self.waiters, []
+        for callback, _ in waiters: callback()
+
+    def take_batch(self):
+        '''
+        Take every record held for a background writer as one batch.
+        This must be called from the thread that owns the queue, and
+        each batch must be written and finished in the order taken.
+
+        :return: The batch to pass to ``write_batch``, or None if there is none
+        '''
+        self._log_pops()
+        if not self.pending: return None
+        self._log_exists_or_throw()
+        batch = { 'data': "".join(self.pending), 'waiters': self.waiters,
+            'log': self.transactions, 'failed': False }
+        self.pending, self.waiters = [], []
+        with self.write_condition: self.in_flight += 1
+        self.unfinished.append(batch)
+        return batch
+
+    def write_batch(self, batch):
+        '''
+        Append a batch of records to the transaction log. This is safe
+        to run in a background thread, as anything that could swap the
+        log out from under it waits for the batch first. A batch that
+        cannot be written is marked as failed for ``finish_batch``.
+
+        :param batch: The batch returned from ``take_batch``
+        :return: The written batch
+        '''
+        try:
+            self._write_records(batch['log'], batch['data'])
+        except (IOError, OSError, ValueError), ex:
+            _logger.error("Failed to write the transaction log for queue %s: %s"
+                % (self.name, ex))
+            batch['failed'] = True
+        finally:
+            with self.write_condition:
+                self.in_flight -= 1
+                self.write_condition.notify_all()
+        return batch
+
+    def finish_batch(self, batch):
+        '''
+        Notify everyone waiting on a batch that has been written. This
+        must be called from the thread that owns the queue.
+
+        Once a batch fails the log is marked unavailable, as the records
+        after a failed write could not be replayed. Everyone waiting on
+        that batch, or on any record logged after it, is failed instead.
+
+        :param batch: The batch returned from ``write_batch``
+        :return: void
+        '''
+        self.unfinished.remove(batch)
+        if batch['failed'] and not self.failed:
+            _logger.error("Transaction log of queue %s is no longer available"
+                % self.name)
+            self.failed, self.transactions = True, None
+            self.pending, self.unlogged_pops = [], 0
+            waiters, self.waiters = self.waiters, []
+            batch['waiters'].extend(waiters)
+        for callback, errback in batch['waiters']:
+            if not self.failed: callback()
+            elif errback: errback()
+
+    def when_durable(self, callback, errback=None):
+        '''
+        Call ``callback`` once every record logged so far has been made
+        as durable as the queue's durability mode promises, or
+        ``errback`` if a writer failed to write them.
+
+        :param callback: The method to call once the log is durable
+        :param errback: The method to call if the log could not be written
+        :return: void
+        '''
+        if self.failed:
+            if errback: errback()
+        elif self.pending:
+            self.waiters.append((callback, errback))
+        elif self.unfinished: # still with a writer
+            self.unfinished[-1]['waiters'].append((callback, errback))
+        else: callback()
+
+    def needs_compaction(self, ratio, min_size):
+        '''
+        Check if enough of the transaction log is dead (popped items
+        and pop records) to be worth compacting.
+
+        :param ratio: The ratio of dead to live bytes to compact at
+        :param min_size: The smallest log worth compacting
+        :return: True if the log should be compacted, False otherwise
+        '''
+        dead_size = self.log_size - self.live_size
+        return (not self.compacting and self.transactions is not None
+            and self.log_size >= min_size and dead_size > ratio * self.live_size)
+
+    def begin_compaction(self):
+        '''
+        Start compacting the transaction log by taking a snapshot of
+        the live items. This is cheap and must be called from the
+        thread that owns the queue.
+
+        Everything logged after the snapshot goes to a new segment and
+        the segment number before it is reserved for the compacted log.
+
+        :return: The compaction state to pass to the other phases
+        '''
+        _logger.debug("Compacting the transaction log for queue %s" % self.name)
+        self.compacting = True
+        segment = self.next_segment
+        self.next_segment += 1
+        self._roll_segment()
+        items = list(self.queue)
+        numbers = set(entry[0] for entry in items)
+        readers = dict((number, open(self._segment_file(number), "rb"))
+            for number in numbers)
+        framed = set(number for number in numbers if self.versions.get(number, 0) > 1)
+        return { 'items': items, 'readers': readers, 'framed': framed,
+            'popped': self.popped, 'segment': segment,
+            'path': self._segment_path(segment, "tmp") }
+
+    def write_compaction(self, state):
+        '''
+        Write the snapshot of live items to a fresh log segment. This
+        does the heavy lifting and is safe to run in a background thread.
+        The records are copied over as they are, so nothing is compressed
+        again; only records of logs without framing (or items that were
+        never logged) are framed afresh.
+
+        :param state: The state returned from ``begin_compaction``
+        :return: The updated compaction state
+        '''
+        entries, offset, segment = [], _header_struct.size, state['segment']
+        try:
+            with open(state['path'], "wb") as compacted:
+                compacted.write(_log_header)
+                for number, position, size, value, length in state['items']:
+                    if length:
+                        reader = state['readers'][number]
+                        reader.seek(position)
+                        record = reader.read(length)
+                    else: record = _frame(self.__trx_cmd_push, value)
+                    if length and number not in state['framed']:
+                        record = _frame(self.__trx_cmd_push, record[_push_overhead:])
+                    compacted.write(record)
+                    entries.append((segment, offset, size,
+                        value if self.in_memory else None, len(record)))
+                    offset += len(record)
+                compacted.flush()
+                os.fsync(compacted.fileno())
+            state['entries'], state['size'] = entries, offset
+        except (IOError, OSError), ex:
+            _logger.error("Failed to compact queue %s: %s" % (self.name, ex))
+            state['entries'] = None
+        for reader in state['readers'].itervalues(): reader.close()
+        state['items'], state['readers'] = None, None
+        return state
+
+    def finish_compaction(self, state):
+        '''
+        Atomically swap the compacted segment in for every segment
+        before it. This must be called from the thread that owns the
+        queue.
+
+        :param state: The state returned from ``write_compaction``
+        :return: True if the log was compacted, False otherwise
+        '''
+        self.compacting = False
+        entries = state['entries']
+        consumed = self.popped - state['popped']
+        swapped = (entries is not None and self.transactions is not None
+            and consumed < len(entries))
+        if swapped:
+            previous, segment = self.log_size, state['segment']
+            os.rename(state['path'], self._segment_path(segment, "compact"))
+            self.segments[segment] = state['size']
+            self.versions[segment] = _log_version
+            self.compacted.add(segment)
+            self.log_size += state['size']
+            remaining = len(entries) - consumed
+            fresh = entries[consumed:]
+            # records that had to be framed afresh changed in length
+            self.live_size += (sum(entry[4] for entry in fresh)
+                - sum(entry[4] for entry in islice(self.queue, remaining)))
+            if self.payloads == "spill": # keep what is currently in memory
+                fresh = [entry[:3] + current[3:4] + entry[4:] for entry, current
+                    in izip(fresh, self.queue)]
+            self.queue = deque(chain(fresh, islice(self.queue, remaining, None)))
+            self._retire_segments()
+            _logger.debug("Compacted the transaction log for queue %s from "
+                "%d to %d bytes" % (self.name, previous, self.log_size))
+        elif os.path.exists(state['path']):
+            os.remove(state['path'])
+        return swapped
+
+    def suspend(self):
+        '''
+        Close the files of an idle queue to give back its file
+        descriptors. The log is reopened for appending the next time
+        the queue is used. A queue that is compacting or waiting on a
+        log writer is left alone.
+
+        :return: True if the queue was suspended, False otherwise
+        '''
+        if (self.suspended or self.transactions is None or self.compacting
+            or self.unfinished):
+            return False
+        _logger.debug("Suspending the idle queue %s" % self.name)
+        self._write_checkpoint()
+        self._close_log()
+        for reader in self.readers.itervalues(): reader.close()
+        self.readers.clear()
+        self.suspended = True
+        return True
+
     def close(self):
         '''
         Finish all writes to this queue's transaction log file
-        and close it.
+        and close it. A log that failed is already closed.
 
         :return: void
         '''
         # TODO find a way to do this without another lock?
         _logger.debug("Closing the queue %s" % self.name)
-        temp = self.transactions
-        self.transactions = None
-        temp.close()
+        if not self.failed:
+            self._log_exists_or_throw() # reopen a suspended log
+            self._write_checkpoint()
+            self._close_log()
+        for reader in self.readers.itervalues(): reader.close()
+        self.readers.clear()
+
+    def detach(self):
+        '''
+        Drop every record still held for a commit, and notify everyone
+        waiting on them, as the queue is about to be purged. This must
+        be called from the thread that owns the queue.
+
+        :return: void
+        '''
+        self.pending, self.unlogged_pops = [], 0
+        waiters, self.waiters = self.waiters, []
+        for callback, _ in waiters: callback()
 
     def purge(self):
         '''
-        Purge the entire transaction log for this queue
+        Purge the entire transaction log for this queue. This can be
+        slow for a large log and is safe to run in a background thread
+        once the queue has been detached.
 
         :return: void
         '''
         _logger.debug("Purging the entire transaction for %s" % self.name)
+        self._drain_writes() # a writer may still be appending to the log
         self.close()
-        if os.path.exists(self.log_path):
-            os.remove(self.log_path)
+        for segment in self.segments:
+            path = self._segment_file(segment)
+            if os.path.exists(path): os.remove(path)
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
 
     # --------------------------------------------------------------- #
     # Private Methods
     # --------------------------------------------------------------- #
-    def _open_log(self):
+    def _segment_path(self, segment, kind="log"):
+        '''
+        Helper to build the path of a log segment
+
+        :param segment: The number of the segment
+        :param kind: The kind of segment (log, compact, or tmp)
+        :return: The path to the segment file
+        '''
+        if segment == 0: return self.log_path
+        return "%s.%08d.%s" % (self.log_path, segment, kind)
+
+    def _segment_file(self, segment):
         '''
-        Helper method to open a new log file and initialize values
+        Helper to find the file of a live log segment
+
+        :param segment: The number of the segment
+        :return: The path to the segment file
+        '''
+        kind = "compact" if segment in self.compacted else "log"
+        return self._segment_path(segment, kind)
+
+    def _read_log(self, segment, offset, size):
+        '''
+        Helper to read a range of bytes back from a log segment. The
+        records at the end of the active segment that are still held for
+        a group commit (or a writer) are read from memory, so reading
+        never forces a commit.
+
+        :param segment: The segment to read from
+        :param offset: The offset to start reading at
+        :param size: The number of bytes to read
+        :return: The bytes read
+        '''
+        unwritten = ""
+        if segment == self.active:
+            end, pieces = self.segments[segment], []
+            for data in reversed([batch['data'] for batch in self.unfinished]
+                + self.pending):
+                if end <= offset: break
+                start = end - len(data)
+                if start < offset + size:
+                    pieces.append(data[max(offset - start, 0):offset + size - start])
+                end = start
+            unwritten = "".join(reversed(pieces))
+            size = max(min(offset + size, end) - offset, 0)
+            if not size: return unwritten
+            self._log_exists_or_throw()
+            self.transactions.flush() # written, but maybe still buffered
+        reader = self.readers.get(segment, None)
+        if reader is None:
+            reader = self.readers[segment] = open(self._segment_file(segment),
+                "rb", 0) # a read buffer could hold stale preallocated space
+        reader.seek(offset)
+        return reader.read(size) + unwritten
+
+    def _refill_head(self):
+        '''
+        Helper to bring the spilled items at the head of the queue back
+        into memory with one sequential read of up to a window of log.
 
         :return: void
         '''
-        fd = os.open(self.log_path, os.O_RDWR|os.O_CREAT)
+        segment, start = self.queue[0][:2]
+        batch, end = [], start
+        for entry in self.queue:
+            if entry[3] is not None or entry[0] != segment: break
+            if batch and self._record_end(entry) - start > self.spill_window:
+                break
+            batch.append(entry)
+            end = self._record_end(entry)
+
+        data = self._read_log(segment, start, end - start)
+        for _ in batch: self.queue.popleft()
+        for segment, offset, size, _, length in reversed(batch):
+            self.queue.appendleft((segment, offset, size,
+                self._decode(data, offset - start, size), length))
+        self.resident_size += sum(entry[2] for entry in batch)
+
+    def _find_segments(self):
+        '''
+        Helper to find every log segment of this queue on disk
+
+        :return: A sorted list of (segment, kind) pairs
+        '''
+        segments = []
+        for entry in os.listdir(self.path):
+            if entry == self.name:
+                segments.append((0, "log"))
+            elif entry.startswith(self.name):
+                match = _segment_pattern.match(entry[len(self.name):])
+                if match: segments.append((int(match.group(1)), match.group(2)))
+        return sorted(segments)
+
+    def _open_log(self, segment):
+        '''
+        Helper method to open a log segment for appending. Segments
+        that already exist are appended to after their last record.
+
+        :param segment: The number of the segment to open
+        :return: void
+        '''
+        path = self._segment_path(segment)
+        fd = os.open(path, os.O_RDWR|os.O_CREAT)
         self.transactions = os.fdopen(fd, "rb+")
-        self.log_size = os.path.getsize(self.log_path)
+        self.allocated = os.fstat(fd).st_size
+        if segment not in self.segments: # a new segment
+            self.transactions.write(_log_header)
+            self.versions[segment] = _log_version
+            self.segments[segment] = _header_struct.size
+            self.log_size += _header_struct.size
+        self.transactions.seek(self.segments[segment])
+        self.active = segment
+        self.next_segment = max(self.next_segment, segment + 1)
+
+    def _roll_segment(self):
+        '''
+        Helper method to close the active log segment and start
+        appending to a new one.
+
+        :return: void
+        '''
+        _logger.debug("Starting a new log segment for queue %s" % self.name)
+        self.commit()
+        self._close_log()
+        self._open_log(self.next_segment)
+
+    def _close_log(self):
+        '''
+        Helper method to close the active log segment, giving back
+        any space reserved past its last record.
+
+        :return: void
+        '''
+        temp, self.transactions = self.transactions, None
+        temp.flush()
+        if self.allocated > self.segments[self.active]:
+            os.ftruncate(temp.fileno(), self.segments[self.active])
+        temp.close()
+        self.allocated = 0
+
+    def _preallocate(self, end):
+        '''
+        Helper method to reserve space in the active log segment in
+        whole chunks, so appends do not have to grow the file.
+
+        :param end: The offset the log segment must reach
+        :return: void
+        '''
+        if not self.preallocate or end <= self.allocated: return
+        chunks = (end - self.allocated - 1) // self.preallocate + 1
+        _allocate(self.transactions.fileno(), self.allocated,
+            chunks * self.preallocate)
+        self.allocated += chunks * self.preallocate
+
+    def _retire_segments(self):
+        '''
+        Helper method to delete every log segment in front of the
+        oldest live item. The checkpoint is moved past them first so
+        a crash can never leave it pointing at a deleted segment.
+
+        :return: void
+        '''
+        if self.transactions is None: return # still replaying
+        head = self.queue[0][0] if self.queue else self.active
+        retired = [segment for segment in self.segments if segment < head]
+        if not retired: return
+        self._write_checkpoint()
+        for segment in retired:
+            _logger.debug("Removing consumed log segment %d of queue %s"
+                % (segment, self.name))
+            if segment in self.readers:
+                self.readers.pop(segment).close()
+            self._remove_segment(segment, self._segment_file(segment))
+            self.compacted.discard(segment)
+            self.versions.pop(segment, None)
+            self.log_size -= self.segments.pop(segment)
+
+    def _remove_segment(self, segment, path):
+        '''
+        Helper to delete a consumed log segment, or to retire it when
+        consumed segments are being retained.
+
+        :param segment: The number of the segment
+        :param path: The path to the segment file
+        :return: void
+        '''
+        if self.retain_segments:
+            os.rename(path, "%s.%08d.retired" % (self.log_path, segment))
+        else: os.remove(path)
 
-    def _rotate_log(self):
+    def _write_checkpoint(self):
         '''
-        Helper method to quickly rename a file to
-        `filename.timestamp`
+        Helper method to atomically record the position of the oldest
+        live item and the end of the log, so that replay can skip
+        straight to the live records.
 
         :return: void
         '''
-        # guard with a reader writer lock?
-        _logger.debug("Rotating log for queue %s" % self.name)
-        self.transactions.close()
-        os.rename(self.log_path, "%s.%s" % (self.log_path, time.time()))
-        self._open_log()
+        self.commit()
+        self.transactions.flush()
+        tail = (self.active, self.segments[self.active])
+        head = self.queue[0][:2] if self.queue else tail
+        path = self.checkpoint_path + ".tmp"
+        with open(path, "wb") as checkpoint:
+            checkpoint.write(_checkpoint_struct.pack(*(head + tail)))
+            if self.durability in ("fsync-per-op", "group-commit"):
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+        os.rename(path, self.checkpoint_path)
+
+    def _read_checkpoint(self):
+        '''
+        Helper method to read back the replay checkpoint
+
+        :return: The (head, tail) positions, or None if there is none
+        '''
+        try:
+            with open(self.checkpoint_path, "rb") as checkpoint:
+                data = checkpoint.read(_checkpoint_struct.size)
+            position = _checkpoint_struct.unpack(data)
+            return (position[:2], position[2:])
+        except (IOError, StructError):
+            if os.path.exists(self.checkpoint_path):
+                _logger.warning("Ignoring unreadable checkpoint for queue %s"
+                    % self.name)
+            return None
 
     def _log_exists_or_throw(self, test=True):
         '''
-        Helper to make the log checking look cleaner
+        Helper to make the log checking look cleaner, which also
+        reopens the log of a suspended queue.
 
         :return: void
         '''
+        if test and self.suspended:
+            self.suspended = False
+            self._open_log(self.active)
         if test and not self.transactions:
             _logger.error("Transaction log not available for queue %s" % self.name)
             raise TransactionLogException("Transaction log not available")
 
-    def _read_command(self, fd):
+    def _replay_transactions(self, segments=None):
         '''
-        Helper method to read a single command back out of the
-        transactions log
+        Helper to rebuild the in-memory queue from the transaction log.
+        Replay starts at the checkpointed head (or the newest compacted
+        segment if that is later) and each segment is mapped into memory
+        and parsed in place, so the replay cost scales with the live
+        bytes on disk instead of with the number of python calls per
+        record.
 
-        :param fd: The file descriptor to read from
-        :return: A tuple of the read command and size
+        :param segments: The (segment, kind) pairs already found on disk,
+            or None to look for them
+        :return: The number of payload bytes left in the queue
         '''
-        raw_size = fd.read(4)
-        if not raw_size:
-            return (0, None)
-        size = unpack("I", raw_size)[0] 
-        data = fd.read(size)
-        return (size, data)
+        live_bytes, start = 0, time.time()
+        self.log_size, self.next_segment, self.active = 0, 1, None
+        if segments is None:
+            segments = self._find_segments()
+        else: # the queue may have been purged since they were found
+            segments = [(segment, kind) for segment, kind in segments
+                if os.path.exists(self._segment_path(segment, kind))]
+        checkpoint = self._read_checkpoint() or ((0, 0), (0, 0))
+        head, tail = checkpoint
+        compacted = [segment for segment, kind in segments if kind == "compact"]
+        if compacted and compacted[-1] > head[0]:
+            head = tail = (compacted[-1], 0)
 
-    def _replay_transactions(self):
+        _logger.debug("Reading back transaction log for queue %s" % self.name)
+        for segment, kind in segments:
+            self.next_segment = max(self.next_segment, segment + 1)
+            path = self._segment_path(segment, kind)
+            if kind == "tmp":
+                os.remove(path) # a stale compaction
+                continue
+            if segment < head[0]:
+                self._remove_segment(segment, path) # a consumed segment
+                continue
+            if kind == "compact": self.compacted.add(segment)
+            offset = head[1] if segment == head[0] else 0
+            last = (segment, kind) == segments[-1] and kind == "log"
+            bytes, size, appendable = self._replay_segment(segment, path,
+                offset, tail, last)
+            live_bytes += bytes
+            self.segments[segment] = size
+            self.log_size += size
+            self.active = segment if kind == "log" and appendable else None
+
+        # never append after a torn record or to an old or compacted log
+        if self.active is None:
+            self.active = self.next_segment
+        self._open_log(self.active)
+        self._retire_segments()
+
+        elapsed = max(time.time() - start, 1e-6)
+        _logger.debug("Finished reading back transaction log for queue %s "
+            "(%d bytes in %0.3fs, %0.2f MB/s)" % (self.name, self.log_size,
+            elapsed, self.log_size / elapsed / (1024**2)))
+        return live_bytes
+
+    def _replay_segment(self, segment, path, offset, tail, last=False):
         '''
-        Helper to make the log checking look cleaner
+        Helper method to map a log segment into memory and replay it.
+        If the newest segment ends in a torn record it is cut back to
+        the last good record in one step, and appending continues there.
 
-        :return: void
+        :param segment: The number of the segment
+        :param path: The path to the segment
+        :param offset: The offset to start replaying at
+        :param tail: The position before which pops are already applied
+        :param last: Set to True if this is the newest segment
+        :return: A tuple of the payload bytes added, the size of the
+            segment, and if it is safe to append to
         '''
-        self._open_log()
-        bytes_read = 0
+        size = os.path.getsize(path)
+        if not size: return (0, 0, False)
+        with open(path, "rb") as log:
+            buffer = mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                version = self.versions[segment] = self._log_version(buffer)
+                replay = self._replay_framed if version > 1 else self._replay_buffer
+                bytes, position, clean = replay(buffer, segment, offset, tail, version)
+            finally: buffer.close()
 
-        _logger.debug("Reading back transaction log for queue %s" % self.name)
-        for cmd in file_iterator(self.transactions):
-            if cmd == self.__trx_cmd_push:
-                (size, data) = self._read_command(self.transactions)
-                if not data: continue
-                self.put(data, False)
-                bytes_read -= size
-            elif cmd == self.__trx_cmd_pop:
-                bytes_read -= len(self.get(False))
+        if clean:
+            return (bytes, position, version == _log_version)
+        if last and version == _log_version:
+            _logger.warning("Truncating %d bytes of torn transaction at the "
+                "end of the log for queue %s" % (size - position, self.name))
+            with open(path, "rb+") as log: log.truncate(position)
+            return (bytes, position, True)
+        _logger.warning("Ignoring %d bytes of incomplete transaction "
+            "at the end of the log for queue %s" % (size - position, self.name))
+        return (bytes, size, False)
+
+    def _replay_buffer(self, buffer, segment, position, tail, version):
+        '''
+        Helper method to apply every command in a transaction log
+        buffer from before records were framed to the in-memory queue.
+
+        :param buffer: The buffer (or mapping) holding the log
+        :param segment: The number of the segment being replayed
+        :param position: The offset to start replaying at
+        :param tail: The position before which pops are already applied
+        :param version: The format version of the log
+        :return: A tuple of the payload bytes added, the offset replay
+            stopped at, and if the log was clean
+        '''
+        length, live_bytes = len(buffer), 0
+        if version:
+            position = max(position, _header_struct.size)
+            cmd_push, cmd_end = self.__trx_cmd_push, self.__trx_cmd_end
+            size_struct = _record_size_struct
+        else: # only ever appended to by older servers
+            cmd_push, cmd_end = self.__trx_legacy_push, None
+            size_struct = _size_struct
+        unpack_size, header = size_struct.unpack_from, size_struct.size
+        skip_pops = self._skip_pops(segment, tail, length)
+
+        while position < length:
+            command = buffer[position]
+            if command == cmd_end: break
+            elif command == cmd_push:
+                start = position + 1 + header
+                if start > length: break
+                size = unpack_size(buffer, position + 1)[0]
+                if start + size > length: break
+                value = buffer[start:start + size] if self.payloads != "disk" else None
+                self._put_entry((segment, position, size, value,
+                    start + size - position))
+                live_bytes += size
+                position = start + size
+            elif command == self.__trx_cmd_pop:
+                if position >= skip_pops and self.queue:
+                    live_bytes -= self._pop_entry()[2]
+                position += 1
+            elif command == self.__trx_cmd_pops and version:
+                if position + _push_overhead > length: break
+                count = unpack_size(buffer, position + 1)[0]
+                if position >= skip_pops:
+                    live_bytes -= self._pop_entries(count)
+                position += _push_overhead
             else:
-                _logger.warning("Invalid command(%s) in transaction log" % cmd)
-        _logger.debug("Finished reading back transaction log for queue %s" % self.name)
-        return bytes_read
+                _logger.warning("Invalid command(%r) in transaction log" % command)
+                position += 1
+
+        # anything after the last record must be unwritten space
+        clean = not buffer[position:].strip(self.__trx_cmd_end)
+        return (live_bytes, position if clean and version else length, clean)
+
+    def _replay_framed(self, buffer, segment, position, tail, version):
+        '''
+        Helper method to apply every record in a framed transaction log
+        buffer to the in-memory queue. Replay stops at the first record
+        that is incomplete or fails its checksum.
+
+        :param buffer: The buffer (or mapping) holding the log
+        :param segment: The number of the segment being replayed
+        :param position: The offset to start replaying at
+        :param tail: The position before which pops are already applied
+        :param version: The format version of the log
+        :return: A tuple of the payload bytes added, the offset replay
+            stopped at, and if the log was clean
+        '''
+        length, live_bytes = len(buffer), 0
+        position = max(position, _header_struct.size)
+        unpack_head, unpack_crc = _record_struct.unpack_from, _crc_struct.unpack_from
+        skip_pops = self._skip_pops(segment, tail, length)
+
+        while position < length:
+            if buffer[position] == self.__trx_cmd_end: break
+            start = position + _push_overhead
+            if start > length: break
+            command, size = unpack_head(buffer, position)
+            end = start + size
+            if end + _crc_struct.size > length: break
+            body = buffer[start:end]
+            checksum = crc32(body, crc32(buffer[position:start])) & 0xffffffff
+            if checksum != unpack_crc(buffer, end)[0]: break
+            if command == self.__trx_cmd_push:
+                value = body if self.payloads != "disk" else None
+                self._put_entry((segment, position, size, value,
+                    end + _crc_struct.size - position))
+                live_bytes += size
+            elif command == self.__trx_cmd_zpush:
+                size, value = _record_size_struct.unpack_from(body)[0], None
+                if self.payloads != "disk":
+                    try: value = self._decode(buffer, position, size)
+                    except ZlibError: break
+                self._put_entry((segment, position, size, value,
+                    end + _crc_struct.size - position))
+                live_bytes += size
+            elif command == self.__trx_cmd_pop:
+                if position >= skip_pops: live_bytes -= self._pop_entries(1)
+            elif command == self.__trx_cmd_pops:
+                if position >= skip_pops:
+                    live_bytes -= self._pop_entries(_record_size_struct.unpack(body)[0])
+            else: break
+            position = end + _crc_struct.size
+
+        # anything after the last record must be unwritten space
+        clean = not buffer[position:].strip(self.__trx_cmd_end)
+        return (live_bytes, position, clean)
+
+    def _skip_pops(self, segment, tail, length):
+        '''
+        Helper method to find the offset in a segment before which
+        the pops were already applied when the checkpoint was written.
+
+        :param segment: The number of the segment being replayed
+        :param tail: The checkpointed end of the log
+        :param length: The length of the segment
+        :return: The offset to start applying pops at
+        '''
+        if segment < tail[0]: return length
+        elif segment == tail[0]: return tail[1]
+        return 0
+
+    def _pop_entries(self, count):
+        '''
+        Helper to take up to ``count`` entries off of the queue
+
+        :param count: The number of entries to take
+        :return: The payload bytes taken
+        '''
+        return sum(self._pop_entry()[2] for _ in xrange(min(count, len(self.queue))))
+
+    def _log_version(self, buffer):
+        '''
+        Helper method to find the format version of a log segment
+
+        :param buffer: The buffer (or mapping) holding the segment
+        :return: The format version, or 0 for a log without a header
+        '''
+        if buffer[:len(_log_magic)] != _log_magic: return 0
+        if len(buffer) < _header_struct.size: return 0
+        magic, version = _header_struct.unpack_from(buffer)
+        if version > _log_version:
+            raise TransactionLogException("Unsupported log version %d for "
+                "queue %s" % (version, self.name))
+        return version
+
+    def _encode(self, value):
+        '''
+        Helper to build the log record for a pushed value. Payloads
+        over the compression threshold are compressed, and stored that
+        way if it makes them smaller.
+
+        :param value: The value being pushed
+        :return: The framed push record
+        '''
+        if self.compress_threshold and len(value) >= self.compress_threshold:
+            start = time.clock()
+            packed = compress(value, self.compress_level)
+            self.compress_time += time.clock() - start
+            stored = _record_size_struct.size + len(packed)
+            self.compressed_in += len(value)
+            if stored < len(value):
+                self.compressed_out += stored
+                return _frame(self.__trx_cmd_zpush,
+                    _record_size_struct.pack(len(value)) + packed)
+            self.compressed_out += len(value)
+        return _frame(self.__trx_cmd_push, value)
+
+    def _decode(self, data, position, size):
+        '''
+        Helper to pull the payload out of a push record of any log
+        version. A compressed record is never larger than its payload,
+        so reading the record header plus ``size`` bytes always covers it.
+
+        :param data: The bytes read from the log
+        :param position: The offset of the record in the bytes
+        :param size: The size of the payload
+        :return: The payload of the record
+        '''
+        start = position + _push_overhead
+        if not ord(data[position]) & _compressed_flag:
+            return data[start:start + size]
+        length = _record_size_struct.unpack_from(data, position + 1)[0]
+        begin = time.clock()
+        value = decompress(data[start + _record_size_struct.size:start + length])
+        self.compress_time += time.clock() - begin
+        return value
+
+    def _record_end(self, entry):
+        '''
+        Helper to find where the log record of a queued entry ends
+
+        :param entry: The (segment, offset, size, value, length) entry
+        :return: The offset just past the record in its segment
+        '''
+        return entry[1] + entry[4]
+
+    def _put_entry(self, entry, spill=False):
+        '''
+        Helper to queue a new entry, deciding if its payload stays
+        in memory on the way.
+
+        :param entry: The (segment, offset, size, value, length) entry to queue
+        :param spill: Set to True to spill regardless of the memory budget
+        :return: void
+        '''
+        size = entry[2]
+        self.total_items += 1
+        self.live_size += entry[4]
+        if self.payloads == "disk":
+            entry = entry[:3] + (None,) + entry[4:]
+        elif self.payloads == "spill":
+            spill = spill or (self.memory_budget and
+                self.resident_size + size > self.memory_budget)
+            if spill:
+                self.tail_items += 1
+                self.tail_size += size
+            else: self.tail_items, self.tail_size = (0, 0)
+        if entry[3] is not None:
+            self.resident_size += size
+        self.queue.append(entry)
+
+        # keep only a window of the newest items in memory while spilling
+        while self.tail_items > 1 and self.tail_size > self.spill_window:
+            index = len(self.queue) - self.tail_items
+            demoted = self.queue[index]
+            self.queue[index] = demoted[:3] + (None,) + demoted[4:]
+            self.tail_items -= 1
+            self.tail_size -= demoted[2]
+            self.resident_size -= demoted[2]
+
+    def _pop_entry(self):
+        '''
+        Helper to take the next entry off of the queue
+
+        :return: The (segment, offset, size, value, length) entry
+        '''
+        entry = self.queue.popleft()
+        self.popped += 1
+        self.live_size -= entry[4]
+        if entry[3] is not None:
+            self.resident_size -= entry[2]
+        if len(self.queue) < self.tail_items:
+            self.tail_items -= 1
+            self.tail_size -= entry[2]
+        return entry
 
     def _transaction(self, data):
         '''
@@ -187,15 +1194,87 @@ class PersistentQueue(Queue):
         :param data: The data to append to the log
         :return: void
         '''
-        # guard with a reader writer lock?
         self._log_exists_or_throw()
-        self.transactions.write(data)
-        self.transactions.flush()
+        self._preallocate(self.segments[self.active] + len(data))
+        if self.durability == "group-commit" or self.background_writes:
+            self.pending.append(data)
+        else: self._write_records(self.transactions, data)
         self.log_size += len(data)
-        if self.log_size > self.__max_size and self.qsize() == 0:
-            self._rotate_log()
+        self.segments[self.active] += len(data)
+        if self.segments[self.active] >= self.segment_size:
+            self._roll_segment()
+
+    def _log_pops(self):
+        '''
+        Helper method to log every coalesced pop as a single record
+
+        :return: void
+        '''
+        count, self.unlogged_pops = self.unlogged_pops, 0
+        if count == 1:
+            self._transaction(self.__trx_pop)
+        elif count:
+            self._transaction(_frame(self.__trx_cmd_pops,
+                _record_size_struct.pack(count)))
+
+    def _write_records(self, log, data):
+        '''
+        Helper method to append records to a log segment and make
+        them as durable as the durability mode promises.
+
+        :param log: The open log segment to append to
+        :param data: The records to append
+        :return: void
+        '''
+        log.write(data)
+        if self.durability != "none":
+            log.flush()
+        if self.durability in ("fsync-per-op", "group-commit"):
+            os.fsync(log.fileno())
+
+    def _drain_writes(self):
+        '''
+        Helper method to wait for a writer thread to finish every
+        batch it has been handed for this queue.
+
+        :return: void
+        '''
+        with self.write_condition:
+            while self.in_flight:
+                self.write_condition.wait()
+
+class SynchronizedQueue(PersistentQueue):
+    '''
+    A PersistentQueue that serializes every operation with a lock, for
+    queues that are touched from more than one thread.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        '''
+        Create a new SynchronizedQueue, see :class:`PersistentQueue`
+        for the available parameters.
+        '''
+        self.mutex = threading.RLock()
+        PersistentQueue.__init__(self, *args, **kwargs)
+
+    put               = _synchronized(PersistentQueue.put)
+    put_many          = _synchronized(PersistentQueue.put_many)
+    get               = _synchronized(PersistentQueue.get)
+    qsize             = _synchronized(PersistentQueue.qsize)
+    empty             = _synchronized(PersistentQueue.empty)
+    commit            = _synchronized(PersistentQueue.commit)
+    when_durable      = _synchronized(PersistentQueue.when_durable)
+    take_batch        = _synchronized(PersistentQueue.take_batch)
+    finish_batch      = _synchronized(PersistentQueue.finish_batch)
+    suspend           = _synchronized(PersistentQueue.suspend)
+    needs_compaction  = _synchronized(PersistentQueue.needs_compaction)
+    begin_compaction  = _synchronized(PersistentQueue.begin_compaction)
+    finish_compaction = _synchronized(PersistentQueue.finish_compaction)
+    close             = _synchronized(PersistentQueue.close)
+    detach            = _synchronized(PersistentQueue.detach)
+    purge             = _synchronized(PersistentQueue.purge)
 
 #---------------------------------------------------------------------------# 
 # Exported Identifiers
 #---------------------------------------------------------------------------# 
-__all__ = [ "PersistentQueue" ]
+__all__ = [ "PersistentQueue", "SynchronizedQueue" ]
@@ -0,0 +1,136 @@
+'''
+Mamba Log Retention
+------------------------------------------------------------
+
+Queue log segments that have been consumed are normally deleted
+straight away. To keep an audit trail they can instead be retired
+(renamed to ``name.00000001.retired``) and left for the retention
+policy, which bounds how many of them each queue keeps, how old they
+may get, and how many bytes they may take up. Logs that were rotated
+by older servers (``name.1323100000.25``) are treated the same way, so
+the policy also cleans up spool directories left over from them.
+
+The policy only ever touches retired files, so it is safe to run
+in a background thread while the queues are being used, or from an
+offline tool against a spool directory.
+'''
+import os, re, time
+
+#---------------------------------------------------------------------------#
+# Logging
+#---------------------------------------------------------------------------#
+import logging
+_logger = logging.getLogger("mamba.queue")
+
+#---------------------------------------------------------------------------#
+# Local helpers
+#---------------------------------------------------------------------------#
+_retired_pattern = re.compile(r"^(.+?)\.(\d{8}\.retired|\d{9,10}\.\d{1,2})$")
+_owner_pattern = re.compile(r"^(.+?)(\.\d{8}\.(log|compact)|\.checkpoint)$")
+
+#---------------------------------------------------------------------------#
+# Class definitions
+#---------------------------------------------------------------------------#
+class RetentionPolicy(object):
+    '''
+    Bounds the retired log files kept for each queue
+    '''
+
+    def __init__(self, max_age=0, max_count=0, max_bytes=0):
+        '''
+        Initialize a new retention policy, where a limit of 0 means
+        there is no limit.
+
+        :param max_age: The seconds a retired file is kept for
+        :param max_count: The retired files kept for each queue
+        :param max_bytes: The retired bytes kept for each queue
+        '''
+        self.max_age = max_age
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+
+    def enabled(self):
+        '''
+        Check if the policy limits anything, in which case consumed
+        segments should be retired instead of deleted.
+
+        :return: True if any limit is set, False otherwise
+        '''
+        return bool(self.max_age or self.max_count or self.max_bytes)
+
+    @staticmethod
+    def find(path):
+        '''
+        Find every retired (or rotated) log file in a persistence
+        directory. A file that only looks like a rotated log (the legacy
+        log of a queue named ``orders.1323100000.25``, say) is left out
+        when a live queue of that name has segments or a checkpoint.
+
+        :param path: The path to the persistence directory
+        :return: A dict of queue name to a list of (path, size, mtime)
+            tuples for that queue, oldest first
+        '''
+        retired, entries = {}, os.listdir(path)
+        owned = set(match.group(1) for match in
+            map(_owner_pattern.match, entries) if match)
+        for entry in entries:
+            match = _retired_pattern.match(entry)
+            if not match or entry in owned: continue
+            full = os.path.join(path, entry)
+            try: stat = os.stat(full)
+            except OSError: continue # removed while we looked
+            retired.setdefault(match.group(1), []).append(
+                (full, stat.st_size, stat.st_mtime))
+        for files in retired.itervalues():
+            files.sort(key=lambda entry: (entry[2], entry[0]))
+        return retired
+
+    def expired(self, files, now=None):
+        '''
+        Pick out the files of a single queue that are past the policy
+
+        :param files: The (path, size, mtime) tuples of the queue, oldest first
+        :param now: The current time, defaults to now
+        :return: The list of files to remove
+        '''
+        now = now or time.time()
+        keep, kept_bytes, expired = [], 0, []
+        for entry in reversed(files): # the newest are kept first
+            path, size, mtime = entry
+            if ((self.max_age and now - mtime > self.max_age)
+                or (self.max_count and len(keep) >= self.max_count)
+                or (self.max_bytes and kept_bytes + size > self.max_bytes)):
+                expired.append(entry)
+            else:
+                keep.append(entry)
+                kept_bytes += size
+        expired.reverse()
+        return expired
+
+    def enforce(self, path, now=None):
+        '''
+        Remove every retired file in a persistence directory that is
+        past the policy.
+
+        :param path: The path to the persistence directory
+        :param now: The current time, defaults to now
+        :return: The list of paths that were removed
+        '''
+        removed = []
+        if not self.enabled(): return removed
+        for name, files in self.find(path).iteritems():
+            for entry in self.expired(files, now):
+                try:
+                    os.remove(entry[0])
+                    removed.append(entry[0])
+                except OSError, ex:
+                    _logger.warning("Failed to remove retired log %s: %s"
+                        % (entry[0], ex))
+        if removed:
+            _logger.debug("Removed %d retired logs from '%s'" % (len(removed), path))
+        return removed
+
+#---------------------------------------------------------------------------#
+# Exported Identifiers
+#---------------------------------------------------------------------------#
+__all__ = [ "RetentionPolicy" ]
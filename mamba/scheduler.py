@@ -0,0 +1,60 @@
+'''
+Mamba Scheduler
+------------------------------------------------------------
+
+The queue collection occasionally needs to put work off until
+later (batched log commits for example) or move it off of the
+main thread (log compaction) without knowing anything
+about the event loop that drives it. The default scheduler simply
+runs the work inline, which is what the tests and any embedded
+users of the collection expect; the server installs a version
+that hands the work to the twisted reactor.
+'''
+
+#---------------------------------------------------------------------------#
+# Class definitions
+#---------------------------------------------------------------------------#
+class Scheduler(object):
+    '''
+    A scheduler that runs everything as soon as it is asked to
+    '''
+
+    def call_later(self, delay, method, *args):
+        '''
+        Run the supplied method after ``delay`` seconds
+
+        :param delay: The number of seconds to wait before calling
+        :param method: The method to call
+        :param args: The arguments to supply to the method
+        :return: void
+        '''
+        method(*args)
+
+    def call_in_thread(self, method, callback, *args):
+        '''
+        Run the supplied method away from the calling thread (if the
+        scheduler has somewhere else to run it) and then hand its result
+        to ``callback`` back on the calling thread.
+
+        :param method: The method to call
+        :param callback: The method to pass the result to
+        :param args: The arguments to supply to the method
+        :return: void
+        '''
+        callback(method(*args))
+
+    def call_from_thread(self, method, *args):
+        '''
+        Run the supplied method on the main thread, from any other
+        thread (a log writer for example).
+
+        :param method: The method to call
+        :param args: The arguments to supply to the method
+        :return: void
+        '''
+        method(*args)
+
+#---------------------------------------------------------------------------# 
+# Exported Identifiers
+#---------------------------------------------------------------------------# 
+__all__ = [ "Scheduler" ]
@@ -12,13 +12,15 @@ Example run::
     StartServer() # this will not return
 '''
 import time
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 from twisted.internet.protocol import ServerFactory
 from twisted.protocols.basic import LineReceiver
 
 from mamba.handler import Handler
 from mamba.attr import AttributeDict
 from mamba.config import Options
+from mamba.defaults import Defaults
+from mamba.scheduler import Scheduler
 from mamba.collection import QueueCollection
 
 #---------------------------------------------------------------------------#
@@ -34,6 +36,13 @@ class MambaProtocol(LineReceiver):
     '''
     Implementation of an async mamba client handler using
     the Twisted protocol.
+
+    Commands are read as lines, but the data block of a set is read in
+    raw mode for exactly its length (and the line break after it), so
+    that it may hold any bytes. The block is collected as a list of the
+    chunks it arrived in, which are only joined once it is complete. Sets
+    sent with ``noreply`` are stored together once all the data received
+    so far has been processed.
     '''
 
     def connectionMade(self):
@@ -48,6 +57,10 @@ class MambaProtocol(LineReceiver):
         self.factory.statistics.total_connections += 1
         self.handler = self.factory.getHandler()
         self.callbacks = {'send':self._send, 'exit':self._shutdown}
+        self.chunks = None   # the data block being read
+        self.remaining = 0   # the bytes of the data block still to read
+        self.trailer = ''    # the bytes read after the data block
+        self.receiving = 0   # the depth of nested calls to dataReceived
 
     def connectionLost(self, reason):
         ''' Callback for when a client disconnects
@@ -56,6 +69,22 @@ class MambaProtocol(LineReceiver):
         '''
         _logger.debug("Client Disconnected")
         self.factory.statistics.connections -= 1
+        self.handler.flush(self.callbacks)
+
+    def dataReceived(self, data):
+        ''' Callback when we receive data from the client
+
+        Leaving raw mode feeds the rest of the data back in through here,
+        so the held sets are only stored by the outermost call, once the
+        whole of the data has been processed.
+
+        :param data: The data sent by the client
+        '''
+        self.receiving += 1
+        try: result = LineReceiver.dataReceived(self, data)
+        finally: self.receiving -= 1
+        if not self.receiving: self.handler.flush(self.callbacks)
+        return result
 
     def lineReceived(self, data):
         ''' Callback when we receive any data
@@ -64,7 +93,31 @@ class MambaProtocol(LineReceiver):
         '''
         _logger.debug("RX: %s", data)
         self.factory.statistics.bytes_read += len(data)
-        self.handler.process(data, self.callbacks)
+        length = self.handler.process(data, self.callbacks)
+        if length is not None: # read the data block as it is
+            self.chunks, self.remaining, self.trailer = [], length, ''
+            self.setRawMode()
+
+    def rawDataReceived(self, data):
+        ''' Callback when we receive part of a data block
+
+        :param data: The data sent by the client
+        '''
+        if self.remaining:
+            chunk = data[:self.remaining] if len(data) > self.remaining else data
+            data = data[len(chunk):]
+            self.chunks.append(chunk)
+            self.remaining -= len(chunk)
+            self.factory.statistics.bytes_read += len(chunk)
+        if not self.remaining and data:
+            self.trailer += data
+        if self.remaining or len(self.trailer) < 2: return
+
+        trailer, rest = self.trailer[:2], self.trailer[2:]
+        chunks, self.chunks, self.trailer = self.chunks, None, ''
+        self.factory.statistics.bytes_read += len(trailer)
+        self.handler.process_data(chunks, trailer, self.callbacks)
+        self.setLineMode(rest)
 
     #--------------------------------------------------------------------------#
     # Private Functions
@@ -87,6 +140,48 @@ class MambaProtocol(LineReceiver):
             reactor.stop()
         except: logging.error("Silencing reactor shutdown")
 
+class ReactorScheduler(Scheduler):
+    '''
+    Scheduler that defers work to the twisted reactor
+    '''
+
+    def call_later(self, delay, method, *args):
+        '''
+        Run the supplied method after ``delay`` seconds
+
+        :param delay: The number of seconds to wait before calling
+        :param method: The method to call
+        :param args: The arguments to supply to the method
+        :return: void
+        '''
+        reactor.callLater(delay, method, *args)
+
+    def call_in_thread(self, method, callback, *args):
+        '''
+        Run the supplied method in the reactor thread pool and then
+        hand its result to ``callback`` back on the reactor thread.
+
+        :param method: The method to call
+        :param callback: The method to pass the result to
+        :param args: The arguments to supply to the method
+        :return: void
+        '''
+        deferred = threads.deferToThread(method, *args)
+        deferred.addCallback(callback)
+        deferred.addErrback(lambda failure: _logger.error(
+            "Background task failed: %s" % failure.getErrorMessage()))
+
+    def call_from_thread(self, method, *args):
+        '''
+        Run the supplied method on the reactor thread, from any other
+        thread (a log writer for example).
+
+        :param method: The method to call
+        :param args: The arguments to supply to the method
+        :return: void
+        '''
+        reactor.callFromThread(method, *args)
+
 class MambaServerFactory(ServerFactory):
     '''
     Builder class for a mamba server that also holds the queue
@@ -102,15 +197,67 @@ class MambaServerFactory(ServerFactory):
         '''
         self.path = options['path']
         self.timeout = options['timeout']
+        self.durability = options.get('durability', Defaults.Durability)
+        self.commit_window = options.get('commit_window', Defaults.CommitWindow)
+        self.segment_size = options.get('segment_size', Defaults.SegmentSize)
+        self.payloads = options.get('payloads', Defaults.Payloads)
+        self.memory_limit = options.get('memory_limit', Defaults.MemoryLimit)
+        self.memory_budget = options.get('memory_budget', Defaults.MemoryBudget)
+        self.spill_window = options.get('spill_window', Defaults.SpillWindow)
+        self.recovery = options.get('recovery', Defaults.Recovery)
+        self.recovery_workers = options.get('recovery_workers',
+            Defaults.RecoveryWorkers)
+        self.compact_ratio = options.get('compact_ratio', Defaults.CompactRatio)
+        self.compact_min_size = options.get('compact_min_size',
+            Defaults.CompactMinSize)
+        self.log_writers = options.get('log_writers', Defaults.LogWriters)
+        self.writer_backlog = options.get('writer_backlog',
+            Defaults.WriterBacklog)
+        self.storage = options.get('storage', Defaults.Storage)
+        self.max_open_logs = options.get('max_open_logs', Defaults.MaxOpenLogs)
+        self.preallocate = options.get('preallocate', Defaults.Preallocate)
+        self.compress_threshold = options.get('compress_threshold',
+            Defaults.CompressThreshold)
+        self.compress_level = options.get('compress_level',
+            Defaults.CompressLevel)
+        self.retain_age = options.get('retain_age', Defaults.RetainAge)
+        self.retain_count = options.get('retain_count', Defaults.RetainCount)
+        self.retain_bytes = options.get('retain_bytes', Defaults.RetainBytes)
+        self.retention_interval = options.get('retention_interval',
+            Defaults.RetentionInterval)
+        self.fanout = options.get('fanout', Defaults.Fanout)
 
     def startFactory(self):
         '''
-        Callback for when the server is started up
+        Callback for when the server is started up. Existing queues are
+        recovered according to the ``recovery`` option:
+
+            ``lazy``        Replay each queue off the reactor when first used
+            ``eager``       Replay every queue before accepting clients
+            ``background``  Accept clients while the queues replay
 
         :return: void
         '''
         _logger.debug('Mamba Server Started')
-        self.database = QueueCollection(self.path)
+        self.database = QueueCollection(self.path,
+            durability=self.durability, commit_window=self.commit_window,
+            segment_size=self.segment_size, payloads=self.payloads,
+            memory_limit=self.memory_limit, memory_budget=self.memory_budget,
+            spill_window=self.spill_window, compact_ratio=self.compact_ratio,
+            compact_min_size=self.compact_min_size,
+            log_writers=self.log_writers, writer_backlog=self.writer_backlog,
+            storage=self.storage, max_open_logs=self.max_open_logs,
+            preallocate=self.preallocate,
+            compress_threshold=self.compress_threshold,
+            compress_level=self.compress_level,
+            retain_age=self.retain_age, retain_count=self.retain_count,
+            retain_bytes=self.retain_bytes,
+            retention_interval=self.retention_interval, fanout=self.fanout,
+            scheduler=ReactorScheduler())
+        if self.recovery == "eager":
+            self.database.recover(self.recovery_workers)
+        elif self.recovery == "background":
+            self.database.recover(self.recovery_workers, wait=False)
         self.statistics = AttributeDict()
         self.statistics.start_time = time.time()
 
@@ -0,0 +1,97 @@
+'''
+Mamba Log Writer
+------------------------------------------------------------
+
+Appending to the transaction logs from the reactor means a slow
+disk stalls every connection. The log writer moves those appends
+to a small pool of threads: the collection hands over the records
+a queue has built up as one batch, a writer appends the batch to
+the log in a single write, and the queue is told (back on the
+calling thread) once it has, which is when the clients waiting on
+those records get their replies.
+
+Every queue is always handled by the same writer so that its batches
+reach the log in order, and the writers are fed through bounded
+queues so that a disk that cannot keep up pushes back on the server
+instead of letting the batches pile up in memory.
+'''
+import threading
+from Queue import Queue
+from mamba.scheduler import Scheduler
+from mamba.defaults import Defaults
+
+#---------------------------------------------------------------------------#
+# Logging
+#---------------------------------------------------------------------------#
+import logging
+_logger = logging.getLogger("mamba.queue")
+
+#---------------------------------------------------------------------------#
+# Class definitions
+#---------------------------------------------------------------------------#
+class LogWriter(object):
+    '''
+    A pool of threads that append batches of records to queue logs
+    '''
+
+    def __init__(self, workers=Defaults.LogWriters,
+        backlog=Defaults.WriterBacklog, scheduler=None):
+        '''
+        Initialize and start a new pool of log writers
+
+        :param workers: The number of writer threads to start
+        :param backlog: The batches each writer can have waiting
+        :param scheduler: The scheduler used to report finished batches
+        '''
+        self.scheduler = scheduler or Scheduler()
+        self.requests = [Queue(backlog) for _ in range(max(workers, 1))]
+        self.threads = [threading.Thread(target=self._run, args=(requests,),
+            name="mamba-writer-%d" % index)
+            for index, requests in enumerate(self.requests)]
+        for thread in self.threads:
+            thread.setDaemon(True)
+            thread.start()
+
+    def submit(self, queue):
+        '''
+        Hand everything the queue has logged since the last batch to
+        its writer. This blocks while that writer's backlog is full.
+
+        :param queue: The queue to write the records of
+        :return: True if a batch was submitted, False otherwise
+        '''
+        batch = queue.take_batch()
+        if batch is None: return False
+        self.requests[hash(queue.name) % len(self.requests)].put((queue, batch))
+        return True
+
+    def close(self):
+        '''
+        Wait for every submitted batch to be written and then stop
+        the writer threads.
+
+        :return: void
+        '''
+        for requests in self.requests:
+            requests.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    # ---------------------------------------------------- #
+    # Private Methods
+    # ---------------------------------------------------- #
+    def _run(self, requests):
+        '''
+        The main loop of a writer thread
+
+        :param requests: The queue of batches this writer handles
+        :return: void
+        '''
+        for queue, batch in iter(requests.get, None):
+            queue.write_batch(batch)
+            self.scheduler.call_from_thread(queue.finish_batch, batch)
+
+#---------------------------------------------------------------------------#
+# Exported Identifiers
+#---------------------------------------------------------------------------#
+__all__ = [ "LogWriter" ]
@@ -0,0 +1,98 @@
+import sys, os, unittest, shutil, tempfile
+from Queue import Empty
+from mamba.backend import MemoryQueue, LogBackend, MemoryBackend
+from mamba.persistent import PersistentQueue
+from mamba.collection import QueueCollection
+from mamba.errors import QueueCollectionException
+
+class SimpleStorageBackendTest(unittest.TestCase):
+    '''
+    The unit tests for the mamba.backend module
+    '''
+
+    def setUp(self):
+        ''' Initializes the test environment '''
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        ''' Cleans up the test environment '''
+        shutil.rmtree(self.path)
+
+    def testMemoryQueue(self):
+        '''
+        Test that the memory queue behaves like a persistent one
+        '''
+        queue, durable = MemoryQueue("memory"), []
+        for value in ["first", "second"]:
+            queue.put(value)
+        queue.when_durable(lambda: durable.append(True))
+        self.assertEqual([queue.qsize(), queue.total_items, durable], [2, 2, [True]])
+        self.assertEqual(queue.get(), "first")
+        queue.purge()
+        self.assertTrue(queue.empty())
+        self.assertRaises(Empty, queue.get)
+
+    def testStorageRoutes(self):
+        '''
+        Test that queues are stored by the backend their name matches
+        '''
+        storage = [{"cache.*": "memory"}, {"*": "log"}]
+        database = QueueCollection(self.path, storage=storage)
+        self.assertTrue(isinstance(database._backend("cache.pages"), MemoryBackend))
+        self.assertTrue(isinstance(database._backend("jobs"), LogBackend))
+        for key in ["cache.pages", "jobs"]:
+            database.put(key, key)
+        self.assertEqual(os.listdir(self.path), ["jobs.00000001.log"])
+        database.close()
+
+        database = QueueCollection(self.path, storage=storage)
+        database.recover()
+        self.assertEqual(list(database.get_queues()), ["jobs"])
+        self.assertEqual(database.get("cache.pages"), None)
+        self.assertEqual(database.get("jobs"), "jobs")
+        database.close()
+        self.assertRaises(QueueCollectionException, QueueCollection,
+            self.path, storage=[{"*": "tape"}])
+
+    def testSingleDirectoryScan(self):
+        '''
+        Test that recovering and purging queues lists the path only once
+        '''
+        names = ["queue %d" % value for value in range(20)]
+        database = QueueCollection(self.path)
+        for name in names: database.put(name, name)
+        database.close()
+
+        listed, listdir = [], os.listdir
+        def counted(path):
+            listed.append(path)
+            return listdir(path)
+        os.listdir = counted
+        try:
+            database = QueueCollection(self.path)
+            database.get("queue 0") # opens the first queue before a recovery
+            database.recover()
+            self.assertEqual([database.get(name) for name in names[1:]], names[1:])
+            database.put("new queue", "value")
+            for name in names[:10]: database.delete(name)
+        finally: os.listdir = listdir
+        self.assertEqual(listed, [self.path] * 2) # first use and recovery
+        self.assertEqual(PersistentQueue.find_queues(self.path),
+            set(names[10:] + ["new queue"]))
+        database.close()
+
+    def testPopCoalescing(self):
+        '''
+        Test that pops are only coalesced when not syncing every record
+        '''
+        for durability, coalesced in [("fsync-per-op", False), ("flush", True)]:
+            database = QueueCollection(self.path, durability=durability)
+            database.put(durability, "value")
+            self.assertEqual(database.get_queues(durability).coalesce_pops, coalesced)
+            database.close()
+
+#---------------------------------------------------------------------------#
+# Main
+#---------------------------------------------------------------------------#
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,25 @@
-import sys, unittest
+import sys, os, unittest, shutil, tempfile
 from mamba.collection import QueueCollection
+from mamba.scheduler import Scheduler
+
+class ManualScheduler(Scheduler):
+    ''' A scheduler that only runs work when told to '''
+
+    def __init__(self):
+        self.calls = []
+
+    def call_later(self, delay, method, *args):
+        self.calls.append((method, args))
+
+    def call_in_thread(self, method, callback, *args):
+        self.calls.append((lambda: callback(method(*args)), ()))
+
+    def call_from_thread(self, method, *args):
+        self.calls.append((method, args))
+
+    def run(self):
+        calls, self.calls = self.calls, []
+        for method, args in calls: method(*args)
 
 class SimpleQueueCollectionTest(unittest.TestCase):
     '''
@@ -8,11 +28,166 @@ class SimpleQueueCollectionTest(unittest.TestCase):
 
     def setUp(self):
         ''' Initializes the test environment '''
-        pass
+        self.path = tempfile.mkdtemp()
 
     def tearDown(self):
         ''' Cleans up the test environment '''
-        pass
+        shutil.rmtree(self.path)
+
+    def testPutAndGet(self):
+        '''
+        Test that values make it through the collection
+        '''
+        database = QueueCollection(self.path)
+        self.assertTrue(database.put("queue", "value"))
+        self.assertEqual(database.get("queue"), "value")
+        self.assertEqual(database.get("queue"), None)
+        self.assertEqual(database.get_statistic('get_hits'), 1)
+        self.assertEqual(database.get_statistic('get_misses'), 1)
+        database.close()
+
+    def testGroupCommit(self):
+        '''
+        Test that group commits are batched until the scheduler runs
+        '''
+        scheduler = ManualScheduler()
+        database = QueueCollection(self.path, durability="group-commit",
+            scheduler=scheduler)
+        durable = []
+        database.put("first", "value")
+        database.put("second", "value")
+        database.when_durable("first", lambda: durable.append("first"))
+        database.when_durable("second", lambda: durable.append("second"))
+        self.assertEqual(durable, [])
+        self.assertEqual(len(scheduler.calls), 1)
+
+        scheduler.run()
+        self.assertEqual(sorted(durable), ["first", "second"])
+        database.close()
+
+    def testRecovery(self):
+        '''
+        Test that every queue on disk is recovered up front
+        '''
+        database = QueueCollection(self.path)
+        for key in ["first", "second", "third.queue"]:
+            database.put(key, "value")
+        database.close()
+
+        for wait in [True, False]:
+            scheduler, ready = ManualScheduler(), []
+            database = QueueCollection(self.path, scheduler=scheduler)
+            database.recover(workers=2, wait=wait,
+                callback=lambda: ready.append(True))
+            self.assertEqual(sorted(database.queues), [] if not wait
+                else ["first", "second", "third.queue"])
+            self.assertEqual(database.get_queues("first"),
+                database.queues.get("first", None))
+            while scheduler.calls: scheduler.run()
+            self.assertEqual(sorted(database.queues),
+                ["first", "second", "third.queue"])
+            self.assertEqual(database.get_statistic('current_bytes'), 15)
+            self.assertEqual(ready, [True])
+            database.close()
+
+    def testLazyLoading(self):
+        '''
+        Test that a queue is replayed off the main thread when first used
+        '''
+        database = QueueCollection(self.path)
+        database.put("queue", "value")
+        database.close()
+
+        scheduler, ready = ManualScheduler(), []
+        database = QueueCollection(self.path, scheduler=scheduler)
+        database.when_ready("queue", lambda: ready.append("first"))
+        database.when_ready("queue", lambda: ready.append("second"))
+        self.assertEqual([ready, len(scheduler.calls)], [[], 1])
+
+        scheduler.run()
+        self.assertEqual(ready, ["first", "second"])
+        database.when_ready("queue", lambda: ready.append("third"))
+        self.assertEqual(ready, ["first", "second", "third"])
+        self.assertEqual(database.get("queue"), "value")
+        database.close()
+
+    def testOpenLogLimit(self):
+        '''
+        Test that idle queue logs are closed and reopened on demand
+        '''
+        database = QueueCollection(self.path, max_open_logs=2)
+        for key in ["first", "second", "third"]:
+            database.put(key, key)
+        self.assertEqual(list(database.open_logs), ["second", "third"])
+        self.assertTrue(database.queues["first"].suspended)
+        self.assertEqual(database.queues["first"].transactions, None)
+
+        self.assertEqual(database.get("first"), "first")
+        database.put("first", "again")
+        self.assertEqual(list(database.open_logs), ["third", "first"])
+        self.assertTrue(database.queues["second"].suspended)
+        self.assertEqual(database.get_statistic('log_cache_hits'), 4)
+        self.assertEqual(database.get_statistic('log_cache_misses'), 4)
+        self.assertEqual(database.get_statistic('open_logs'), 2)
+
+        database.queues["third"].compacting = True # busy, so skipped
+        database.put("second", "again")
+        self.assertEqual(list(database.open_logs), ["third", "second"])
+        self.assertTrue(database.queues["first"].suspended)
+        database.put("fourth", "fourth")
+        self.assertEqual(list(database.open_logs), ["third", "fourth"])
+        database.queues["fourth"].compacting = True # every other log busy
+        database.put("first", "last")
+        self.assertEqual(list(database.open_logs), ["third", "fourth", "first"])
+        for key in ["third", "fourth"]:
+            database.queues[key].compacting = False
+        database.put("second", "last")
+        self.assertEqual(list(database.open_logs), ["first", "second"])
+        database.close()
+
+        database = QueueCollection(self.path)
+        self.assertEqual([database.get(key) for key in
+            ["first", "second", "third"]], ["again", "second", "third"])
+        database.close()
+
+    def testBackgroundPurge(self):
+        '''
+        Test that a deleted queue is purged off the main thread
+        '''
+        scheduler, ready = ManualScheduler(), []
+        database = QueueCollection(self.path, scheduler=scheduler)
+        database.put("queue", "value")
+        self.assertTrue(database.delete("queue"))
+        self.assertFalse(database.delete("queue"))
+        self.assertEqual(database.get_statistic('current_bytes'), 0)
+        self.assertEqual(database.get_statistic('purges_in_progress'), 1)
+        self.assertTrue(os.listdir(self.path))
+
+        database.when_ready("queue", lambda: ready.append(True))
+        self.assertEqual([ready, len(scheduler.calls)], [[], 1])
+        scheduler.run()
+        self.assertEqual(database.get_statistic('purges_in_progress'), 0)
+        self.assertEqual(os.listdir(self.path), [])
+        scheduler.run() # the queue is recreated once the purge is done
+        self.assertEqual(ready, [True])
+        self.assertEqual(database.get("queue"), None)
+        database.close()
+
+    def testCompactionTrigger(self):
+        '''
+        Test that a queue log is compacted once it is mostly dead
+        '''
+        database = QueueCollection(self.path, compact_ratio=1.0,
+            compact_min_size=0)
+        for value in range(10):
+            database.put("queue", "value" * 10)
+        for value in range(6):
+            database.get("queue")
+        self.assertEqual(database.get_statistic('log_compactions'), 1)
+        queue = database.get_queues("queue")
+        self.assertEqual(queue.qsize(), 4)
+        self.assertTrue(queue.log_size < queue.live_size * 2)
+        database.close()
 
 #---------------------------------------------------------------------------#
 # Main
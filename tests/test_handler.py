@@ -1,5 +1,8 @@
-import sys, unittest
-from mamba.handler import Handler
+import sys, os, unittest, shutil, tempfile
+from mamba.handler import Handler, Messages
+from mamba.collection import QueueCollection
+from mamba.attr import AttributeDict
+from test_collection import ManualScheduler
 
 class SimpleHandlerTest(unittest.TestCase):
     '''
@@ -8,11 +11,251 @@ class SimpleHandlerTest(unittest.TestCase):
 
     def setUp(self):
         ''' Initializes the test environment '''
-        pass
+        self.path = tempfile.mkdtemp()
+        self.scheduler = ManualScheduler()
+        self.database = QueueCollection(self.path,
+            durability="group-commit", scheduler=self.scheduler)
+        self.handler = Handler(self.database, AttributeDict())
+        self.responses = []
+        self.callbacks = {'send':self.responses.append, 'exit':lambda: None}
 
     def tearDown(self):
         ''' Cleans up the test environment '''
-        pass
+        self.database.close()
+        shutil.rmtree(self.path)
+
+    def testStoredAfterGroupCommit(self):
+        '''
+        Test that STORED (and what follows it) waits on the group commit
+        '''
+        self.assertEqual(self.handler.process("set queue 0 0 5", self.callbacks), 5)
+        self.handler.process_data(["value"], "\r\n", self.callbacks)
+        self.handler.process("get empty", self.callbacks)
+        self.assertEqual(self.responses, [])
+
+        while self.scheduler.calls: self.scheduler.run()
+        self.assertEqual(self.responses, [
+            Messages.set_response_success, Messages.get_response_empty])
+
+    def testCommandsWaitOnQueueReplay(self):
+        '''
+        Test that commands behind a replaying queue keep their order
+        '''
+        self.handler.process("set queue 0 0 5", self.callbacks)
+        self.handler.process_data(["value"], "\r\n", self.callbacks)
+        while self.scheduler.calls: self.scheduler.run()
+
+        for line in ["get other", "get queue", "get queue"]:
+            self.handler.process(line, self.callbacks)
+        self.assertEqual(len(self.responses), 1)
+
+        self.scheduler.run()
+        self.assertEqual(self.responses[1:], [Messages.get_response_empty,
+            Messages.get_response % ("queue", 0, 5, "value"),
+            Messages.get_response_empty])
+
+    def testBinaryData(self):
+        '''
+        Test that data blocks are stored as they are, line breaks and all
+        '''
+        value = "line\r\nbreak\x00" * 1000
+        self.handler.process("set queue 7 0 %d" % len(value), self.callbacks)
+        self.handler.process_data([value[:10], value[10:]], "\r\n", self.callbacks)
+        self.handler.process("set queue 0 0 2", self.callbacks)
+        self.handler.process_data(["ok"], "XX", self.callbacks)
+        while self.scheduler.calls: self.scheduler.run()
+
+        self.handler.process("get queue", self.callbacks)
+        self.assertEqual(self.responses, [Messages.set_response_success,
+            Messages.set_client_data_error,
+            Messages.get_response % ("queue", 7, len(value), value)])
+
+    def testMultipleKeyGet(self):
+        '''
+        Test that a get of several queues answers for all of them at once
+        '''
+        for key in ["first", "third"]:
+            self.handler.process("set %s 0 0 %d" % (key, len(key)), self.callbacks)
+            self.handler.process_data([key], "\r\n", self.callbacks)
+        while self.scheduler.calls: self.scheduler.run()
+        del self.responses[:]
+
+        self.handler.process("get first second third first", self.callbacks)
+        self.assertEqual(self.responses, []) # waiting on the new queue
+        self.scheduler.run()
+        self.assertEqual(self.responses, [
+            Messages.get_response_value % ("first", 0, 5, "first") +
+            Messages.get_response % ("third", 0, 5, "third")])
+        self.assertEqual(self.handler.statistics.get_requests, 4)
+
+    def testBatchGet(self):
+        '''
+        Test that a batch get takes several messages with one pop record
+        '''
+        values = ["item %d" % value for value in range(5)]
+        for value in values:
+            self.handler.process("set queue 0 0 6", self.callbacks)
+            self.handler.process_data([value], "\r\n", self.callbacks)
+        while self.scheduler.calls: self.scheduler.run()
+        del self.responses[:]
+        queue = self.database.get_queues("queue")
+        previous = queue.log_size
+
+        self.handler.process("get queue/n=3 queue/n=3", self.callbacks)
+        while self.scheduler.calls: self.scheduler.run()
+        self.assertEqual(self.responses, ["".join(
+            Messages.get_response_value % ("queue/n=3", 0, 6, value)
+            for value in values) + Messages.get_response_empty])
+        self.assertEqual(queue.log_size, previous + 13) # one pops record
+        self.assertEqual(self.database.get_statistic("get_misses"), 0)
+        self.assertEqual(Messages.parse_batch("queue/n=0"), ("queue/n=0", 1))
+
+    def testExpiredMessages(self):
+        '''
+        Test that single and batch gets skip over expired messages
+        '''
+        for value, expire in [("gone", 1), ("kept", 0), ("gone", 1),
+            ("gone", 1), ("also", 0)]:
+            self.handler.process("set queue 0 %d 4" % expire, self.callbacks)
+            self.handler.process_data([value], "\r\n", self.callbacks)
+        while self.scheduler.calls: self.scheduler.run()
+        del self.responses[:]
+
+        for key in ["queue", "queue/n=5"]:
+            self.handler.process("get " + key, self.callbacks)
+        while self.scheduler.calls: self.scheduler.run()
+        self.assertEqual(self.responses, [
+            Messages.get_response % ("queue", 0, 4, "kept"),
+            Messages.get_response % ("queue/n=5", 0, 4, "also")])
+        self.assertEqual(self.handler.expirations, {"queue": 3})
+        self.assertTrue("STAT queue_queue_expired_items 3\r" in
+            self.handler._get_queue_statistics())
+
+    def testPipelinedSets(self):
+        '''
+        Test that noreply sets are stored with one append per queue
+        '''
+        for key in ["first", "second"]:
+            self.handler.process("set %s 0 0 5" % key, self.callbacks)
+            self.handler.process_data(["start"], "\r\n", self.callbacks)
+        while self.scheduler.calls: self.scheduler.run()
+        del self.responses[:]
+        queues = [self.database.get_queues(key) for key in ["first", "second"]]
+
+        sets = [("first", "one"), ("second", "two"), ("first", "six"),
+            ("second", "ten")]
+        for key, value in sets:
+            self.assertEqual(self.handler.process(
+                "set %s 0 0 3 noreply" % key, self.callbacks), 3)
+            self.handler.process_data([value], "\r\n", self.callbacks)
+        self.handler.process("set first 0 0 3", self.callbacks)
+        self.handler.process_data(["end"], "\r\n", self.callbacks)
+        self.assertEqual([len(queue.pending) for queue in queues], [1, 1])
+        self.assertEqual(self.responses, [])
+
+        while self.scheduler.calls: self.scheduler.run()
+        self.assertEqual(self.responses, [Messages.set_response_success])
+        self.handler.process("set second 0 0 4 noreply", self.callbacks)
+        self.handler.process_data(["last"], "\r\n", self.callbacks)
+        self.handler.flush(self.callbacks)
+        self.assertEqual(queues[1].qsize(), 4)
+
+        self.handler.process("get first/n=9 second/n=9", self.callbacks)
+        while self.scheduler.calls: self.scheduler.run()
+        self.assertEqual(self.responses[1:], ["".join(
+            [Messages.get_response_value % ("first/n=9", 0, len(value), value)
+                for value in ["start", "one", "six", "end"]] +
+            [Messages.get_response_value % ("second/n=9", 0, len(value), value)
+                for value in ["start", "two", "ten", "last"]]) +
+            Messages.get_response_empty])
+
+    def testStatistics(self):
+        '''
+        Test that the server statistics are reported with queues present
+        '''
+        for value in ["first", "other"]:
+            self.handler.process("set queue 0 0 5", self.callbacks)
+            self.handler.process_data([value], "\r\n", self.callbacks)
+        while self.scheduler.calls: self.scheduler.run()
+        del self.responses[:]
+
+        self.handler.process("stats", self.callbacks)
+        statistics = self.responses[0]
+        for line in ["STAT curr_items 2\r", "STAT cmd_set 2\r",
+            "STAT log_cache_misses 0\r", "STAT purges_in_progress 0\r",
+            "STAT queue_queue_items 2\r"]:
+            self.assertTrue(line in statistics, line)
+        self.assertTrue(statistics.endswith(Messages.get_response_empty))
+
+    def testCompressionStatistics(self):
+        '''
+        Test that the queue statistics report the compression of a queue
+        '''
+        self.database.close()
+        self.database = QueueCollection(self.path, compress_threshold=64,
+            durability="group-commit", scheduler=self.scheduler)
+        self.handler = Handler(self.database, AttributeDict())
+        self.handler.process("set queue 0 0 1000", self.callbacks)
+        self.handler.process_data(["x" * 1000], "\r\n", self.callbacks)
+        while self.scheduler.calls: self.scheduler.run()
+        queue = self.database.get_queues("queue")
+        self.assertTrue(queue.compressed_out < queue.compressed_in)
+
+        statistics = self.handler._get_queue_statistics()
+        ratio = float(queue.compressed_in) / queue.compressed_out
+        self.assertTrue("STAT queue_queue_compression_ratio %0.2f\r" % ratio
+            in statistics)
+        self.assertTrue("STAT queue_queue_compression_time " in statistics)
+        self.assertTrue("STAT queue_queue_expired_items 0\r" in statistics)
+
+    def testDeletePurgesQueue(self):
+        '''
+        Test that delete answers straight away and purges in the background
+        '''
+        self.database.close()
+        self.database = QueueCollection(self.path, durability="group-commit",
+            scheduler=self.scheduler, segment_size=64, max_open_logs=1)
+        self.handler = Handler(self.database, AttributeDict())
+        for key in ["queue"] * 5 + ["other"]: # other suspends queue
+            self.handler.process("set %s 0 0 10" % key, self.callbacks)
+            self.handler.process_data(["0123456789"], "\r\n", self.callbacks)
+            while self.scheduler.calls: self.scheduler.run()
+        del self.responses[:]
+        files = lambda: sorted(entry for entry in os.listdir(self.path)
+            if entry.startswith("queue."))
+        self.assertTrue("queue.checkpoint" in files())
+        self.assertTrue(len(files()) > 2)
+
+        self.handler.process("delete queue 0", self.callbacks)
+        self.handler.process("get queue", self.callbacks)
+        self.assertEqual(self.responses, [Messages.delete_response])
+        self.assertEqual(self.database.get_statistic('purges_in_progress'), 1)
+        self.assertTrue(files())
+
+        self.scheduler.run() # the purge
+        self.assertEqual(self.database.get_statistic('purges_in_progress'), 0)
+        self.assertEqual(files(), [])
+        while self.scheduler.calls: self.scheduler.run()
+        self.assertEqual(self.responses[1:], [Messages.get_response_empty])
+
+    def testCommandParsing(self):
+        '''
+        Test that command lines are checked like the protocol expects
+        '''
+        parse = Messages.parse_command
+        self.assertEqual(parse("get a  queue"), ("_get", ["a", "queue"]))
+        self.assertEqual(parse("set jobs 1 0 5"), ("_set", ["jobs", "1", "0", "5"]))
+        self.assertEqual(parse("set jobs 1 0 5 noreply"),
+            ("_set", ["jobs", "1", "0", "5", True]))
+        self.assertEqual(parse("delete jobs 0\n"), ("_delete", ["jobs", "0"]))
+        self.assertEqual(parse("stats"), ("_statistics", ()))
+        for line in ["get", "get " + "k" * 251, "set jobs 0 0", "set jobs 0 -1 5",
+            "delete jobs", "stats now", "GET jobs", "get a\nb",
+            "set jobs noreply", "delete jobs 0 noreply"]:
+            self.assertEqual(parse(line), None)
+
+        self.handler.process("flush_all", self.callbacks)
+        self.assertEqual(self.responses, [Messages.unknown_response])
 
 #---------------------------------------------------------------------------#
 # Main
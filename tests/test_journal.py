@@ -0,0 +1,129 @@
+import sys, os, unittest, shutil, tempfile
+from Queue import Empty
+from mamba.journal import Journal
+from mamba.collection import QueueCollection
+
+class SimpleJournalTest(unittest.TestCase):
+    '''
+    The unit tests for the mamba.journal module
+    '''
+
+    def setUp(self):
+        ''' Initializes the test environment '''
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        ''' Cleans up the test environment '''
+        shutil.rmtree(self.path)
+
+    def testJournalReplay(self):
+        '''
+        Test that every queue is rebuilt from the shared journal
+        '''
+        journal = Journal(self.path)
+        first, second = journal.queue("first"), journal.queue("second")
+        for value in ["one", "two\x01\x00", "three"]:
+            first.put(value)
+            second.put(value.upper())
+        self.assertEqual([first.get(), second.get()], ["one", "ONE"])
+        journal.close()
+
+        journal = Journal(self.path)
+        self.assertEqual(journal.names(), set(["first", "second"]))
+        first, second = journal.queue("first"), journal.queue("second")
+        self.assertEqual(first.initial_bytes, len("two\x01\x00three"))
+        self.assertEqual([first.get(), second.get()], ["two\x01\x00", "TWO\x01\x00"])
+        second.purge()
+        journal.close()
+
+        journal = Journal(self.path)
+        self.assertEqual(journal.names(), set(["first"]))
+        self.assertEqual(journal.queue("first").get(), "three")
+        self.assertRaises(Empty, journal.queue("second").get)
+        journal.close()
+
+    def testSegmentRetirement(self):
+        '''
+        Test that consumed journal segments are removed and replay skips them
+        '''
+        journal = Journal(self.path, segment_size=64)
+        journal.relocate_ratio = 0 # only remove fully consumed segments
+        first, second = journal.queue("first"), journal.queue("second")
+        for value in range(20):
+            first.put("item %08d" % value)
+        second.put("pinned")
+        head = journal.indexes["first"][15][0]
+        for value in range(15):
+            first.get()
+        self.assertEqual(min(journal.segments), head)
+        self.assertEqual(journal.log_size, sum(os.path.getsize(
+            os.path.join(self.path, entry)) for entry in os.listdir(self.path)))
+        journal.close()
+
+        journal = Journal(self.path, segment_size=64)
+        expected = ["item %08d" % value for value in range(15, 20)]
+        first = journal.queue("first")
+        self.assertEqual([first.get() for _ in expected], expected)
+        self.assertEqual(journal.queue("second").get(), "pinned")
+        journal.close()
+
+    def testIdleItemRelocation(self):
+        '''
+        Test that an unread item does not keep the segments after it
+        '''
+        journal = Journal(self.path, segment_size=256)
+        idle, busy = journal.queue("idle"), journal.queue("busy")
+        idle.put("waiting")
+        for value in range(1000):
+            if value == 500: idle.put("later")
+            busy.put("item %04d" % value)
+            if value % 2: busy.get()
+        self.assertTrue(len(journal.segments) < 100)
+        self.assertEqual(journal.log_size, sum(os.path.getsize(
+            os.path.join(self.path, entry)) for entry in os.listdir(self.path)))
+        journal.close()
+
+        journal = Journal(self.path, segment_size=256)
+        idle, busy = journal.queue("idle"), journal.queue("busy")
+        self.assertEqual([idle.get(), idle.get()], ["waiting", "later"])
+        self.assertEqual([busy.get() for _ in range(500)],
+            ["item %04d" % value for value in range(500, 1000)])
+        journal.close()
+
+    def testCollectionStorage(self):
+        '''
+        Test that the collection can keep every queue in the journal
+        '''
+        database = QueueCollection(self.path, storage="journal")
+        for key in ["first", "second"]:
+            database.put(key, "value")
+        database.close()
+        self.assertEqual(len(os.listdir(self.path)), 1)
+
+        database = QueueCollection(self.path, storage="journal")
+        database.recover()
+        self.assertEqual(sorted(database.queues), ["first", "second"])
+        self.assertEqual(database.get_statistic('current_bytes'), 10)
+        self.assertEqual(database.get("second"), "value")
+        database.close()
+
+    def testDeleteAfterRestart(self):
+        '''
+        Test that a queue unused since a restart can still be deleted
+        '''
+        database = QueueCollection(self.path, storage="journal")
+        database.put_many("queue", ["one", "two"])
+        database.close()
+
+        database = QueueCollection(self.path, storage="journal")
+        self.assertTrue(database.delete("queue"))
+        self.assertFalse(database.delete("missing"))
+        self.assertEqual(database.get_statistic('current_bytes'), 0)
+        self.assertEqual(database.get_many("queue", 10), [])
+        database.close()
+
+#---------------------------------------------------------------------------#
+# Main
+#---------------------------------------------------------------------------#
+if __name__ == "__main__":
+    unittest.main()
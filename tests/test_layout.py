@@ -0,0 +1,69 @@
+import sys, os, unittest, shutil, tempfile
+from mamba.layout import SpoolLayout
+from mamba.collection import QueueCollection
+from mamba.errors import QueueCollectionException
+
+class SimpleSpoolLayoutTest(unittest.TestCase):
+    '''
+    The unit tests for the mamba.layout module
+    '''
+
+    def setUp(self):
+        ''' Initializes the test environment '''
+        self.path = tempfile.mkdtemp()
+        self.paths = [os.path.join(self.path, disk) for disk in "abc"]
+
+    def tearDown(self):
+        ''' Cleans up the test environment '''
+        shutil.rmtree(self.path)
+
+    def testPlacement(self):
+        '''
+        Test that queues are spread out and mostly stay put on a new path
+        '''
+        names = ["queue %d" % value for value in range(300)]
+        layout = SpoolLayout(self.paths[:2])
+        placed = dict((name, layout.shard(name)) for name in names)
+        self.assertEqual(set(placed.values()), set(self.paths[:2]))
+
+        layout = SpoolLayout(os.pathsep.join(self.paths))
+        moved = [name for name in names if layout.shard(name) != placed[name]]
+        self.assertTrue(all(layout.shard(name) == self.paths[2] for name in moved))
+        self.assertTrue(50 < len(moved) < 150)
+        self.assertRaises(QueueCollectionException, SpoolLayout, [])
+
+    def testFanout(self):
+        '''
+        Test that queue logs are fanned out over hashed subdirectories
+        '''
+        layout = SpoolLayout(self.paths, fanout=256)
+        directory = layout.directory("jobs")
+        self.assertEqual(os.path.dirname(directory), layout.shard("jobs"))
+        self.assertEqual(len(os.path.basename(directory)), 2)
+        self.assertEqual(len(layout.directories()), 3 * 256)
+        self.assertTrue(directory in layout.directories(layout.shard("jobs")))
+        self.assertEqual(SpoolLayout(self.paths).directory("jobs"),
+            layout.shard("jobs"))
+
+    def testShardedCollection(self):
+        '''
+        Test that queues on several paths are recovered from all of them
+        '''
+        names = ["queue %d" % value for value in range(20)]
+        database = QueueCollection(self.paths[:2], fanout=16)
+        for name in names: database.put(name, name)
+        database.close()
+        for path in self.paths[:2]:
+            self.assertEqual(len(os.listdir(path)), 16)
+
+        database = QueueCollection(self.paths, fanout=16)
+        database.recover()
+        self.assertEqual(sorted(database.get_queues()), sorted(names))
+        self.assertEqual([database.get(name) for name in names], names)
+        database.close()
+
+#---------------------------------------------------------------------------#
+# Main
+#---------------------------------------------------------------------------#
+if __name__ == "__main__":
+    unittest.main()
@@ -1,202 +1,366 @@
-'''
-'''
-import os, time
-from struct import pack, unpack
-from Queue import Queue
+import sys, os, unittest, shutil, tempfile, threading
+from mamba.persistent import PersistentQueue, SynchronizedQueue
 from mamba.errors import TransactionLogException
 
-#---------------------------------------------------------------------------#
-# Logging
-#---------------------------------------------------------------------------#
-import logging
-_logger = logging.getLogger("mamba.queue")
-
-#---------------------------------------------------------------------------#
-# Local helpers
-#---------------------------------------------------------------------------#
-def file_iterator(fd):
-    ''' Simply helper to make code cleaner '''
-    while True:
-        value = fd.read(1)
-        if not value: break
-        yield value
-
-#---------------------------------------------------------------------------#
-# Class definitions
-#---------------------------------------------------------------------------#
-class PersistentQueue(Queue):
+class SimplePersistentQueueTest(unittest.TestCase):
     '''
-    PersistentQueue is a subclass of Python synchronized class. It adds a 
-    transactional log to the in-memory Queue, which enables quickly rebuilding
-    the Queue in the event of a sever outage.
+    The unit tests for the mamba.persistent module
     '''
-    __max_size = 16 * (1024**2) # 16 MB
 
-    __trx_cmd_push = "\x00"
-    __trx_cmd_pop  = "\x01"
-    __trx_push     = "\x00%s%s"
-    __trx_pop      = "\x01"
+    def getLogSize(self, name):
+        ''' Helper to total up the log segments of a queue '''
+        return sum(os.path.getsize(os.path.join(self.path, entry))
+            for entry in os.listdir(self.path) if entry.startswith(name)
+            and not entry.endswith(".checkpoint"))
 
-    def __init__(self, persistence_path, queue_name):
-        '''
-        Create a new PersistentQueue at +persistence_path+/+queue_name+.
-        If a queue log exists at that path, the Queue will be loaded from
-        disk before being available for use.
+    def setUp(self):
+        ''' Initializes the test environment '''
+        self.path = tempfile.mkdtemp()
 
-        :param persistence_path: The path to the persistence directory
-        :param queue_name: The name of the queue
-        '''
-        self.path = persistence_path
-        self.name = queue_name
-        self.log_path = os.path.join(self.path, self.name)
-        self.total_items = 0
-        Queue.__init__(self, 0)
-        self.initial_bytes = self._replay_transactions()
+    def tearDown(self):
+        ''' Cleans up the test environment '''
+        shutil.rmtree(self.path)
 
-    def put(self, value, log=True):
+    def testQueueReplay(self):
         '''
-        Pushes ``value`` to the queue. By default, ``put`` will write to the
-        transactional log. Set ``log`` to ``False`` to override this behaviour.
-
-        :param value: The value to queue up
-        :param log: Set to True to log to the transaction log, False otherwise
-        :return: void
+        Test that the queue is rebuilt from its transaction log
         '''
-        if log:
-            self._log_exists_or_throw(log)
-            size = pack("I", len(value))
-            self._transaction(self.__trx_push % (size, value))
-        self.total_items += 1
-        Queue.put(self, value)
+        queue = PersistentQueue(self.path, "replay")
+        for value in ["first", "second\x01\x00", "third"]:
+            queue.put(value)
+        self.assertEqual(queue.get(), "first")
+        queue.close()
 
-    def get(self, log = True):
-        '''
-        Retrieve the next element off the queue
+        queue = PersistentQueue(self.path, "replay")
+        self.assertEqual(queue.qsize(), 2)
+        self.assertEqual(queue.initial_bytes, len("second\x01\x00third"))
+        self.assertEqual(queue.get(), "second\x01\x00")
+        queue.put("fourth")
+        queue.close()
 
-        :param log: Set to True to log to the transaction log, False otherwise
-        :return: The next item off of the queue
-        '''
-        self._log_exists_or_throw(log)
-        value = Queue.get(self, log)
-        if log: self._transaction(self.__trx_pop)
-        return value
+        queue = PersistentQueue(self.path, "replay")
+        self.assertEqual([queue.get(), queue.get()], ["third", "fourth"])
+        queue.close()
 
-    def close(self):
+    def testIncompleteRecordReplay(self):
         '''
-        Finish all writes to this queue's transaction log file
-        and close it.
+        Test that a torn record at the end of the log is ignored
+        '''
+        queue = PersistentQueue(self.path, "torn")
+        queue.put("complete")
+        queue.close()
+        with open(queue._segment_path(queue.active), "ab") as log:
+            log.write("\x00\xff\x00\x00\x00partial")
+
+        queue = PersistentQueue(self.path, "torn")
+        self.assertEqual(queue.qsize(), 1)
+        queue.put("after")
+        queue.close()
 
-        :return: void
+        queue = PersistentQueue(self.path, "torn")
+        self.assertEqual([queue.get(), queue.get()], ["complete", "after"])
+        queue.close()
+
+    def testCorruptRecordTruncated(self):
+        '''
+        Test that a record failing its checksum cuts the log off there
         '''
-        # TODO find a way to do this without another lock?
-        _logger.debug("Closing the queue %s" % self.name)
-        temp = self.transactions
-        self.transactions = None
-        temp.close()
+        queue = PersistentQueue(self.path, "corrupt")
+        queue.put("complete")
+        queue.put("corrupt")
+        queue.close()
+        path = queue._segment_path(queue.active)
+        with open(path, "rb+") as log:
+            log.seek(-6, os.SEEK_END)
+            log.write("X") # flip a payload byte of the last record
+            log.seek(0, os.SEEK_END)
+            log.write("\x01\x02garbage")
+        size = queue._record_end(queue.queue[0])
 
-    def purge(self):
+        queue = PersistentQueue(self.path, "corrupt")
+        self.assertEqual([queue.qsize(), queue.active], [1, 1])
+        self.assertEqual(os.path.getsize(path), size)
+        queue.put("after")
+        queue.close()
+
+        queue = PersistentQueue(self.path, "corrupt")
+        self.assertEqual([queue.get(), queue.get()], ["complete", "after"])
+        queue.close()
+
+    def testGroupCommit(self):
+        '''
+        Test that group committed records only reach the log on commit
         '''
-        Purge the entire transaction log for this queue
+        queue = PersistentQueue(self.path, "group", durability="group-commit")
+        durable, empty = [], self.getLogSize("group")
+        queue.put("first")
+        queue.put("second")
+        queue.when_durable(lambda: durable.append(True))
+        self.assertEqual(self.getLogSize("group"), empty)
+        self.assertEqual(durable, [])
 
-        :return: void
+        queue.commit()
+        self.assertEqual(durable, [True])
+        self.assertEqual(self.getLogSize("group"), queue.log_size)
+        queue.close()
+
+        queue = PersistentQueue(self.path, "group")
+        self.assertEqual(queue.qsize(), 2)
+        queue.close()
+
+    def testCompaction(self):
+        '''
+        Test that compacting keeps the live items and later records
         '''
-        _logger.debug("Purging the entire transaction for %s" % self.name)
-        self.close()
-        if os.path.exists(self.log_path):
-            os.remove(self.log_path)
+        queue = PersistentQueue(self.path, "compact")
+        for value in range(100):
+            queue.put("item %d" % value)
+        for value in range(90):
+            queue.get()
+        self.assertTrue(queue.needs_compaction(2.0, 0))
+        previous = queue.log_size
 
-    # --------------------------------------------------------------- #
-    # Private Methods
-    # --------------------------------------------------------------- #
-    def _open_log(self):
+        state = queue.begin_compaction()
+        self.assertFalse(queue.needs_compaction(2.0, 0))
+        queue.put("item 100")
+        queue.get()
+        self.assertTrue(queue.finish_compaction(queue.write_compaction(state)))
+        self.assertTrue(queue.log_size < previous)
+        self.assertEqual(queue.log_size, self.getLogSize("compact"))
+        queue.put("item 101")
+        queue.close()
+
+        queue = PersistentQueue(self.path, "compact")
+        expected = ["item %d" % value for value in range(91, 102)]
+        self.assertEqual([queue.get() for _ in expected], expected)
+        self.assertEqual(queue.qsize(), 0)
+        queue.close()
+
+    def testSegmentRetirement(self):
+        '''
+        Test that consumed segments are removed and replay skips them
         '''
-        Helper method to open a new log file and initialize values
+        queue = PersistentQueue(self.path, "segments", segment_size=64)
+        for value in range(20):
+            queue.put("item %08d" % value)
+        self.assertTrue(len(queue.segments) > 4)
+        head = queue.queue[15][0]
+        for value in range(15):
+            queue.get()
+        self.assertEqual(min(queue.segments), head)
+        self.assertEqual(queue.log_size, self.getLogSize("segments"))
+        queue.close()
 
-        :return: void
+        queue = PersistentQueue(self.path, "segments", segment_size=64)
+        expected = ["item %08d" % value for value in range(15, 20)]
+        self.assertEqual([queue.get() for _ in expected], expected)
+        queue.close()
+
+    def testLegacyLog(self):
+        '''
+        Test that a log from before segments is replayed and retired
         '''
-        fd = os.open(self.log_path, os.O_RDWR|os.O_CREAT)
-        self.transactions = os.fdopen(fd, "rb+")
-        self.log_size = os.path.getsize(self.log_path)
+        with open(os.path.join(self.path, "legacy"), "wb") as log:
+            log.write("\x00\x03\x00\x00\x00one\x00\x03\x00\x00\x00two\x01")
+
+        queue = PersistentQueue(self.path, "legacy")
+        self.assertEqual(queue.qsize(), 1)
+        queue.put("three")
+        self.assertEqual(queue.get(), "two")
+        self.assertFalse(os.path.exists(os.path.join(self.path, "legacy")))
+        queue.close()
+
+        queue = PersistentQueue(self.path, "legacy")
+        self.assertEqual([queue.qsize(), queue.get()], [1, "three"])
+        queue.close()
 
-    def _rotate_log(self):
+    def testCoalescedPops(self):
         '''
-        Helper method to quickly rename a file to
-        `filename.timestamp`
+        Test that coalesced pops are logged as one record on commit
+        '''
+        queue = PersistentQueue(self.path, "pops", coalesce_pops=True)
+        for value in range(10):
+            queue.put("item %d" % value)
+        previous = queue.log_size
+        self.assertEqual([queue.get() for _ in range(6)][-1], "item 5")
+        self.assertEqual([queue.unlogged_pops, queue.log_size], [6, previous])
+        queue.commit()
+        self.assertEqual([queue.unlogged_pops, queue.log_size], [0, previous + 13])
+        queue.get()
+        queue.transactions.flush() # crash with the last pop unlogged
+        queue.transactions = None
+
+        queue = PersistentQueue(self.path, "pops")
+        self.assertEqual([queue.qsize(), queue.get()], [4, "item 6"])
+        queue.close()
 
-        :return: void
+    def testPreallocatedLog(self):
+        '''
+        Test that a preallocated log replays up to its last record
         '''
-        # guard with a reader writer lock?
-        _logger.debug("Rotating log for queue %s" % self.name)
-        self.transactions.close()
-        os.rename(self.log_path, "%s.%s" % (self.log_path, time.time()))
-        self._open_log()
+        queue = PersistentQueue(self.path, "prealloc", preallocate=4096)
+        for value in ["first", "second\x00\x00"]:
+            queue.put(value)
+        self.assertEqual(self.getLogSize("prealloc"), 4096)
+        queue.transactions.flush() # crash without trimming the log
+        queue.transactions = None
 
-    def _log_exists_or_throw(self, test=True):
+        queue = PersistentQueue(self.path, "prealloc", preallocate=4096)
+        self.assertEqual([queue.qsize(), queue.get()], [2, "first"])
+        queue.put("third")
+        queue.close()
+        self.assertEqual(queue.log_size, self.getLogSize("prealloc"))
+
+        queue = PersistentQueue(self.path, "prealloc")
+        self.assertEqual([queue.get(), queue.get()], ["second\x00\x00", "third"])
+        queue.close()
+
+    def testCompressedPayloads(self):
+        '''
+        Test that large payloads are compressed in the log
         '''
-        Helper to make the log checking look cleaner
+        values = ['{"job": "%s"}' % ("x" * 1000), "small"]
+        for payloads in ["memory", "disk"]:
+            queue = PersistentQueue(self.path, payloads, payloads=payloads,
+                compress_threshold=64)
+            for value in values: queue.put(value)
+            self.assertTrue(queue.log_size < 200)
+            self.assertEqual(queue.compressed_in, len(values[0]))
+            self.assertTrue(queue.compressed_out < 100)
+            queue.close()
 
-        :return: void
+            queue = PersistentQueue(self.path, payloads, payloads=payloads)
+            self.assertEqual(queue.initial_bytes, sum(map(len, values)))
+            self.assertEqual([queue.get(), queue.get()], values)
+            queue.close()
+
+    def testCompressedCompaction(self):
+        '''
+        Test that popped compressed records count as dead log space and
+        that compacting copies the records instead of compressing again
         '''
-        if test and not self.transactions:
-            _logger.error("Transaction log not available for queue %s" % self.name)
-            raise TransactionLogException("Transaction log not available")
+        value = '{"job": "%s"}' % ("x" * 1000)
+        queue = PersistentQueue(self.path, "packed", compress_threshold=64)
+        for _ in range(10): queue.put(value)
+        self.assertEqual(queue.live_size, queue.log_size - 8) # the log header
+        for _ in range(8): queue.get()
+        self.assertTrue(queue.needs_compaction(2.0, 0))
+        compressed = [queue.compressed_in, queue.compressed_out]
+
+        state = queue.begin_compaction()
+        self.assertTrue(queue.finish_compaction(queue.write_compaction(state)))
+        self.assertEqual([queue.compressed_in, queue.compressed_out], compressed)
+        self.assertEqual(queue.log_size, self.getLogSize("packed"))
+        self.assertFalse(queue.needs_compaction(0.5, 0))
+        queue.close()
 
-    def _read_command(self, fd):
+        queue = PersistentQueue(self.path, "packed")
+        self.assertEqual([queue.get(), queue.get(), queue.qsize()], [value, value, 0])
+        queue.close()
+
+    def testBatchedPuts(self):
+        '''
+        Test that a batch of puts is appended to the log in one write
         '''
-        Helper method to read a single command back out of the
-        transactions log
+        values = ["first", '{"job": "%s"}' % ("x" * 1000), "third"]
+        queue = PersistentQueue(self.path, "batch", payloads="disk",
+            durability="group-commit", compress_threshold=64)
+        queue.put("zeroth")
+        queue.put_many(values)
+        self.assertEqual(len(queue.pending), 2)
+        self.assertEqual(queue.get(), "zeroth")
+        self.assertEqual([queue.get() for _ in values], values)
+        queue.put_many(values)
+        queue.close()
+
+        queue = PersistentQueue(self.path, "batch", payloads="disk")
+        self.assertEqual([queue.get() for _ in values], values)
+        queue.close()
 
-        :param fd: The file descriptor to read from
-        :return: A tuple of the read command and size
+    def testDiskPayloads(self):
         '''
-        import pdb;pdb.set_trace()
-        raw_size = fd.read(4)
-        if not raw_size:
-            return (0, None)
-        size = unpack("I", raw_size) 
-        data = fd.read(size)
-        return (size, data)
+        Test that disk backed queues only keep an index in memory
+        '''
+        queue = PersistentQueue(self.path, "disk", payloads="disk",
+            durability="group-commit")
+        for value in ["first", "second", "third"]:
+            queue.put(value)
+        self.assertEqual(queue.queue[0][3], None)
+        self.assertEqual(queue.get(), "first")
+        queue.close()
+
+        queue = PersistentQueue(self.path, "disk", payloads="disk")
+        self.assertEqual([entry[3] for entry in queue.queue], [None, None])
+        self.assertEqual(queue.initial_bytes, len("secondthird"))
+        self.assertEqual([queue.get(), queue.get()], ["second", "third"])
+        queue.close()
 
-    def _replay_transactions(self):
+    def testReadsDoNotCommit(self):
+        '''
+        Test that reading records held for a group commit does not commit
         '''
-        Helper to make the log checking look cleaner
+        for payloads in ["disk", "spill"]:
+            queue = PersistentQueue(self.path, payloads, payloads=payloads,
+                durability="group-commit", memory_budget=20, spill_window=20)
+            values = ["item %04d" % value for value in range(10)]
+            queue.put(values[0])
+            queue.commit()
+            durable = []
+            for value in values[1:]: queue.put(value)
+            queue.when_durable(lambda: durable.append(True))
+            self.assertEqual([queue.get() for _ in range(4)], values[:4])
+            self.assertEqual([durable, len(queue.pending)], [[], 13])
+            queue.commit()
+            self.assertEqual([queue.get() for _ in range(6)], values[4:])
+            self.assertEqual(durable, [True])
+            queue.close()
 
-        :return: void
+    def testSpilledPayloads(self):
         '''
-        self._open_log()
-        bytes_read = 0
+        Test that spilling queues keep their ends in memory
+        '''
+        queue = PersistentQueue(self.path, "spill", payloads="spill",
+            memory_budget=20, spill_window=20)
+        values = ["item %04d" % value for value in range(10)]
+        for value in values:
+            queue.put(value)
+        resident = [entry[3] is not None for entry in queue.queue]
+        self.assertEqual(resident, [True] * 2 + [False] * 6 + [True] * 2)
+        self.assertEqual(queue.resident_size, 4 * len(values[0]))
 
-        _logger.debug("Reading back transaction log for queue %s" % self.name)
-        for cmd in file_iterator(self.transactions):
-            if cmd == self.__trx_cmd_push:
-                (size, data) = self._read_command(self.transactions)
-                if not data: continue
-                self.put(data, False)
-                bytes_read -= size
-            elif cmd == self.__trx_cmd_pop:
-                bytes_read -= len(self.get(False))
-            else:
-                _logger.warning("Invalid command(%s) in transaction log" % cmd)
-        _logger.debug("Finished reading back transaction log for queue %s" % self.name)
-        return bytes_read
+        self.assertEqual([queue.get() for _ in range(3)], values[:3])
+        resident = [entry[3] is not None for entry in queue.queue]
+        self.assertEqual(resident, [False] * 5 + [True] * 2)
+        self.assertEqual(queue.resident_size, 2 * len(values[0]))
+        self.assertEqual([queue.get() for _ in range(7)], values[3:])
+        queue.close()
 
-    def _transaction(self, data):
+    def testSynchronizedQueue(self):
+        '''
+        Test that a synchronized queue can be shared between threads
         '''
-        Helper method to write some data to the transaction
-        log file.
+        queue = SynchronizedQueue(self.path, "shared")
+        def producer():
+            for value in range(100): queue.put("value")
+        threads = [threading.Thread(target=producer) for _ in range(4)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        self.assertEqual(queue.qsize(), 400)
+        queue.close()
+
+        queue = PersistentQueue(self.path, "shared")
+        self.assertEqual(queue.qsize(), 400)
+        queue.close()
 
-        :param data: The data to append to the log
-        :return: void
+    def testInvalidDurability(self):
         '''
-        # guard with a reader writer lock?
-        self._log_exists_or_throw()
-        self.transactions.write(data)
-        self.transactions.flush()
-        self.log_size += len(data)
-        if self.log_size > self.__max_size and self.qsize() == 0:
-            self._rotate_log()
+        Test that an unknown durability mode is rejected
+        '''
+        self.assertRaises(TransactionLogException,
+            PersistentQueue, self.path, "invalid", durability="sometimes")
 
-#---------------------------------------------------------------------------# 
-# Exported Identifiers
-#---------------------------------------------------------------------------# 
-__all__ = [ "PersistentQueue" ]
+#---------------------------------------------------------------------------#
+# Main
+#---------------------------------------------------------------------------#
+if __name__ == "__main__":
+    unittest.main()
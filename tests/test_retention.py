@@ -0,0 +1,108 @@
+import sys, os, time, unittest, shutil, tempfile
+from mamba.retention import RetentionPolicy
+from mamba.persistent import PersistentQueue
+from mamba.collection import QueueCollection
+
+class SimpleRetentionPolicyTest(unittest.TestCase):
+    '''
+    The unit tests for the mamba.retention module
+    '''
+
+    def setUp(self):
+        ''' Initializes the test environment '''
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        ''' Cleans up the test environment '''
+        shutil.rmtree(self.path)
+
+    def createRetired(self, name, size, age):
+        ''' Helper to create a retired log of a given size and age '''
+        path = os.path.join(self.path, name)
+        with open(path, "wb") as log: log.write("x" * size)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def testFindRetired(self):
+        '''
+        Test that retired and rotated logs are found, oldest first
+        '''
+        newer = self.createRetired("jobs.00000002.retired", 10, 10)
+        older = self.createRetired("jobs.00000001.retired", 20, 20)
+        rotated = self.createRetired("jobs.1323100000.25", 30, 30)
+        other = self.createRetired("mail.00000004.retired", 5, 5)
+        for name in ["jobs.00000003.log", "jobs.checkpoint", "jobs"]:
+            self.createRetired(name, 1, 0)
+
+        found = RetentionPolicy.find(self.path)
+        self.assertEqual(sorted(found), ["jobs", "mail"])
+        self.assertEqual([entry[0] for entry in found["jobs"]],
+            [rotated, older, newer])
+        self.assertEqual(found["mail"][0][:2], (other, 5))
+
+    def testDottedQueueNames(self):
+        '''
+        Test that queues named like rotated logs are never swept away
+        '''
+        queue = PersistentQueue(self.path, "audit.1323100000.25")
+        queue.put("kept")
+        queue.close()
+        for name in ["orders.2024", "audit.1323100000.25"]: # pre-segment logs
+            path = self.createRetired(name, 0, 3600)
+            with open(path, "wb") as log: log.write("\x00\x03\x00\x00\x00one")
+            os.utime(path, (time.time() - 3600,) * 2)
+
+        self.assertEqual(PersistentQueue.find_queues(self.path),
+            set(["orders.2024", "audit.1323100000.25"]))
+        self.assertEqual(RetentionPolicy.find(self.path), {})
+        self.assertEqual(RetentionPolicy(max_age=60).enforce(self.path), [])
+        self.assertEqual(len(os.listdir(self.path)), 4)
+        queue = PersistentQueue(self.path, "orders.2024")
+        self.assertEqual(queue.get(), "one")
+        queue.close()
+
+    def testRetentionLimits(self):
+        '''
+        Test that each limit keeps the newest retired logs
+        '''
+        now = time.time()
+        files = [("log%d" % age, 10, now - age) for age in [50, 40, 30, 20, 10]]
+        names = lambda policy: [e[0] for e in policy.expired(files, now)]
+        self.assertEqual(names(RetentionPolicy(max_age=25)), ["log50", "log40", "log30"])
+        self.assertEqual(names(RetentionPolicy(max_count=4)), ["log50"])
+        self.assertEqual(names(RetentionPolicy(max_bytes=25)), ["log50", "log40", "log30"])
+        self.assertEqual(names(RetentionPolicy(max_age=45, max_count=3)), ["log50", "log40"])
+        self.assertFalse(RetentionPolicy().enabled())
+        self.assertEqual(RetentionPolicy().enforce(self.path), [])
+
+    def testRetiredSegments(self):
+        '''
+        Test that consumed segments are retired and then swept away
+        '''
+        database = QueueCollection(self.path, segment_size=64, retain_count=2)
+        for value in range(20):
+            database.put("segments", "item %08d" % value)
+        for value in range(15):
+            database.get("segments")
+        retired = RetentionPolicy.find(self.path)["segments"]
+        self.assertTrue(len(retired) > 2)
+        self.assertEqual(database.get_statistic('retired_logs_removed'), 0)
+
+        database.retention_due = 0
+        database.get("segments")
+        self.assertEqual(len(RetentionPolicy.find(self.path)["segments"]), 2)
+        self.assertTrue(database.get_statistic('retired_logs_removed') > 0)
+        self.assertEqual(PersistentQueue.find_queues(self.path), set(["segments"]))
+        database.close()
+
+        queue = PersistentQueue(self.path, "segments", segment_size=64)
+        expected = ["item %08d" % value for value in range(16, 20)]
+        self.assertEqual([queue.get() for _ in expected], expected)
+        queue.close()
+
+#---------------------------------------------------------------------------#
+# Main
+#---------------------------------------------------------------------------#
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,27 @@
-import sys, unittest
+import sys, unittest, shutil, tempfile
 from mamba.server import *
+from mamba.server import MambaProtocol
+from mamba.handler import Handler
+from mamba.collection import QueueCollection
+from mamba.attr import AttributeDict
+from test_collection import ManualScheduler
+
+class FakeTransport(object):
+    ''' A transport that records what is written to it '''
+
+    disconnecting = False
+
+    def __init__(self): self.written = []
+    def getHost(self): return "localhost"
+    def write(self, data): self.written.append(data)
+
+class FakeFactory(object):
+    ''' A factory that hands out handlers over one collection '''
+
+    def __init__(self, database):
+        self.database = database
+        self.statistics = AttributeDict()
+    def getHandler(self): return Handler(self.database, self.statistics)
 
 class SimpleServerTest(unittest.TestCase):
     '''
@@ -8,11 +30,44 @@ class SimpleServerTest(unittest.TestCase):
 
     def setUp(self):
         ''' Initializes the test environment '''
-        pass
+        self.path = tempfile.mkdtemp()
+        self.scheduler = ManualScheduler()
+        self.database = QueueCollection(self.path, scheduler=self.scheduler)
+        self.protocol = MambaProtocol()
+        self.protocol.factory = FakeFactory(self.database)
+        self.protocol.transport = FakeTransport()
+        self.protocol.connectionMade()
 
     def tearDown(self):
         ''' Cleans up the test environment '''
-        pass
+        self.database.close()
+        shutil.rmtree(self.path)
+
+    def testPipelinedNoreplySets(self):
+        '''
+        Test that noreply sets in one read are stored with one put per queue
+        '''
+        for key in ["first", "second"]: # make the queues ready
+            self.database.when_ready(key, lambda: None)
+        while self.scheduler.calls: self.scheduler.run()
+        batches = []
+        put_many = self.database.put_many
+        def record(key, values):
+            batches.append((key, len(values)))
+            return put_many(key, values)
+        self.database.put_many = record
+
+        keys = ["first", "second"] * 10
+        self.protocol.dataReceived("".join("set %s 0 0 5 noreply\r\nvalue\r\n"
+            % key for key in keys))
+        self.assertEqual(batches, [("first", 10), ("second", 10)])
+        self.assertEqual(self.protocol.transport.written, [])
+
+        self.protocol.dataReceived("set first 0 0 4 noreply\r\nlast\r\n"
+            "set first 0 0 3 noreply\r\nend")
+        self.protocol.dataReceived("\r\nget first/n=99\r\n")
+        self.assertEqual(batches[2:], [("first", 1), ("first", 1)])
+        self.assertEqual(self.protocol.transport.written[0].count("VALUE"), 12)
 
 #---------------------------------------------------------------------------#
 # Main
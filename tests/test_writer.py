@@ -0,0 +1,92 @@
+import sys, unittest, shutil, tempfile
+from mamba.writer import LogWriter
+from mamba.persistent import PersistentQueue
+from mamba.collection import QueueCollection
+from mamba.errors import TransactionLogException
+from test_collection import ManualScheduler
+
+class SimpleLogWriterTest(unittest.TestCase):
+    '''
+    The unit tests for the mamba.writer module
+    '''
+
+    def setUp(self):
+        ''' Initializes the test environment '''
+        self.path = tempfile.mkdtemp()
+        self.scheduler = ManualScheduler()
+
+    def tearDown(self):
+        ''' Cleans up the test environment '''
+        shutil.rmtree(self.path)
+
+    def testBatchedWrites(self):
+        '''
+        Test that records reach the log in one batch before the reply
+        '''
+        writer = LogWriter(2, scheduler=self.scheduler)
+        queue = PersistentQueue(self.path, "batched", background_writes=True)
+        durable = []
+        for value in ["first", "second"]:
+            queue.put(value)
+        queue.when_durable(lambda: durable.append("put"))
+        self.assertTrue(writer.submit(queue))
+        self.assertFalse(writer.submit(queue))
+        queue.when_durable(lambda: durable.append("later"))
+
+        writer.close()
+        self.assertEqual(queue.in_flight, 0)
+        self.assertEqual(durable, [])
+        self.scheduler.run()
+        self.assertEqual(durable, ["put", "later"])
+        queue.close()
+
+        queue = PersistentQueue(self.path, "batched")
+        self.assertEqual([queue.get(), queue.get()], ["first", "second"])
+        queue.close()
+
+    def testCollectionWriters(self):
+        '''
+        Test that the collection hands its commits to the writers
+        '''
+        database = QueueCollection(self.path, log_writers=1,
+            scheduler=self.scheduler)
+        durable = []
+        database.put("queue", "value")
+        database.when_durable("queue", lambda: durable.append(True))
+        self.scheduler.run() # the commit hands the batch over
+        database.writer.close()
+        self.scheduler.run() # the writer reports back
+        self.assertEqual(durable, [True])
+        self.assertEqual(database.get("queue"), "value")
+        database.close()
+
+    def testFailedWrite(self):
+        '''
+        Test that a batch that cannot be written fails its waiters
+        '''
+        writer = LogWriter(1, scheduler=self.scheduler)
+        queue = PersistentQueue(self.path, "failed", background_writes=True)
+        results = []
+        stored, failed = (lambda: results.append("stored"),
+            lambda: results.append("failed"))
+        def broken(log, data): raise IOError("No space left on device")
+        queue._write_records = broken
+        queue.put("lost")
+        queue.when_durable(stored, failed)
+        self.assertTrue(writer.submit(queue))
+        queue.put("after") # held until the next batch
+        queue.when_durable(stored, failed)
+
+        writer.close()
+        self.scheduler.run()
+        self.assertEqual(results, ["failed", "failed"])
+        self.assertRaises(TransactionLogException, queue.put, "again")
+        queue.when_durable(stored, failed)
+        self.assertEqual(results, ["failed"] * 3)
+        queue.close()
+
+#---------------------------------------------------------------------------#
+# Main
+#---------------------------------------------------------------------------#
+if __name__ == "__main__":
+    unittest.main()